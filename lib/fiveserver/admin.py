@@ -2,7 +2,7 @@ from twisted.web import static, server, resource
 from twisted.internet import reactor, defer
 from twisted.words.xish import domish
 from xml.sax.saxutils import escape
-from fiveserver import log
+from fiveserver import log, dbstats
 from fiveserver.model.lobby import MatchState, Match, Match6
 from fiveserver.model import util
 
@@ -13,6 +13,7 @@ import hashlib
 from datetime import datetime
 
 import base64
+import time
 base64.decodestring = base64.decodebytes
 
 try: import psutil
@@ -30,6 +31,9 @@ XML_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
 fsroot = os.environ.get('FSROOT','.')
 XSL_FILE=fsroot+"""/%(XslFile)s"""
 
+LEADERBOARD_CACHE_SECONDS = 5
+LEADERBOARD_CACHE_SIZE = 100
+
 
 class XslResource(resource.Resource):
     isLeaf = True
@@ -121,6 +125,7 @@ class AdminRootResource(BaseXmlResource):
                 <biglog href="/log?n=5000"/>\
                 <users href="/users"/>\
                 <profiles href="/profiles"/>\
+                <leaderboard href="/leaderboard"/>\
                 <onlineUsers href="/users/online"/>\
                 <stats href="/stats"/>\
                 <userlock href="/userlock"/>\
@@ -132,6 +137,9 @@ class AdminRootResource(BaseXmlResource):
                 <banned href="/banned"/>\
                 <server-ip href="/server-ip"/>\
                 <processInfo href="/ps"/>\
+                <dbPools href="/db-pools"/>\
+                <dbStats href="/db-stats"/>\
+                <dbConsumers href="/db-consumers"/>\
                 </adminService>' % (
                         XML_HEADER, 
                         self.config.VERSION,
@@ -149,6 +157,7 @@ class StatsRootResource(BaseXmlResource):
                 <server version="%s" ip="%s"/>\
                 <users href="/users"/>\
                 <profiles href="/profiles"/>\
+                <leaderboard href="/leaderboard"/>\
                 <onlineUsers href="/users/online"/>\
                 <stats href="/stats"/>\
                 <processInfo href="/ps"/>\
@@ -262,7 +271,8 @@ class ProfilesResource(BaseXmlResource):
                 root['href'] = '/profiles'
                 root['name'] = util.toUnicode(profile.name)
                 root['id'] = str(profile.id)
-                root.addElement('rank').addContent(str(profile.rank))
+                root.addElement('rank').addContent(
+                    str(self.config.getProfileRank(profile)))
                 root.addElement('favPlayer').addContent(str(profile.favPlayer))
                 root.addElement('favPlayerId').addContent(
                     str(profile.favPlayer & 0x0000ffff))
@@ -318,6 +328,52 @@ class ProfilesResource(BaseXmlResource):
             return server.NOT_DONE_YET
 
 
+class LeaderboardResource(BaseXmlResource):
+    """
+    Pages of the in-memory leaderboard. Rendered pages are
+    cached for a few seconds, so that frequent polling does
+    not re-render on every leaderboard change.
+    """
+
+    def __init__(self, adminConfig, config, authenticated=True):
+        BaseXmlResource.__init__(self, adminConfig, config, authenticated)
+        self._cache = dict()
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type','text/xml')
+        try: offset = max(0, int(request.args[b'offset'][0]))
+        except: offset = 0
+        try: limit = max(1, min(100, int(request.args[b'limit'][0])))
+        except: limit = 30
+        lb = self.config.leaderboard
+        now = time.time()
+        try: version, timestamp, content = self._cache[(offset, limit)]
+        except KeyError:
+            pass
+        else:
+            if version == lb.version or (
+                    now - timestamp < LEADERBOARD_CACHE_SECONDS):
+                return content
+        root = domish.Element((None,'leaderboard'))
+        root['href'] = '/home'
+        root['total'] = str(len(lb))
+        for rank, profileId, name, points in lb.getPage(offset, limit):
+            e = root.addElement('profile')
+            e['rank'] = str(rank)
+            e['name'] = util.toUnicode(name)
+            e['points'] = str(points)
+            e['division'] = str(self.config.ratingMath.getDivision(points))
+            e['href'] = '/profiles/%s' % profileId
+        next = root.addElement('next')
+        next['href'] = '/leaderboard?offset=%s&limit=%s' % (
+            offset+limit, limit)
+        content = ('%s%s' % (XML_HEADER, root.toXml())).encode('utf-8')
+        if len(self._cache) >= LEADERBOARD_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[(offset, limit)] = (lb.version, now, content)
+        return content
+
+
 class StatsResource(BaseXmlResource):
 
     def render_GET(self, request):
@@ -763,6 +819,188 @@ class RosterResource(BaseXmlResource):
                     'href="/home"/>' % XML_HEADER).encode('utf-8')
 
 
+class DbPoolsResource(BaseXmlResource):
+    """
+    Per-server numbers of the DB pools: latency, load, errors
+    and ejection state. Plus queue depth and wait times of
+    each pool class, if configured.
+    """
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type','text/xml')
+        dbController = self.config.profileData.dbController
+        root = domish.Element((None,'dbPools'))
+        root['href'] = '/home'
+        now = time.time()
+        pools = []
+        for shard, controller in enumerate(dbController.getControllers()):
+            if controller.writePool is not controller.readPool:
+                pools.append((shard, 'read', controller.readPool))
+                pools.append((shard, 'write', controller.writePool))
+            else:
+                pools.append((shard, 'read-write', controller.readPool))
+        for shard, role, pool in pools:
+            poolElem = root.addElement('pool')
+            poolElem['role'] = role
+            if dbController.shardCount > 1:
+                poolElem['shard'] = str(shard + 1)
+            for item in pool.getItems():
+                e = poolElem.addElement('server')
+                e['name'] = item.name
+                if item.latency is None:
+                    e['latency'] = ''
+                else:
+                    e['latency'] = '%0.2fms' % (item.latency*1000)
+                e['outstanding'] = str(item.outstanding)
+                e['requests'] = str(item.requests)
+                e['errors'] = str(item.errors)
+                e['ejections'] = str(item.ejections)
+                if item.isEjected():
+                    e['ejected'] = 'True'
+                    e['probeIn'] = '%ds' % max(0, item.ejectedUntil - now)
+                else:
+                    e['ejected'] = 'False'
+        for shard, controller in enumerate(dbController.getControllers()):
+            for name, poolClass in sorted(controller.poolClasses.items()):
+                e = root.addElement('poolClass')
+                e['name'] = name
+                if dbController.shardCount > 1:
+                    e['shard'] = str(shard + 1)
+                e['size'] = str(poolClass.size)
+                e['running'] = str(poolClass.running)
+                e['queueDepth'] = str(poolClass.getQueueDepth())
+                e['maxQueueDepth'] = str(poolClass.maxQueueDepth)
+                e['queueLimit'] = str(poolClass.queueLimit)
+                e['calls'] = str(poolClass.calls)
+                e['waits'] = str(poolClass.waits)
+                e['avgWait'] = '%0.2fms' % (poolClass.getAverageWait()*1000)
+                e['maxWait'] = '%0.2fms' % (poolClass.maxWait*1000)
+                e['rejected'] = str(poolClass.rejected)
+        return ('%s%s' % (XML_HEADER, root.toXml())).encode('utf-8')
+
+
+class DbStatsResource(BaseXmlResource):
+    """
+    Per-query-label numbers of the DB layer, biggest total
+    time first, and the most recent slow queries.
+    POST resets the numbers.
+    """
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type','text/xml')
+        dbController = self.config.profileData.dbController
+        root = domish.Element((None,'dbStats'))
+        root['href'] = '/home'
+        for shard, controller in enumerate(dbController.getControllers()):
+            if dbController.shardCount > 1:
+                e = root.addElement('shard')
+                e['number'] = str(shard + 1)
+            else:
+                e = root
+            self.addQueryStats(e, controller.queryStats)
+            if controller.queryCache is not None:
+                self.addCacheStats(e, controller.queryCache)
+        return ('%s%s' % (XML_HEADER, root.toXml())).encode('utf-8')
+
+    def addQueryStats(self, root, queryStats):
+        now = time.time()
+        root['since'] = '%ds' % (now - queryStats.since)
+        totalTime = queryStats.getTotalTime()
+        root['totalTime'] = '%0.3fs' % totalTime
+        queriesElem = root.addElement('queries')
+        for stat in queryStats.getStats():
+            e = queriesElem.addElement('query')
+            e['key'] = str(stat.key)
+            e['count'] = str(stat.count)
+            e['errors'] = str(stat.errors)
+            e['errorRate'] = '%0.2f%%' % (stat.getErrorRate()*100)
+            e['totalTime'] = '%0.3fs' % stat.totalTime
+            if totalTime > 0:
+                e['share'] = '%0.1f%%' % (stat.totalTime*100/totalTime)
+            e['avg'] = '%0.2fms' % (stat.getAverage()*1000)
+            e['max'] = '%0.2fms' % (stat.maxTime*1000)
+            for name, p in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]:
+                bound = stat.getPercentile(p)
+                if bound is None:
+                    e[name] = '>%dms' % dbstats.LATENCY_BUCKETS[-1]
+                else:
+                    e[name] = '<=%dms' % bound
+            histogram = e.addElement('histogram')
+            for i, n in enumerate(stat.buckets):
+                if not n:
+                    continue
+                b = histogram.addElement('bucket')
+                if i < len(dbstats.LATENCY_BUCKETS):
+                    b['le'] = '%dms' % dbstats.LATENCY_BUCKETS[i]
+                else:
+                    b['le'] = 'inf'
+                b['count'] = str(n)
+        slowElem = root.addElement('slowQueries')
+        slowElem['threshold'] = '%dms' % (queryStats.slowQuerySeconds*1000)
+        for t, key, sql, elapsed, server in reversed(queryStats.slowQueries):
+            e = slowElem.addElement('query')
+            e['time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+            e['key'] = str(key)
+            e['elapsed'] = '%0.1fms' % (elapsed*1000)
+            e['server'] = server
+            e.addElement('sql').addContent(sql)
+
+    def addCacheStats(self, root, queryCache):
+        cacheElem = root.addElement('queryCache')
+        cacheElem['entries'] = str(len(queryCache))
+        cacheElem['size'] = str(queryCache.size)
+        for stat in queryCache.getStats():
+            e = cacheElem.addElement('query')
+            e['key'] = str(stat.key)
+            e['hits'] = str(stat.hits)
+            e['misses'] = str(stat.misses)
+            e['hitRate'] = '%0.1f%%' % (stat.getHitRate()*100)
+
+    def render_POST(self, request):
+        dbController = self.config.profileData.dbController
+        for controller in dbController.getControllers():
+            controller.queryStats.reset()
+            if controller.queryCache is not None:
+                controller.queryCache.resetStats()
+        request.setHeader('Content-Type','text/xml')
+        return ('%s<dbStats reset="True" href="/db-stats"/>' % (
+                XML_HEADER)).encode('utf-8')
+
+
+class DbConsumersResource(BaseXmlResource):
+    """
+    Top DB consumers: connections with the most time spent
+    in DB-backed requests, along with their request counts
+    and what their admission gate collapsed or dropped.
+    """
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type','text/xml')
+        try: n = max(1, min(1000, int(request.args[b'n'][0])))
+        except: n = 20
+        gates = sorted(self.config.dbRequestGates,
+                       key=lambda gate: gate.busyTime, reverse=True)
+        root = domish.Element((None,'dbConsumers'))
+        root['href'] = '/home'
+        root['connections'] = str(len(gates))
+        root['maxInFlight'] = str(self.config.maxDbRequestsInFlight)
+        root['maxQueued'] = str(self.config.maxDbRequestsQueued)
+        now = time.time()
+        for gate in gates[:n]:
+            e = root.addElement('connection')
+            e['addr'] = str(gate.protocol.addr)
+            e['name'] = gate.getName()
+            e['service'] = gate.protocol.__class__.__name__
+            e['requests'] = str(gate.requests)
+            e['inFlight'] = str(gate.inFlight)
+            e['queueDepth'] = str(gate.getQueueDepth())
+            e['collapsed'] = str(gate.collapsed)
+            e['dropped'] = str(gate.dropped)
+            e['busyTime'] = '%0.3fs' % gate.busyTime
+            e['connectedFor'] = '%ds' % (now - gate.since)
+        return ('%s%s' % (XML_HEADER, root.toXml())).encode('utf-8')
+
+
 class ProcessInfoResource(BaseXmlResource):
 
     def render_GET(self, request):
@@ -0,0 +1,144 @@
+"""
+Database pool on an asyncio-native MySQL driver (aiomysql),
+for Twisted's asyncio reactor. Drop-in for adbapi.ConnectionPool
+as far as StorageController is concerned: runQuery and
+runInteraction return Deferreds.
+"""
+
+import asyncio
+
+from twisted.internet import defer, threads
+
+import aiomysql
+
+
+class AioTransaction:
+    """
+    What interactions get instead of adbapi Transaction.
+    Interactions are ordinary blocking functions, so they run
+    in a worker thread, and each cursor call waits there for
+    the query, which runs on the event loop.
+    """
+
+    def __init__(self, loop, cursor):
+        self._loop = loop
+        self._cursor = cursor
+
+    def _wait(self, method, *args):
+        # cursor methods return coroutines (execute) or futures
+        # (fetch*): either way, call and await them on the loop
+        async def call():
+            return await method(*args)
+        return asyncio.run_coroutine_threadsafe(call(), self._loop).result()
+
+    def execute(self, sql, args=None):
+        return self._wait(self._cursor.execute, sql, args)
+
+    def executemany(self, sql, args):
+        return self._wait(self._cursor.executemany, sql, args)
+
+    def fetchall(self):
+        return self._wait(self._cursor.fetchall)
+
+    def fetchone(self):
+        return self._wait(self._cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        return self._wait(self._cursor.fetchmany, size)
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+
+class AioConnectionPool:
+    """
+    Pool of aiomysql connections. Plain queries run on the
+    event loop without any thread: a connection is cheap,
+    so the pool can be much bigger than an adbapi one and
+    many queries can be in flight at once.
+    """
+    dbapiName = 'aiomysql'
+
+    def __init__(self, host, port, user, passwd, db,
+                 min_connections=3, max_connections=50):
+        self.connkw = dict(host=host, port=port, user=user, db=db)
+        self._passwd = passwd
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self._pool = None
+        self._creating = None
+
+    def _fromCoroutine(self, coro):
+        return defer.Deferred.fromFuture(asyncio.ensure_future(coro))
+
+    async def _getPool(self):
+        if self._pool is None:
+            if self._creating is None:
+                self._creating = asyncio.ensure_future(
+                    aiomysql.create_pool(
+                        password=self._passwd, charset='utf8',
+                        use_unicode=True, autocommit=True,
+                        minsize=self.min_connections,
+                        maxsize=self.max_connections, **self.connkw))
+            self._pool = await asyncio.shield(self._creating)
+        return self._pool
+
+    async def _runQuery(self, sql, args):
+        pool = await self._getPool()
+        async with pool.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute(sql, args)
+                return await cursor.fetchall()
+
+    def runQuery(self, sql, args=None):
+        return self._fromCoroutine(self._runQuery(sql, args))
+
+    async def _begin(self):
+        pool = await self._getPool()
+        conn = await pool.acquire()
+        try:
+            await conn.begin()
+            cursor = await conn.cursor()
+        except:
+            pool.release(conn)
+            raise
+        return pool, conn, cursor
+
+    async def _end(self, pool, conn, cursor, commit):
+        try:
+            await cursor.close()
+            if commit:
+                await conn.commit()
+            else:
+                await conn.rollback()
+        finally:
+            pool.release(conn)
+
+    def runInteraction(self, interaction, *args, **kw):
+        d = self._fromCoroutine(self._begin())
+        d.addCallback(self._interact, interaction, args, kw)
+        return d
+
+    def _interact(self, begun, interaction, args, kw):
+        def _done(result):
+            d = self._fromCoroutine(self._end(*begun, commit=True))
+            d.addCallback(lambda _: result)
+            return d
+        def _failed(error):
+            d = self._fromCoroutine(self._end(*begun, commit=False))
+            d.addBoth(lambda _: error)
+            return d
+        pool, conn, cursor = begun
+        transaction = AioTransaction(asyncio.get_event_loop(), cursor)
+        d = threads.deferToThread(interaction, transaction, *args, **kw)
+        d.addCallbacks(_done, _failed)
+        return d
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
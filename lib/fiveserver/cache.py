@@ -0,0 +1,253 @@
+"""
+In-memory caches
+"""
+
+from collections import OrderedDict
+import hashlib
+import re
+from time import time
+import zlib
+
+from fiveserver.model import user
+
+
+SETTINGS_CACHE_SIZE = 2000
+SETTINGS_DIGESTS_SIZE = 100000
+SETTINGS_COMPRESS_LEVEL = 6
+SETTINGS_MIN_COMPRESS_SIZE = 0
+
+# zlib streams never start with a zero byte
+RAW_MARKER = b'\0'
+
+QUERY_CACHE_SIZE = 10000
+
+# table names after FROM, JOIN, INTO, UPDATE, including
+# comma-separated lists of tables, e.g. "FROM matches, streaks"
+TABLE_NAME = r'`?\w+`?(?:\s+(?:AS\s+)?\w+)?'
+TABLES_RE = re.compile(
+    r'\b(?:FROM|JOIN|INTO|(?<!KEY\s)UPDATE)\s+(%s(?:\s*,\s*%s)*)' % (
+    TABLE_NAME, TABLE_NAME), re.I)
+_tables = dict()
+
+
+class SettingsCache:
+    """
+    Decompressed profile settings of recently active profiles,
+    plus content digests of what is stored in DB for many more,
+    so that saving unchanged settings can skip the DB write.
+    Also knows how settings blobs are encoded in DB: zlib with
+    configurable level, or raw (prefixed with RAW_MARKER) when
+    smaller than minCompressSize.
+    """
+
+    def __init__(self, size=SETTINGS_CACHE_SIZE,
+                 compressLevel=SETTINGS_COMPRESS_LEVEL,
+                 minCompressSize=SETTINGS_MIN_COMPRESS_SIZE):
+        self.size = size
+        self.compressLevel = compressLevel
+        self.minCompressSize = minCompressSize
+        self._settings = OrderedDict()
+        self._digests = OrderedDict()
+
+    def encode(self, data):
+        if data is None:
+            return None
+        if len(data) < self.minCompressSize:
+            return RAW_MARKER + data
+        return zlib.compress(data, self.compressLevel)
+
+    def decode(self, blob):
+        if blob is None:
+            return None
+        if blob[:1] == RAW_MARKER:
+            return blob[1:]
+        return zlib.decompress(blob)
+
+    def digest(self, settings):
+        return tuple(
+            None if data is None else hashlib.md5(data).digest()
+            for data in (settings.settings1, settings.settings2))
+
+    def get(self, profileId):
+        """
+        Return decompressed settings, or None if not cached
+        """
+        try: settings = self._settings[profileId]
+        except KeyError:
+            return None
+        self._settings.move_to_end(profileId)
+        return settings
+
+    def put(self, profileId, settings):
+        """
+        Remember settings as stored in DB
+        """
+        self._settings[profileId] = settings
+        self._settings.move_to_end(profileId)
+        while len(self._settings) > self.size:
+            self._settings.popitem(last=False)
+        self._digests[profileId] = self.digest(settings)
+        self._digests.move_to_end(profileId)
+        while len(self._digests) > SETTINGS_DIGESTS_SIZE:
+            self._digests.popitem(last=False)
+
+    def load(self, profileId, storedSettings):
+        """
+        Decompress settings, as read from DB, and cache them
+        """
+        settings = user.ProfileSettings(
+            self.decode(storedSettings.settings1),
+            self.decode(storedSettings.settings2))
+        self.put(profileId, settings)
+        return settings
+
+    def isChanged(self, profileId, settings):
+        return self._digests.get(profileId) != self.digest(settings)
+
+    def forget(self, profileId):
+        self._settings.pop(profileId, None)
+        self._digests.pop(profileId, None)
+
+
+def getTables(sql):
+    """
+    Return names of tables a statement reads or writes
+    """
+    try: return _tables[sql]
+    except KeyError:
+        pass
+    tables = set()
+    for match in TABLES_RE.finditer(sql):
+        for name in match.group(1).split(','):
+            tables.add(name.split()[0].strip('`').lower())
+    tables = _tables[sql] = frozenset(tables)
+    return tables
+
+
+class QueryCacheStat:
+
+    def __init__(self, key):
+        self.key = key
+        self.hits = 0
+        self.misses = 0
+
+    def getHitRate(self):
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return float(self.hits) / total
+
+
+class QueryCache:
+    """
+    Results of reads, for the query labels that opt in, keyed by
+    (label, sql, args) and least recently used ones evicted first.
+    Every table has a generation, bumped by writes to it. Entries
+    remember generations of their tables as they were when the
+    read started: if any has changed since, the entry is stale.
+    """
+
+    def __init__(self, labels=None, size=QUERY_CACHE_SIZE):
+        self.labels = frozenset(labels or [])
+        self.size = size
+        self._entries = OrderedDict()
+        self._generations = dict()
+        self._changedAt = dict()
+        self._stats = dict()
+
+    def isCached(self, key):
+        return key in self.labels
+
+    def getStat(self, key):
+        try: return self._stats[key]
+        except KeyError:
+            stat = self._stats[key] = QueryCacheStat(key)
+            return stat
+
+    def getStats(self):
+        return sorted(self._stats.values(), key=lambda stat: stat.key)
+
+    def getGenerations(self, tables):
+        return tuple(self._generations.get(t, 0) for t in tables)
+
+    def get(self, key, sql, args):
+        """
+        Return cached results, or None
+        """
+        cacheKey = (key, sql, args)
+        try: results, generations = self._entries[cacheKey]
+        except KeyError:
+            self.getStat(key).misses += 1
+            return None
+        if generations != self.getGenerations(getTables(sql)):
+            del self._entries[cacheKey]
+            self.getStat(key).misses += 1
+            return None
+        self._entries.move_to_end(cacheKey)
+        self.getStat(key).hits += 1
+        return results
+
+    def put(self, key, sql, args, results, generations):
+        """
+        Remember results of a read, which started when
+        its tables had the given generations
+        """
+        if generations != self.getGenerations(getTables(sql)):
+            # written meanwhile: results may be stale already
+            return
+        cacheKey = (key, sql, args)
+        self._entries[cacheKey] = (tuple(results), generations)
+        self._entries.move_to_end(cacheKey)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, tables):
+        """
+        Make entries of the tables stale
+        """
+        now = time()
+        for t in tables:
+            self._generations[t] = self._generations.get(t, 0) + 1
+            self._changedAt[t] = now
+
+    def changedWithin(self, tables, seconds):
+        """
+        Return True, if any of the tables was written
+        within the last given seconds
+        """
+        since = time() - seconds
+        for t in tables:
+            if self._changedAt.get(t, 0) > since:
+                return True
+        return False
+
+    def clear(self):
+        self._entries.clear()
+
+    def resetStats(self):
+        self._stats.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TableTracker:
+    """
+    Wraps transaction of a write interaction, collecting
+    names of the tables its statements touch
+    """
+
+    def __init__(self, trans):
+        self._trans = trans
+        self.tables = set()
+
+    def execute(self, sql, *args, **kw):
+        self.tables.update(getTables(sql))
+        return self._trans.execute(sql, *args, **kw)
+
+    def executemany(self, sql, *args, **kw):
+        self.tables.update(getTables(sql))
+        return self._trans.executemany(sql, *args, **kw)
+
+    def __getattr__(self, name):
+        return getattr(self._trans, name)
@@ -6,16 +6,25 @@ Configuration classes for packet server
 from twisted.internet import reactor, defer
 from twisted.web import client
 from xml.dom import minidom
+from Crypto.Cipher import Blowfish
 from datetime import datetime, timedelta
 import time
 import random
+import binascii
 import struct
 import socket
 
 from fiveserver.model import lobby, user
-from fiveserver import storagecontroller, errors, rating, log
+from fiveserver import storagecontroller, errors, rating, log, leaderboard
+from fiveserver import writebehind, cache, dbstats, sqlitebackend, journal
 import yaml
 import os
+import weakref
+
+
+SESSION_TTL = 60 # seconds
+DB_REQUESTS_IN_FLIGHT = 2 # per connection
+DB_REQUESTS_QUEUED = 8 # per connection
 
 
 class YamlConfig:
@@ -60,15 +69,22 @@ class YamlConfig:
 
 
 class ConnectionPoolConfig:
+    """
+    ConnectionPool subsection of DB configuration. "classes"
+    splits the connections between workloads: a dict of pool
+    class name -> {size, queueLimit} (see PoolClass).
+    """
 
     def __init__(self, minConnections=3, maxConnections=5, reconnect=True,
                  keepAliveQuery=storagecontroller.KEEPALIVE_QUERY, 
-                 keepAliveInterval=storagecontroller.KEEPALIVE_INTERVAL):
+                 keepAliveInterval=storagecontroller.KEEPALIVE_INTERVAL,
+                 classes=None):
         self.minConnections = minConnections
         self.maxConnections = maxConnections
         self.reconnect = reconnect
         self.keepAliveQuery = keepAliveQuery
         self.keepAliveInterval = keepAliveInterval
+        self.classes = classes or dict()
         # validate config
         if self.minConnections < 1:
             raise errors.ConfigurationError(
@@ -80,13 +96,55 @@ class ConnectionPoolConfig:
             raise errors.ConfigurationError(
                 'maxConnections is specified in seconds. '
                 'It must be >= %s' % storagecontroller.MIN_KEEPALIVE_INTERVAL)
+        totalSize = 0
+        for name, options in self.classes.items():
+            if name not in storagecontroller.POOL_CLASSES:
+                raise errors.ConfigurationError(
+                    'ConnectionPool.classes: unknown class "%s". '
+                    'Known classes: %s' % (name, ', '.join(
+                    storagecontroller.POOL_CLASSES)))
+            try: size = int(options['size'])
+            except (KeyError, TypeError, ValueError):
+                raise errors.ConfigurationError(
+                    'ConnectionPool.classes.%s.size is missing' % name)
+            if size < 1:
+                raise errors.ConfigurationError(
+                    'ConnectionPool.classes.%s.size must be >= 1' % name)
+            totalSize += size
+        if totalSize > self.maxConnections:
+            raise errors.ConfigurationError(
+                'sizes of ConnectionPool.classes add up to %d: '
+                'more than maxConnections' % totalSize)
+
+    def getPoolClasses(self):
+        """
+        Return new PoolClass gates, as configured
+        """
+        return [storagecontroller.PoolClass(name, int(options['size']),
+            int(options.get('queueLimit',
+                storagecontroller.POOL_CLASS_QUEUE_LIMIT)))
+            for name, options in sorted(self.classes.items())]
 
 
 class DatabaseConfig:
+    """
+    DB section of server configuration. With "shards", a list
+    of {readServers, writeServers} dicts, the data is spread
+    over several shards (see ShardedStorageController), and
+    top-level readServers/writeServers are not used.
+    With backend "sqlite", the database is the SQLite file
+    at "path"; with "memory", it lives in memory only. Either
+    way, tables are created from the "schema" file, if given.
+    QueryCache: {labels, size} turns on caching of results
+    of the listed query labels (see cache.QueryCache).
+    """
 
     def __init__(self, name=None, readServers=None, writeServers=None, 
                  user=None, password=None, port=3306, sharePool=False,
-                 ConnectionPool=None):
+                 ConnectionPool=None, readYourWritesSeconds=None,
+                 slowQuerySeconds=None, shards=None,
+                 backend='mysql', path=None, schema=None, driver='adbapi',
+                 QueryCache=None, groupCommitSeconds=0):
         self._readPool = None
         self._writePool = None
         self.name = name
@@ -96,51 +154,149 @@ class DatabaseConfig:
         self.writeServers = writeServers
         self.user = user
         self.password = password
+        self.backend = backend
+        self.driver = driver
+        self.path = path
+        self.schema = schema
+        self.QueryCache = QueryCache or dict()
+        self.groupCommitSeconds = groupCommitSeconds
+        if readYourWritesSeconds is None:
+            readYourWritesSeconds = storagecontroller.READ_YOUR_WRITES_SECONDS
+        self.readYourWritesSeconds = readYourWritesSeconds
+        if slowQuerySeconds is None:
+            slowQuerySeconds = dbstats.SLOW_QUERY_SECONDS
+        self.slowQuerySeconds = slowQuerySeconds
         if ConnectionPool is not None:
             self.ConnectionPool = ConnectionPoolConfig(**ConnectionPool)
         else:
             self.ConnectionPool = ConnectionPoolConfig()
+        self.shards = []
+        for shard in (shards or []):
+            try:
+                shardReadServers = shard['readServers']
+                shardWriteServers = shard['writeServers']
+            except (KeyError, TypeError):
+                raise errors.ConfigurationError(
+                    'DB.shards entries must have readServers '
+                    'and writeServers')
+            self.shards.append(DatabaseConfig(
+                name=name, readServers=shardReadServers,
+                writeServers=shardWriteServers, user=user,
+                password=password, port=port, sharePool=sharePool,
+                ConnectionPool=ConnectionPool,
+                readYourWritesSeconds=readYourWritesSeconds,
+                slowQuerySeconds=slowQuerySeconds, driver=driver,
+                QueryCache=QueryCache,
+                groupCommitSeconds=groupCommitSeconds))
 
         # validate config
         if self.name is None:
             raise errors.ConfigurationError(
                 'DB.name is None or missing')
-        if self.readServers is None or not self.readServers:
+        if self.backend not in storagecontroller.BACKENDS:
             raise errors.ConfigurationError(
-                'DB.readServers is None or empty list or missing')
-        if self.writeServers is None or not self.writeServers:
+                'DB.backend must be one of: %s' % ', '.join(
+                storagecontroller.BACKENDS))
+        if self.driver not in storagecontroller.DRIVERS:
             raise errors.ConfigurationError(
-                'DB.writeServers is None or empty list or missing')
-        if self.user is None:
+                'DB.driver must be one of: %s' % ', '.join(
+                storagecontroller.DRIVERS))
+        if self.backend != 'mysql':
+            if self.driver != 'adbapi':
+                raise errors.ConfigurationError(
+                    'DB.driver "%s" needs "mysql" backend' % self.driver)
+            if self.shards:
+                raise errors.ConfigurationError(
+                    'DB.shards need "mysql" backend')
+            if self.backend == 'sqlite' and self.path is None:
+                raise errors.ConfigurationError(
+                    'DB.path is None or missing')
+            if self.backend == 'memory' and self.schema is None:
+                raise errors.ConfigurationError(
+                    'DB.schema is None or missing')
+        else:
+            if not self.shards:
+                if self.readServers is None or not self.readServers:
+                    raise errors.ConfigurationError(
+                        'DB.readServers is None or empty list or missing')
+                if self.writeServers is None or not self.writeServers:
+                    raise errors.ConfigurationError(
+                        'DB.writeServers is None or empty list or missing')
+            if self.user is None:
+                raise errors.ConfigurationError(
+                    'DB.user is None or missing')
+            if self.password is None:
+                raise errors.ConfigurationError(
+                    'DB.password is None or missing')
+        if self.readYourWritesSeconds < 0:
             raise errors.ConfigurationError(
-                'DB.user is None or missing')
-        if self.password is None:
+                'DB.readYourWritesSeconds must be >= 0')
+        if self.slowQuerySeconds < 0:
             raise errors.ConfigurationError(
-                'DB.password is None or missing')
+                'DB.slowQuerySeconds must be >= 0')
+        if self.groupCommitSeconds < 0:
+            raise errors.ConfigurationError(
+                'DB.groupCommitSeconds must be >= 0')
+        if not isinstance(self.QueryCache.get('labels', []), list):
+            raise errors.ConfigurationError(
+                'DB.QueryCache.labels must be a list of query labels')
         
     def getReadPool(self):
         if self._readPool is not None:
             return self._readPool
-        if self.sharePool and self.readServers == self.writeServers:
+        if self.backend != 'mysql':
+            # one file: nothing to split
+            self._readPool = self.getWritePool()
+        elif self.sharePool and self.readServers == self.writeServers:
             self._readPool = self.getWritePool()
         else:
             self._readPool = storagecontroller.getDbPool(self.readServers,
                 db=self.name, user=self.user, passwd=self.password,
                 port=self.port, reconnect=self.ConnectionPool.reconnect,
                 min_connections=self.ConnectionPool.minConnections,
-                max_connections=self.ConnectionPool.maxConnections)
+                max_connections=self.ConnectionPool.maxConnections,
+                driver=self.driver)
         return self._readPool
                 
     def getWritePool(self):
         if self._writePool is not None:
             return self._writePool
-        self._writePool = storagecontroller.getDbPool(self.readServers,
+        if self.backend != 'mysql':
+            memory = self.backend == 'memory'
+            path = self.path or self.name
+            if self.schema is not None:
+                sqlitebackend.createSchema(path, memory, self.schema)
+            self._writePool = storagecontroller.getSqlitePool(path, memory,
+                max_connections=self.ConnectionPool.maxConnections)
+            return self._writePool
+        self._writePool = storagecontroller.getDbPool(self.writeServers,
             db=self.name, user=self.user, passwd=self.password,
             port=self.port, reconnect=self.ConnectionPool.reconnect,
             min_connections=self.ConnectionPool.minConnections,
-            max_connections=self.ConnectionPool.maxConnections)
+            max_connections=self.ConnectionPool.maxConnections,
+            driver=self.driver)
         return self._writePool
 
+    def getStorageController(self):
+        """
+        Return StorageController, or ShardedStorageController
+        if shards are configured
+        """
+        if self.shards:
+            return storagecontroller.ShardedStorageController([
+                shard.getStorageController() for shard in self.shards])
+        queryCache = None
+        if self.QueryCache.get('labels'):
+            queryCache = cache.QueryCache(self.QueryCache['labels'],
+                int(self.QueryCache.get('size', cache.QUERY_CACHE_SIZE)))
+        return storagecontroller.StorageController(
+            self.getReadPool(), self.getWritePool(),
+            readYourWritesSeconds=self.readYourWritesSeconds,
+            slowQuerySeconds=self.slowQuerySeconds,
+            queryCache=queryCache,
+            groupCommitSeconds=self.groupCommitSeconds,
+            poolClasses=self.ConnectionPool.getPoolClasses())
+
  
 class FiveServerConfig:
     """
@@ -163,6 +319,9 @@ class FiveServerConfig:
         self.cipherKey = ('27501fd04e6b82c831024dac5c6305221974deb9388a2190'
                           '1d576cbbe2f377ef23d75486010f37819afe6c321a0146d2'
                           '1544ec365bf7289a')
+        # ECB mode keeps no state: one cipher object serves everyone
+        self.cipher = Blowfish.new(
+            binascii.a2b_hex(self.cipherKey), Blowfish.MODE_ECB)
         
         self.serverIP_lan = None
         self.serverIP_wan = None
@@ -224,11 +383,69 @@ class FiveServerConfig:
             self.ipDetectUri = 'http://mapote.com/cgi-bin/ip.py'
 
         # rating/points calculator
-        self.ratingMath = rating.RatingMath(0.44, 0.56)
+        self.ratingMath = rating.makeRatingMath(
+            self.serverConfig.get('Rating'))
+
+        # real-time leaderboard (loaded from DB at startup)
+        self.leaderboard = leaderboard.Leaderboard()
+        reactor.callLater(0, self.initLeaderboard)
+
+        # write-behind queue for cosmetic profile changes
+        try: interval = int(self.serverConfig.WriteBehind['interval'])
+        except: interval = writebehind.DEFAULT_INTERVAL
+        try: dumpPath = self.serverConfig.WriteBehind['dumpPath']
+        except: dumpPath = writebehind.DEFAULT_DUMP_PATH
+        self.profileWriteQueue = writebehind.WriteBehindQueue(
+            self.profileData.store, interval, dumpPath)
+        reactor.addSystemEventTrigger(
+            'before', 'shutdown', self.profileWriteQueue.shutdown)
+
+        # match journal: match results are safe on local disk
+        # before they reach the DB (see journal.MatchJournal)
+        journalConfig = self.serverConfig.get('MatchJournal')
+        if journalConfig:
+            try: path = journalConfig['path']
+            except KeyError:
+                raise errors.ConfigurationError(
+                    'MatchJournal must include "path" attribute')
+            matchJournal = journal.MatchJournal(
+                path, self.matchData, float(journalConfig.get(
+                    'fsyncSeconds', journal.FSYNC_SECONDS)),
+                int(journalConfig.get('keepDays', journal.KEEP_DAYS)))
+            self.profileLogic.matchJournal = matchJournal
+            reactor.callWhenRunning(matchJournal.start)
+            reactor.addSystemEventTrigger(
+                'before', 'shutdown', matchJournal.shutdown)
+
+        # profile settings: hot decompressed copies and digests
+        settingsConfig = self.serverConfig.get('Settings') or dict()
+        self.settingsCache = cache.SettingsCache(
+            size=int(settingsConfig.get(
+                'cacheSize', cache.SETTINGS_CACHE_SIZE)),
+            compressLevel=int(settingsConfig.get(
+                'compressLevel', cache.SETTINGS_COMPRESS_LEVEL)),
+            minCompressSize=int(settingsConfig.get(
+                'minCompressSize', cache.SETTINGS_MIN_COMPRESS_SIZE)))
+
+        # per-connection admission of DB-backed requests
+        # (see protocol.DbRequestGate)
+        dbRequestsConfig = self.serverConfig.get('DbRequests') or dict()
+        self.maxDbRequestsInFlight = int(dbRequestsConfig.get(
+            'maxInFlight', DB_REQUESTS_IN_FLIGHT))
+        self.maxDbRequestsQueued = int(dbRequestsConfig.get(
+            'maxQueued', DB_REQUESTS_QUEUED))
+        self.dbRequestGates = weakref.WeakSet()
 
         # initialize online-list
         self.onlineUsers = dict()
 
+        # users recently loaded at login, handed over from one
+        # service connection to the next: {hash: (user, expiry)}
+        try: self.sessionTTL = int(self.serverConfig.SessionCache['ttl'])
+        except: self.sessionTTL = SESSION_TTL
+        self._sessions = dict()
+        reactor.callLater(self.sessionTTL, self.purgeSessions)
+
         # initialize latest-info dict
         self._latestUserInfo = dict()
 
@@ -302,10 +519,48 @@ class FiveServerConfig:
                 datetime.now() + td))
             seconds = td.days*24*60*60 + td.seconds
             reactor.callLater(seconds, self.computeRanks)
+            # re-sync in-memory leaderboard with DB
+            return self.initLeaderboard()
         d = self.profileData.computeRanks()
         d.addCallback(_reschedule)
         return d
 
+    @defer.inlineCallbacks
+    def loadLeaderboard(self):
+        rows = yield self.profileData.getRankingData()
+        self.leaderboard.load(rows)
+        log.msg('NOTICE: Leaderboard loaded (%d profiles).' % len(
+            self.leaderboard))
+        defer.returnValue(True)
+
+    def initLeaderboard(self, retryDelay=1):
+        def _error(error, retryDelay):
+            retryDelay = min(retryDelay*2, 120)
+            log.msg(
+                'WARN: Failed to load leaderboard (ERROR: %s). '
+                'Using ranks from DB, trying again in %d seconds' % (
+                str(error.value), retryDelay))
+            reactor.callLater(retryDelay, self.initLeaderboard, retryDelay)
+        d = self.loadLeaderboard()
+        d.addErrback(_error, retryDelay)
+        return d
+
+    def updateLeaderboard(self, profile):
+        if profile.id > 0 and profile.name:
+            self.leaderboard.update(
+                profile.id, profile.name, profile.points,
+                int(profile.playTime.total_seconds()))
+
+    def getProfileRank(self, profile):
+        """
+        Return up-to-date rank of the profile from the leaderboard,
+        falling back to the rank stored in DB by computeRanks.
+        """
+        rank = self.leaderboard.getRank(profile.id)
+        if rank is None:
+            return profile.rank
+        return rank
+
     def makeFastBannedList(self):
         self.fastBannedList = []
         for spec in self.bannedList.Banned:
@@ -384,6 +639,33 @@ class FiveServerConfig:
             value = True
         return value
 
+    @defer.inlineCallbacks
+    def getSettings(self, profileId):
+        """
+        Return decompressed settings of a profile
+        """
+        settings = self.settingsCache.get(profileId)
+        if settings is None:
+            stored = yield self.profileData.getSettings(profileId)
+            settings = self.settingsCache.load(profileId, stored)
+        defer.returnValue(settings)
+
+    @defer.inlineCallbacks
+    def storeSettings(self, profileId, settings):
+        """
+        Compress and store settings, unless they are
+        the same as already stored
+        """
+        if not self.settingsCache.isChanged(profileId, settings):
+            defer.returnValue(False)
+        stored = user.ProfileSettings(
+            self.settingsCache.encode(settings.settings1),
+            self.settingsCache.encode(settings.settings2))
+        yield self.profileData.storeSettings(profileId, stored)
+        self.settingsCache.put(profileId, user.ProfileSettings(
+            settings.settings1, settings.settings2))
+        defer.returnValue(True)
+
     @defer.inlineCallbacks
     def storePlayerData(self, usr):
         for profile in usr.profiles:
@@ -394,29 +676,102 @@ class FiveServerConfig:
 
     @defer.inlineCallbacks
     def storeProfile(self, profile):
-        yield self.profileData.store(profile)
-        profiles = yield self.profileData.findByName(profile.name)
-        defer.returnValue(profiles[0])
+        if profile.id is None or profile.id <= 0:
+            # new profile
+            self.endSession(userId=profile.userId)
+        # full write: supersedes any pending one
+        self.profileWriteQueue.discard(profile.id)
+        profile = yield self.profileData.store(profile)
+        self.updateLeaderboard(profile)
+        defer.returnValue(profile)
      
+    def storeProfileAfterMatch(self, profile):
+        """
+        Store points and play time of a match participant. With
+        a match journal, the match does not wait for the DB here
+        either: the leaderboard is updated right away, the
+        profile is written behind.
+        """
+        if self.profileLogic.matchJournal is None:
+            return self.storeProfile(profile)
+        self.updateLeaderboard(profile)
+        return self.storeProfileLater(profile)
+
+    def storeProfileLater(self, profile):
+        """
+        Queue profile for writing. For changes that nobody needs
+        to wait for: favourite team/player, comment, disconnects.
+        """
+        if profile.id is None or profile.id <= 0:
+            return self.storeProfile(profile)
+        self.profileWriteQueue.put(profile.id, profile)
+        return defer.succeed(profile)
+
     @defer.inlineCallbacks
     def deleteProfile(self, profile):
+        self.endSession(userId=profile.userId)
+        self.profileWriteQueue.discard(profile.id)
         yield self.profileData.delete(profile)
+        self.leaderboard.remove(profile.id)
+        self.profileLogic.forgetStats(profile.id)
+        self.settingsCache.forget(profile.id)
         defer.returnValue(True)
 
+    def _sessionKey(self, hash):
+        if isinstance(hash, bytes):
+            return hash.decode('utf-8')
+        return hash
+
+    def purgeSessions(self):
+        now = time.time()
+        for key, (usr, expiry) in list(self._sessions.items()):
+            if expiry < now:
+                del self._sessions[key]
+        reactor.callLater(self.sessionTTL, self.purgeSessions)
+
+    def endSession(self, hash=None, userId=None):
+        """
+        Forget cached session of a user, so that next
+        getUser call loads it from DB again.
+        """
+        if hash is not None:
+            self._sessions.pop(self._sessionKey(hash), None)
+        if userId is not None:
+            for key, (usr, expiry) in list(self._sessions.items()):
+                if usr.id == userId:
+                    del self._sessions[key]
+
     @defer.inlineCallbacks
     def getUser(self, hash):
-        users = yield self.userData.findByHash(hash)
-        if not users:
+        """
+        Return user with profiles. Within session TTL, the user
+        loaded by previous service connection is re-used.
+        """
+        key = self._sessionKey(hash)
+        now = time.time()
+        try: usr, expiry = self._sessions[key]
+        except KeyError:
+            pass
+        else:
+            if expiry >= now:
+                self._sessions[key] = (usr, now + self.sessionTTL)
+                defer.returnValue(usr.copySession())
+            del self._sessions[key]
+        results = yield self.userData.findByHashWithProfiles(
+            hash, self.profileData)
+        if not results:
             raise errors.UnknownUserError('Unknown user: %s' % hash)
-        profiles = yield self.profileData.getByUserId(users[0].id)
-        users[0].profiles = [None, None, None]
+        usr, profiles = results[0]
+        usr.profiles = [None, None, None]
         for profile in profiles:
-            users[0].profiles[profile.index] = profile
+            profile = self.profileWriteQueue.get(profile.id, profile)
+            usr.profiles[profile.index] = profile
         for i in range(3):
-            if users[0].profiles[i] is None:
-                users[0].profiles[i] = user.Profile(i)
-                users[0].profiles[i].userId = users[0].id
-        defer.returnValue(users[0])
+            if usr.profiles[i] is None:
+                usr.profiles[i] = user.Profile(i)
+                usr.profiles[i].userId = usr.id
+        self._sessions[key] = (usr, now + self.sessionTTL)
+        defer.returnValue(usr.copySession())
 
     def getLobbies(self):
         return self.lobbies
@@ -433,6 +788,9 @@ class FiveServerConfig:
     def userOffline(self, usr):
         if not usr:
             return
+        for profile in usr.profiles or []:
+            if profile is not None:
+                self.profileWriteQueue.flush(profile.id)
         try: del self.onlineUsers[usr.hash]
         except KeyError:
             pass
@@ -471,6 +829,7 @@ class FiveServerConfig:
             if not results:
                 raise Exception('User not found for nonce: %s' % nonce)
             usr = results[0]
+            self.endSession(hash=usr.hash)
             usr.hash = hash
             usr.serial = serial
             usr.username = username
@@ -486,6 +845,7 @@ class FiveServerConfig:
         usr = results[0]
         usr.nonce = ''.join([str(random.randint(1000,10000)) for x in range(4)])
         yield self.userData.store(usr)
+        self.endSession(hash=usr.hash)
         defer.returnValue(usr.nonce)
 
     @defer.inlineCallbacks
@@ -495,6 +855,7 @@ class FiveServerConfig:
             raise Exception('Unknown username: %s' % username)
         usr = results[0]
         yield self.userData.delete(usr)
+        self.endSession(hash=usr.hash)
         log.msg('User "%s" has been DELETED.' % username)
         defer.returnValue(usr)
 
@@ -507,6 +868,9 @@ class FiveServerConfig:
 
     @defer.inlineCallbacks
     def getPlayerProfile(self, profileId):
+        profile = self.profileWriteQueue.get(profileId)
+        if profile is not None:
+            defer.returnValue(profile)
         results = yield self.profileData.get(profileId)
         if not results:
             defer.returnValue(None)
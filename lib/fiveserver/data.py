@@ -3,8 +3,192 @@ Data-layer
 """
 
 from twisted.internet import defer
+from twisted.python import failure
 from datetime import timedelta
-from fiveserver.model import user
+import weakref
+from fiveserver.model import user, lobby
+from fiveserver import log
+
+
+# Streak update, computed by the database itself: one statement
+# for all participants of a match, no need to read current values.
+# Row values are (profile_id, win, win), where win is 1 or 0.
+# Note: "best" must be assigned before "wins", because MySQL
+# applies assignments left to right.
+STREAKS_UPSERT_SQL = (
+    'INSERT INTO streaks (profile_id, wins, best) VALUES (%s,%s,%s) '
+    'ON DUPLICATE KEY UPDATE '
+    'best=GREATEST(best, CASE WHEN VALUES(wins)>0 THEN wins+1 ELSE 0 END), '
+    'wins=CASE WHEN VALUES(wins)>0 THEN wins+1 ELSE 0 END')
+
+RANKS_BATCH_SIZE = 500
+
+# Idempotency of match journal entries (see journal.MatchJournal):
+# the key of an entry is recorded in the same transaction as
+# the match, so that replaying the entry does not store it twice
+JOURNAL_APPLIED_SQL = 'SELECT 1 FROM journal_applied WHERE entry_key=%s'
+JOURNAL_MARK_SQL = 'INSERT INTO journal_applied (entry_key) VALUES (%s)'
+JOURNAL_PRUNE_SQL = 'DELETE FROM journal_applied WHERE applied_on < %s'
+
+# Pool classes (see storagecontroller.PoolClass): every DB call
+# declares which workload it belongs to, so that one workload
+# cannot take all connections from the others
+INTERACTIVE = 'interactive' # logins, profile changes, registration
+MATCHES = 'matches' # match results and stats
+ADMIN = 'admin' # admin pages: browsing, counts, deletes
+BATCH = 'batch' # background jobs, e.g. rank computation
+
+# Stats of a profile. Matches older than a few months are moved
+# to the archive (see tools.archive), and counted in monthly
+# rollups instead: stats are raw matches plus rollups.
+# Args: (profileId,)
+ROLLUPS_SQL = (
+    'SELECT sum(games),sum(wins),sum(losses),sum(draws),'
+    'sum(goals_scored),sum(goals_allowed) FROM match_rollups '
+    'WHERE profile_id=%s')
+# Args: (profileId, profileId)
+MATCH_GAMES_SQL = (
+    'SELECT count(id) FROM matches '
+    'WHERE profile_id_home=%s OR profile_id_away=%s')
+MATCH_WINS_SQL = (
+    'SELECT count(id) FROM matches '
+    'WHERE profile_id_home=%s AND score_home>score_away '
+    'OR profile_id_away=%s AND score_home<score_away')
+MATCH_LOSSES_SQL = (
+    'SELECT count(id) FROM matches '
+    'WHERE profile_id_home=%s AND score_home<score_away '
+    'OR profile_id_away=%s AND score_home>score_away')
+MATCH_DRAWS_SQL = (
+    'SELECT count(id) FROM matches '
+    'WHERE profile_id_home=%s AND score_home=score_away '
+    'OR profile_id_away=%s AND score_home=score_away')
+# Args: (profileId,)
+MATCH_GOALS_HOME_SQL = (
+    'SELECT sum(score_home),sum(score_away) FROM matches '
+    'WHERE profile_id_home=%s')
+MATCH_GOALS_AWAY_SQL = (
+    'SELECT sum(score_away),sum(score_home) FROM matches '
+    'WHERE profile_id_away=%s')
+STREAKS_SQL = (
+    'SELECT wins, best FROM streaks '
+    'WHERE profile_id=%s')
+
+
+# Read-your-writes pins: reads with a pin go to the write servers
+# for a few seconds after a write with the same pin.
+# (see StorageController)
+
+def userPin(userId):
+    return ('user', userId)
+
+def hashPin(hash):
+    if isinstance(hash, bytes):
+        hash = hash.decode('utf-8')
+    return ('hash', hash)
+
+def profilePin(profileId):
+    return ('profile', profileId)
+
+
+def profileRef(profileId):
+    """
+    Return Profile object that only has an id: enough
+    to store a match rebuilt from a journal record
+    """
+    p = user.Profile(0)
+    p.id = profileId
+    return p
+
+def isJournalApplied(transaction, journalKey):
+    if journalKey is None:
+        return False
+    transaction.execute(JOURNAL_APPLIED_SQL, (journalKey,))
+    return len(transaction.fetchall()) > 0
+
+def markJournalApplied(transaction, journalKey):
+    if journalKey is not None:
+        transaction.execute(JOURNAL_MARK_SQL, (journalKey,))
+
+@defer.inlineCallbacks
+def pruneJournalApplied(dbController, before):
+    """
+    Delete keys of journal entries applied before the
+    given time (a datetime), on all shards
+    """
+    before = before.strftime('%Y-%m-%d %H:%M:%S')
+    for controller in dbController.getControllers():
+        yield controller.dbWrite(
+            'journal.prune', JOURNAL_PRUNE_SQL, before, poolClass=BATCH)
+
+def goalsFromRows(rows):
+    """
+    Return (scored, allowed) from result of goals query
+    """
+    scored = rows[0][0] or 0
+    allowed = rows[0][1] or 0
+    return int(scored), int(allowed)
+
+def rollupsFromRows(rows):
+    """
+    Return (games, wins, losses, draws, goals scored,
+    goals allowed) from result of rollups query
+    """
+    return tuple(int(value or 0) for value in rows[0])
+
+@defer.inlineCallbacks
+def readWithRollups(dbController, key, sql, args, profileId):
+    """
+    Read query of a profile together with its rollups,
+    in one batch. Return (rows, rollups)
+    """
+    results = yield dbController.dbReadBatch(key, [
+        (sql, args), (ROLLUPS_SQL, (profileId,))],
+        pin=profilePin(profileId), shard=profileId, poolClass=MATCHES)
+    defer.returnValue((results[0], rollupsFromRows(results[1])))
+
+def streaksFromRows(rows):
+    """
+    Return (current, best) from result of streaks query
+    """
+    if len(rows)>0:
+        return rows[0][0], rows[0][1]
+    return 0, 0
+
+
+@defer.inlineCallbacks
+def readPage(dbController, key, sql, offset, limit, sortKey,
+             poolClass=ADMIN):
+    """
+    Read one page of rows with sql, which ends with
+    "LIMIT %s OFFSET %s". With several shards, each shard
+    returns its first offset+limit rows, and the page is
+    cut from all of them, sorted with sortKey.
+    """
+    if dbController.shardCount == 1:
+        rows = yield dbController.dbRead(
+            key, sql, limit, offset, poolClass=poolClass)
+        defer.returnValue(rows)
+    rows = yield dbController.dbRead(
+        key, sql, offset + limit, 0, poolClass=poolClass)
+    rows = sorted(rows, key=sortKey)
+    defer.returnValue(rows[offset:offset+limit])
+
+
+def makeUpdate(table, columns, getColumnValue, obj, fields):
+    """
+    Build UPDATE statement for changed fields of the object.
+    Return (None, None), if there is nothing to update.
+    """
+    assignments, params = [], []
+    for field, column in columns:
+        if field in fields:
+            assignments.append('%s=%%s' % column)
+            params.append(getColumnValue(obj, field))
+    if not assignments:
+        return None, None
+    sql = 'UPDATE %s SET %s WHERE id=%%s' % (table, ', '.join(assignments))
+    params.append(obj.id)
+    return sql, params
 
 
 class UserData:
@@ -12,140 +196,242 @@ class UserData:
     def __init__(self, dbController):
         self.dbController = dbController
 
+    def _makeUser(self, row):
+        usr = user.User(row[3])
+        usr.id = row[0]
+        usr.username = row[1]
+        usr.serial = row[2]
+        usr.hash = row[3]
+        usr.nonce = row[4]
+        usr.updatedOn = row[5]
+        usr.markClean()
+        return usr
+
     @defer.inlineCallbacks
     def get(self, id):
         sql = ('SELECT id,username,serial,hash,reset_nonce,updated_on '
                'FROM users WHERE deleted = 0 AND id = %s')
-        rows = yield self.dbController.dbRead(0, sql, id)
-        results = []
-        for row in rows:
-            usr = user.User(row[3])
-            usr.id = row[0]
-            usr.username = row[1]
-            usr.serial = row[2]
-            usr.hash = row[3]
-            usr.nonce = row[4]
-            usr.updatedOn = row[5]
-            results.append(usr)
+        rows = yield self.dbController.dbRead(
+            'user.get', sql, id, pin=userPin(id), shard=id,
+            poolClass=INTERACTIVE)
+        results = [self._makeUser(row) for row in rows]
         defer.returnValue(results)
 
     @defer.inlineCallbacks
     def browse(self, offset=0, limit=30):
         sql = ('SELECT count(id) '
                'FROM users WHERE deleted = 0')
-        rows = yield self.dbController.dbRead(0, sql)
-        total = int(rows[0][0])
+        rows = yield self.dbController.dbRead('user.count', sql,
+            poolClass=ADMIN)
+        total = sum(int(row[0]) for row in rows)
         sql = ('SELECT id,username,serial,hash,reset_nonce,updated_on '
                'FROM users WHERE deleted = 0 '
                'ORDER BY username LIMIT %s OFFSET %s')
-        rows = yield self.dbController.dbRead(0, sql, limit, offset)
-        results = []
-        for row in rows:
-            usr = user.User(row[3])
-            usr.id = row[0]
-            usr.username = row[1]
-            usr.serial = row[2]
-            usr.hash = row[3]
-            usr.nonce = row[4]
-            usr.updatedOn = row[5]
-            results.append(usr)
+        rows = yield readPage(self.dbController, 'user.browse',
+            sql, offset, limit, lambda row: row[1], poolClass=ADMIN)
+        results = [self._makeUser(row) for row in rows]
         defer.returnValue((total, results))
 
+    # field -> column
+    columns = [
+        ('username', 'username'),
+        ('serial', 'serial'),
+        ('hash', 'hash'),
+        ('nonce', 'reset_nonce'),
+    ]
+
+    def getColumnValue(self, usr, field):
+        return getattr(usr, field)
+
     @defer.inlineCallbacks
     def store(self, usr):
-        sql = ('INSERT INTO users (id,username,serial,hash,reset_nonce) '
-               'VALUES (%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE '
-               'deleted=0, username=%s, serial=%s, hash=%s, reset_nonce=%s')
-        params = (usr.id, usr.username, usr.serial, usr.hash,
-                  usr.nonce, usr.username, usr.serial, usr.hash,
-                  usr.nonce)
-        yield self.dbController.dbWrite(0, sql, *params)
-        defer.returnValue(True)
+        """
+        Write user to DB. Return the user, with id
+        assigned by DB, if it was a new one.
+        """
+        dirty = usr.getDirtyFields()
+        insert = dirty is None or usr.id is None
+        if insert:
+            sql = ('INSERT INTO users (id,username,serial,hash,reset_nonce) '
+                   'VALUES (%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE '
+                   'deleted=0, username=%s, serial=%s, hash=%s, reset_nonce=%s')
+            params = (usr.id, usr.username, usr.serial, usr.hash,
+                      usr.nonce, usr.username, usr.serial, usr.hash,
+                      usr.nonce)
+        else:
+            sql, params = makeUpdate(
+                'users', self.columns, self.getColumnValue, usr, dirty)
+            if sql is None:
+                defer.returnValue(usr)
+        pin = [hashPin(usr.hash)]
+        if usr.id is not None:
+            pin.append(userPin(usr.id))
+        usr.markClean()
+        try:
+            if insert:
+                rowId = yield self.dbController.dbInsert(
+                    'user.insert', sql, *params, pin=pin, shard=usr.id,
+                    poolClass=INTERACTIVE)
+            else:
+                yield self.dbController.dbWrite(
+                    'user.update', sql, *params, pin=pin, shard=usr.id,
+                    poolClass=INTERACTIVE)
+        except:
+            usr.markDirty(dirty)
+            raise
+        if usr.id is None:
+            usr.id = rowId
+        defer.returnValue(usr)
 
     @defer.inlineCallbacks
     def delete(self, usr):
         sql = 'UPDATE users SET deleted = 1 WHERE id = %s'
         params = (usr.id,)
-        yield self.dbController.dbWrite(0, sql, *params)
+        yield self.dbController.dbWrite(
+            'user.delete', sql, *params,
+            pin=[userPin(usr.id), hashPin(usr.hash)], shard=usr.id,
+            poolClass=ADMIN)
         defer.returnValue(True)
 
     @defer.inlineCallbacks
     def findByUsername(self, username):
         sql = ('SELECT id,username,serial,hash,reset_nonce,updated_on '
                'FROM users WHERE deleted = 0 AND username = %s')
-        rows = yield self.dbController.dbRead(0, sql, username)
-        results = []
-        for row in rows:
-            usr = user.User(row[3])
-            usr.id = row[0]
-            usr.username = row[1]
-            usr.serial = row[2]
-            usr.hash = row[3]
-            usr.nonce = row[4]
-            usr.updatedOn = row[5]
-            results.append(usr)
+        rows = yield self.dbController.dbRead(
+            'user.byUsername', sql, username, primary=True,
+            poolClass=INTERACTIVE)
+        results = [self._makeUser(row) for row in rows]
         defer.returnValue(results)
 
     @defer.inlineCallbacks
     def findByHash(self, hash):
         sql = ('SELECT id,username,serial,hash,reset_nonce,updated_on '
                'FROM users WHERE deleted = 0 AND hash = %s')
-        rows = yield self.dbController.dbRead(0, sql, hash)
+        rows = yield self.dbController.dbRead(
+            'user.byHash', sql, hash, pin=hashPin(hash), poolClass=INTERACTIVE)
+        results = [self._makeUser(row) for row in rows]
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def findByHashWithProfiles(self, hash, profileData):
+        """
+        Load user and all its profiles in one round-trip.
+        Return list of (user, profiles) pairs.
+        """
+        sql = ('SELECT u.id,u.username,u.serial,u.hash,u.reset_nonce,'
+               'u.updated_on,%s '
+               'FROM users u LEFT JOIN profiles p '
+               'ON p.user_id = u.id AND p.deleted = 0 '
+               'WHERE u.deleted = 0 AND u.hash = %%s '
+               'ORDER BY u.id, p.updated_on ASC') % ','.join(
+               'p.%s' % column for column in profileData.selectColumns)
+        rows = yield self.dbController.dbRead(
+            'user.login', sql, hash, pin=hashPin(hash), poolClass=INTERACTIVE)
+        if rows and self.dbController.isPinned(userPin(rows[0][0])):
+            # profiles of this user changed recently: replica may lag
+            rows = yield self.dbController.dbRead(
+                'user.login.primary', sql, hash, primary=True,
+                poolClass=INTERACTIVE)
         results = []
         for row in rows:
-            usr = user.User(row[3])
-            usr.id = row[0]
-            usr.username = row[1]
-            usr.serial = row[2]
-            usr.hash = row[3]
-            usr.nonce = row[4]
-            usr.updatedOn = row[5]
-            results.append(usr)
+            if not results or results[-1][0].id != row[0]:
+                results.append((self._makeUser(row[:6]), []))
+            if row[6] is not None:
+                results[-1][1].append(profileData._makeProfile(row[6:]))
         defer.returnValue(results)
 
     @defer.inlineCallbacks
     def findByNonce(self, nonce):
         sql = ('SELECT id,username,serial,hash,reset_nonce,updated_on '
                'FROM users WHERE deleted = 0 AND reset_nonce = %s')
-        rows = yield self.dbController.dbRead(0, sql, nonce)
-        results = []
-        for row in rows:
-            usr = user.User(row[3])
-            usr.id = row[0]
-            usr.username = row[1]
-            usr.serial = row[2]
-            usr.hash = row[3]
-            usr.nonce = row[4]
-            usr.updatedOn = row[5]
-            results.append(usr)
+        rows = yield self.dbController.dbRead(
+            'user.byNonce', sql, nonce, primary=True, poolClass=INTERACTIVE)
+        results = [self._makeUser(row) for row in rows]
         defer.returnValue(results)
 
 
 class ProfileData:
 
+    # columns, as expected by _makeProfile
+    selectColumns = [
+        'id', 'user_id', 'ordinal', 'name', 'fav_player', 'fav_team',
+        '`rank`', 'points', 'disconnects', 'updated_on', 'seconds_played']
+
     def __init__(self, dbController):
         self.dbController = dbController
+        # profile id -> the one Profile object everybody holds
+        self._identityMap = weakref.WeakValueDictionary()
+        self._loading = dict()
+
+    def _makeProfile(self, row):
+        """
+        Return canonical Profile object for the row. If the profile
+        is already in memory, that object is returned as is: it is
+        at least as fresh as the row.
+        """
+        try: return self._identityMap[row[0]]
+        except KeyError:
+            p = self._newProfile(row)
+            self._identityMap[p.id] = p
+            return p
+
+    def _singleFlight(self, key, load, *args):
+        """
+        Run the load, unless the same one is already in progress:
+        then just wait for its results.
+        """
+        d = defer.Deferred()
+        try: self._loading[key].append(d)
+        except KeyError:
+            self._loading[key] = [d]
+            load(*args).addBoth(self._loaded, key)
+        return d
+
+    def _loaded(self, result, key):
+        for d in self._loading.pop(key):
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(list(result))
 
-    @defer.inlineCallbacks
     def get(self, id):
+        """
+        Return list with the profile, or empty list. Profiles
+        already in memory are returned without going to DB.
+        """
+        try: p = self._identityMap[id]
+        except KeyError:
+            return self._singleFlight(('id', id), self._get, id)
+        return defer.succeed([p])
+
+    def findByName(self, profileName):
+        return self._singleFlight(
+            ('name', profileName), self._findByName, profileName)
+
+    def _newProfile(self, row):
+        p = user.Profile(row[2])
+        p.id = row[0]
+        p.userId = row[1]
+        p.name = row[3]
+        p.favPlayer = row[4]
+        p.favTeam = row[5]
+        p.rank = row[6]
+        p.points = row[7]
+        p.disconnects = row[8]
+        p.updatedOn = row[9]
+        p.playTime = timedelta(seconds=row[10])
+        p.markClean()
+        return p
+
+    @defer.inlineCallbacks
+    def _get(self, id):
         sql = ('SELECT id,user_id,ordinal,name,fav_player,fav_team,`rank`,'
                'points,disconnects,updated_on,seconds_played '
                'FROM profiles WHERE deleted = 0 AND id = %s')
-        rows = yield self.dbController.dbRead(0, sql, id)
-        results = []
-        for row in rows:
-            p = user.Profile(row[2])
-            p.id = row[0]
-            p.userId = row[1]
-            p.name = row[3]
-            p.favPlayer = row[4]
-            p.favTeam = row[5]
-            p.rank = row[6]
-            p.points = row[7]
-            p.disconnects = row[8]
-            p.updatedOn = row[9]
-            p.playTime = timedelta(seconds=row[10])
-            results.append(p)
+        rows = yield self.dbController.dbRead(
+            'profile.get', sql, id, pin=profilePin(id), shard=id,
+            poolClass=INTERACTIVE)
+        results = [self._makeProfile(row) for row in rows]
         defer.returnValue(results)
 
     @defer.inlineCallbacks
@@ -154,28 +440,19 @@ class ProfileData:
                'points,disconnects,updated_on,seconds_played '
                'FROM profiles WHERE deleted = 0 AND user_id = %s '
                'ORDER BY updated_on ASC')
-        rows = yield self.dbController.dbRead(0, sql, userId)
-        results = []
-        for row in rows:
-            p = user.Profile(row[2])
-            p.id = row[0]
-            p.userId = row[1]
-            p.name = row[3]
-            p.favPlayer = row[4]
-            p.favTeam = row[5]
-            p.rank = row[6]
-            p.points = row[7]
-            p.disconnects = row[8]
-            p.updatedOn = row[9]
-            p.playTime = timedelta(seconds=row[10])
-            results.append(p)
+        rows = yield self.dbController.dbRead(
+            'profile.byUserId', sql, userId, pin=userPin(userId), shard=userId,
+            poolClass=INTERACTIVE)
+        results = [self._makeProfile(row) for row in rows]
         defer.returnValue(results)
 
     @defer.inlineCallbacks
     def getSettings(self, profileId):
         sql = ('SELECT settings1, settings2 '
                'FROM settings WHERE profile_id=%s')
-        rows = yield self.dbController.dbRead(0, sql, profileId)
+        rows = yield self.dbController.dbRead(
+            'settings.get', sql, profileId,
+            pin=profilePin(profileId), shard=profileId, poolClass=INTERACTIVE)
         if len(rows)>0:
             settings = user.ProfileSettings(rows[0][0], rows[0][1])
         else:
@@ -188,113 +465,166 @@ class ProfileData:
                'VALUES (%s, %s, %s) '
                'ON DUPLICATE KEY UPDATE settings1=%s, settings2=%s')
         yield self.dbController.dbWrite(
-            0, sql, profileId, settings.settings1, settings.settings2,
-            settings.settings1, settings.settings2)
+            'settings.store', sql, profileId,
+            settings.settings1, settings.settings2,
+            settings.settings1, settings.settings2,
+            pin=profilePin(profileId), shard=profileId, poolClass=INTERACTIVE)
         defer.returnValue(settings)
 
     @defer.inlineCallbacks
     def browse(self, offset=0, limit=30):
         sql = ('SELECT count(id) '
                'FROM profiles WHERE deleted = 0')
-        rows = yield self.dbController.dbRead(0, sql)
-        total = int(rows[0][0])
+        rows = yield self.dbController.dbRead('profile.count', sql,
+            poolClass=ADMIN)
+        total = sum(int(row[0]) for row in rows)
         sql = ('SELECT id,user_id,ordinal,name,fav_player,fav_team,`rank`,'
                'points,disconnects,updated_on,seconds_played '
                'FROM profiles WHERE deleted = 0 '
                'ORDER BY name LIMIT %s OFFSET %s')
-        rows = yield self.dbController.dbRead(0, sql, limit, offset)
-        results = []
-        for row in rows:
-            p = user.Profile(row[2])
-            p.id = row[0]
-            p.userId = row[1]
-            p.name = row[3]
-            p.favPlayer = row[4]
-            p.favTeam = row[5]
-            p.rank = row[6]
-            p.points = row[7]
-            p.disconnects = row[8]
-            p.updatedOn = row[9]
-            p.playTime = timedelta(seconds=row[10])
-            results.append(p)
+        rows = yield readPage(self.dbController, 'profile.browse',
+            sql, offset, limit, lambda row: row[3], poolClass=ADMIN)
+        results = [self._makeProfile(row) for row in rows]
         defer.returnValue((total, results))
 
+    # field -> column
+    columns = [
+        ('userId', 'user_id'),
+        ('index', 'ordinal'),
+        ('name', 'name'),
+        ('favPlayer', 'fav_player'),
+        ('favTeam', 'fav_team'),
+        ('rank', '`rank`'),
+        ('points', 'points'),
+        ('disconnects', 'disconnects'),
+        ('playTime', 'seconds_played'),
+    ]
+
+    def getColumnValue(self, p, field):
+        if field == 'playTime':
+            return int(p.playTime.total_seconds())
+        return getattr(p, field)
+
     @defer.inlineCallbacks
     def store(self, p):
+        """
+        Write profile to DB. Return the profile, with id
+        assigned by DB, if it was a new one.
+        """
+        dirty = p.getDirtyFields()
+        isNew = p.id is None or p.id <= 0
+        insert = dirty is None or isNew
+        if insert:
+            sql, params = self._upsert(p)
+        else:
+            sql, params = makeUpdate(
+                'profiles', self.columns, self.getColumnValue, p, dirty)
+            if sql is None:
+                defer.returnValue(p)
+        pin = [userPin(p.userId)]
+        if not isNew:
+            pin.append(profilePin(p.id))
+        # new profiles go to the shard of their user
+        shard = p.userId if isNew else p.id
+        p.markClean()
+        try:
+            if insert:
+                rowId = yield self.dbController.dbInsert(
+                    'profile.insert', sql, *params, pin=pin, shard=shard,
+                    poolClass=INTERACTIVE)
+            else:
+                yield self.dbController.dbWrite(
+                    'profile.update', sql, *params, pin=pin, shard=shard,
+                    poolClass=INTERACTIVE)
+        except:
+            p.markDirty(dirty)
+            raise
+        if isNew:
+            p.id = rowId
+            self._identityMap[p.id] = p
+        defer.returnValue(p)
+
+    def _upsert(self, p):
         sql = ('INSERT INTO profiles (id,user_id,ordinal,name,fav_player,'
                'fav_team,`rank`,points,disconnects,seconds_played) '
                'VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) ON DUPLICATE KEY UPDATE '
                'deleted=0, user_id=%s, ordinal=%s, name=%s, '
                'fav_player=%s, fav_team=%s, `rank`=%s, '
                'points=%s, disconnects=%s, seconds_played=%s')
-        params = (p.id, p.userId, p.index, p.name, p.favPlayer, p.favTeam,
+        # new profiles (id <= 0) get id from auto-increment
+        params = (p.id if p.id and p.id > 0 else None,
+                  p.userId, p.index, p.name, p.favPlayer, p.favTeam,
                   p.rank, p.points, p.disconnects, int(p.playTime.total_seconds()),
                   p.userId, p.index, p.name, p.favPlayer, p.favTeam, p.rank,
                   p.points, p.disconnects, int(p.playTime.total_seconds()))
-        yield self.dbController.dbWrite(0, sql, *params)
-        defer.returnValue(True)
+        return sql, params
 
     @defer.inlineCallbacks
     def delete(self, p):
         sql = 'UPDATE profiles SET deleted = 1 WHERE id = %s'
         params = (p.id,)
-        yield self.dbController.dbWrite(0, sql, *params)
+        yield self.dbController.dbWrite(
+            'profile.delete', sql, *params,
+            pin=[profilePin(p.id), userPin(p.userId)], shard=p.id,
+            poolClass=ADMIN)
+        self._identityMap.pop(p.id, None)
         defer.returnValue(True)
 
     @defer.inlineCallbacks
-    def findByName(self, profileName):
-        print("findByName:",profileName)
+    def _findByName(self, profileName):
+        log.debug('DEBUG: findByName: %s' % profileName)
         sql = ('SELECT id,user_id,ordinal,name,fav_player,fav_team,'
                '`rank`,points,disconnects,updated_on,seconds_played '
                'FROM profiles WHERE deleted = 0 AND name = %s')
-        rows = yield self.dbController.dbRead(0, sql, profileName)
-        results = []
-        for row in rows:
-            p = user.Profile(row[2])
-            p.id = row[0]
-            p.userId = row[1]
-            p.name = row[3]
-            p.favPlayer = row[4]
-            p.favTeam = row[5]
-            p.rank = row[6]
-            p.points = row[7]
-            p.disconnects = row[8]
-            p.updatedOn = row[9]
-            p.playTime = timedelta(seconds=row[10])
-            results.append(p)
-        print(results)
+        rows = yield self.dbController.dbRead(
+            'profile.byName', sql, profileName, primary=True,
+            poolClass=INTERACTIVE)
+        results = [self._makeProfile(row) for row in rows]
         defer.returnValue(results)
 
+    @defer.inlineCallbacks
+    def getRankingData(self):
+        sql = ('SELECT id, name, points, seconds_played '
+               'FROM profiles WHERE deleted = 0')
+        rows = yield self.dbController.dbRead('profile.rankingData', sql,
+            poolClass=BATCH)
+        defer.returnValue(rows)
+
     @defer.inlineCallbacks
     def computeRanks(self):
-        result = yield self.dbController.dbWriteInteraction(
-            0, self._computeRanksTxn)
+        """
+        Recompute ranks of all profiles. The ordering is read
+        from read servers (of all shards), ranks are written
+        back in batches, to the shard of each profile.
+        """
+        sql = ('SELECT id, points, seconds_played FROM profiles '
+               'ORDER BY points DESC, seconds_played DESC')
+        rows = yield self.dbController.dbRead('profile.rankOrder', sql,
+            poolClass=BATCH)
+        if self.dbController.shardCount > 1:
+            rows = sorted(rows, key=lambda row: (-row[1], -row[2]))
+        ranks = dict()
+        rank, count, last_points = 1, 1, None
+        for (id, points, seconds) in rows:
+            if last_points is not None and last_points > points:
+                # rank is lowered: as many as ranked higher, plus one
+                rank = count
+            ranks[id] = rank
+            last_points = points
+            count += 1
+        result = 0
+        groups = self.dbController.groupByShard(ranks.keys())
+        for ids in groups.values():
+            result += yield self.dbController.dbWriteInteraction(
+                'profile.storeRanks', self._storeRanksTxn,
+                [(ranks[id], id) for id in ids], shard=ids[0], poolClass=BATCH)
         defer.returnValue(result)
 
-    def _computeRanksTxn(self, transaction):
-        rank, count, rank_range = 1, 1, 100
-        last_points = None
-        limit, offset = 50, 0
-        while True:
-            sql = ('SELECT id, points FROM profiles '
-                   'ORDER BY points DESC, seconds_played DESC '
-                   'LIMIT %s OFFSET %s')
-            params = [limit, offset]
-            transaction.execute(sql, params)
-            rows = transaction.fetchall()
-            for (id, points) in rows:
-                if last_points is not None:
-                    # check if rank needs to be lowered
-                    if last_points > points:
-                        rank = count
-                sql = ('UPDATE profiles SET `rank`=%s WHERE id=%s')
-                params = [rank, id]
-                transaction.execute(sql, params)
-                last_points = points
-                count += 1
-            if len(rows) < limit:
-                break
-            offset += limit
+    def _storeRanksTxn(self, transaction, ranks):
+        sql = 'UPDATE profiles SET `rank`=%s WHERE id=%s'
+        for i in range(0, len(ranks), RANKS_BATCH_SIZE):
+            transaction.executemany(sql, ranks[i:i+RANKS_BATCH_SIZE])
+        return len(ranks)
 
 
 class MatchData:
@@ -304,89 +634,154 @@ class MatchData:
 
     @defer.inlineCallbacks
     def getGames(self, profileId):
-        sql = ('SELECT count(id) FROM matches '
-               'WHERE profile_id_home=%s OR profile_id_away=%s')
-        rows = yield self.dbController.dbRead(0, sql, profileId, profileId)
-        defer.returnValue(rows[0][0])
+        rows, rollups = yield readWithRollups(self.dbController,
+            'match.games', MATCH_GAMES_SQL, (profileId, profileId),
+            profileId)
+        defer.returnValue(rows[0][0] + rollups[0])
+
+    @defer.inlineCallbacks
+    def getGamesOfProfiles(self, profileIds):
+        """
+        Return numbers of games of several profiles of one
+        user (hence one shard), read in one batch
+        """
+        ids = [id for id in profileIds if id]
+        if not ids:
+            defer.returnValue([0 for id in profileIds])
+        queries = []
+        for id in ids:
+            queries.append((MATCH_GAMES_SQL, (id, id)))
+            queries.append((ROLLUPS_SQL, (id,)))
+        results = yield self.dbController.dbReadBatch(
+            'match.gamesOfProfiles', queries,
+            pin=[profilePin(id) for id in ids], shard=ids[0],
+            poolClass=MATCHES)
+        games = dict(zip(ids, [
+            rows[0][0] + rollupsFromRows(rollups)[0] for rows, rollups
+            in zip(results[0::2], results[1::2])]))
+        defer.returnValue([games.get(id, 0) for id in profileIds])
 
     @defer.inlineCallbacks
     def getWins(self, profileId):
-        sql = ('SELECT count(id) FROM matches '
-               'WHERE profile_id_home=%s AND score_home>score_away '
-               'OR profile_id_away=%s AND score_home<score_away')
-        rows = yield self.dbController.dbRead(0, sql, profileId, profileId)
-        defer.returnValue(rows[0][0])
+        rows, rollups = yield readWithRollups(self.dbController,
+            'match.wins', MATCH_WINS_SQL, (profileId, profileId),
+            profileId)
+        defer.returnValue(rows[0][0] + rollups[1])
 
     @defer.inlineCallbacks
     def getLosses(self, profileId):
-        sql = ('SELECT count(id) FROM matches '
-               'WHERE profile_id_home=%s AND score_home<score_away '
-               'OR profile_id_away=%s AND score_home>score_away')
-        rows = yield self.dbController.dbRead(0, sql, profileId, profileId)
-        defer.returnValue(rows[0][0])
+        rows, rollups = yield readWithRollups(self.dbController,
+            'match.losses', MATCH_LOSSES_SQL, (profileId, profileId),
+            profileId)
+        defer.returnValue(rows[0][0] + rollups[2])
 
     @defer.inlineCallbacks
     def getDraws(self, profileId):
-        sql = ('SELECT count(id) FROM matches '
-               'WHERE profile_id_home=%s AND score_home=score_away '
-               'OR profile_id_away=%s AND score_home=score_away')
-        rows = yield self.dbController.dbRead(0, sql, profileId, profileId)
-        defer.returnValue(rows[0][0])
+        rows, rollups = yield readWithRollups(self.dbController,
+            'match.draws', MATCH_DRAWS_SQL, (profileId, profileId),
+            profileId)
+        defer.returnValue(rows[0][0] + rollups[3])
+
+    # Goals at home/away: rollups do not keep them apart,
+    # so these two count matches not archived yet only
 
     @defer.inlineCallbacks
     def getGoalsHome(self, profileId):
-        sql = ('SELECT sum(score_home),sum(score_away) FROM matches '
-               'WHERE profile_id_home=%s')
-        rows = yield self.dbController.dbRead(0, sql, profileId)
-        scored = rows[0][0] or 0
-        allowed = rows[0][1] or 0
-        defer.returnValue((int(scored), int(allowed)))
+        rows = yield self.dbController.dbRead(
+            'match.goalsHome', MATCH_GOALS_HOME_SQL, profileId,
+            pin=profilePin(profileId), shard=profileId, poolClass=MATCHES)
+        defer.returnValue(goalsFromRows(rows))
 
     @defer.inlineCallbacks
     def getGoalsAway(self, profileId):
-        sql = ('SELECT sum(score_away),sum(score_home) FROM matches '
-               'WHERE profile_id_away=%s')
-        rows = yield self.dbController.dbRead(0, sql, profileId)
-        scored = rows[0][0] or 0
-        allowed = rows[0][1] or 0
-        defer.returnValue((int(scored), int(allowed)))
+        rows = yield self.dbController.dbRead(
+            'match.goalsAway', MATCH_GOALS_AWAY_SQL, profileId,
+            pin=profilePin(profileId), shard=profileId, poolClass=MATCHES)
+        defer.returnValue(goalsFromRows(rows))
 
     @defer.inlineCallbacks
     def getStreaks(self, profileId):
-        sql = ('SELECT wins, best FROM streaks '
-               'WHERE profile_id=%s')
-        rows = yield self.dbController.dbRead(0, sql, profileId)
-        wins, best = 0, 0
-        if len(rows)>0:
-            wins, best = rows[0][0], rows[0][1]
-        defer.returnValue((wins, best))
+        rows = yield self.dbController.dbRead(
+            'match.streaks', STREAKS_SQL, profileId,
+            pin=profilePin(profileId), shard=profileId, poolClass=MATCHES)
+        defer.returnValue(streaksFromRows(rows))
+
+    def getStatsQueries(self, profileId, numLastTeams=None):
+        """
+        Return list of (sql, args) that getStats reads
+        """
+        args = (profileId, profileId)
+        return [
+            (MATCH_WINS_SQL, args),
+            (MATCH_LOSSES_SQL, args),
+            (MATCH_DRAWS_SQL, args),
+            (MATCH_GOALS_HOME_SQL, (profileId,)),
+            (MATCH_GOALS_AWAY_SQL, (profileId,)),
+            (STREAKS_SQL, (profileId,)),
+            (ROLLUPS_SQL, (profileId,))]
 
     @defer.inlineCallbacks
-    def store(self, match):
-        matchId = yield self.dbController.dbWriteInteraction(
-            0, self._storeTxn, match)
-        defer.returnValue(matchId)
-
-    def _storeTxn(self, transaction, match):
-        def _writeStreak(profile_id, win):
-            wins, best = 0, 0
-            sql = ('SELECT wins, best FROM streaks '
-                   'WHERE profile_id=%s')
-            transaction.execute(sql, (profile_id,))
-            data = transaction.fetchall()
-            if len(data)>0:
-                wins, best = data[0][0], data[0][1]
-            if win:
-                wins += 1
-                best = max(wins, best)
-            else:
-                wins = 0
-            sql = ('INSERT INTO streaks (profile_id, wins, best) '
-                   'VALUES (%s,%s,%s) ON DUPLICATE KEY UPDATE '
-                   'wins=%s, best=%s')
-            transaction.execute(sql, (
-                profile_id, wins, best, wins, best))
+    def getStats(self, profileId, numLastTeams=None):
+        """
+        Read all stats of a profile in one batch. Return tuple:
+        (wins, losses, draws, goals scored, goals allowed,
+        current streak, best streak, last teams). Last teams
+        are not recorded by PES5 matches: always None.
+        """
+        results = yield self.dbController.dbReadBatch('match.stats',
+            self.getStatsQueries(profileId, numLastTeams),
+            pin=profilePin(profileId), shard=profileId, poolClass=MATCHES)
+        wins, losses, draws = [rows[0][0] for rows in results[:3]]
+        scoredHome, allowedHome = goalsFromRows(results[3])
+        scoredAway, allowedAway = goalsFromRows(results[4])
+        current, best = streaksFromRows(results[5])
+        (games, rolledWins, rolledLosses, rolledDraws,
+         rolledScored, rolledAllowed) = rollupsFromRows(results[6])
+        defer.returnValue((wins + rolledWins, losses + rolledLosses,
+            draws + rolledDraws,
+            scoredHome + scoredAway + rolledScored,
+            allowedHome + allowedAway + rolledAllowed,
+            current, best, None))
+
+    def toRecord(self, match):
+        """
+        Return match as plain dict, for the match journal
+        """
+        return {'home': [match.home_profile.id],
+                'away': [match.away_profile.id],
+                'score': [match.score_home, match.score_away],
+                'teams': [match.home_team_id, match.away_team_id]}
+
+    def fromRecord(self, record):
+        match = lobby.Match()
+        match.home_profile = profileRef(record['home'][0])
+        match.away_profile = profileRef(record['away'][0])
+        match.score_home, match.score_away = record['score']
+        match.home_team_id, match.away_team_id = record['teams']
+        return match
 
+    @defer.inlineCallbacks
+    def store(self, match, journalKey=None):
+        """
+        Write match to the shard of each participant: both get
+        the match row, and their own streaks. Return the match
+        id from the shard of the home player. With journalKey,
+        a match already stored with that key is not stored
+        again (and its id is None).
+        """
+        profileIds = [match.home_profile.id, match.away_profile.id]
+        matchIds = []
+        for ids in self.dbController.groupByShard(profileIds).values():
+            matchIds.append((yield self.dbController.dbWriteInteraction(
+                'match.store', self._storeTxn, match, ids, journalKey,
+                pin=[profilePin(id) for id in ids], shard=ids[0],
+                poolClass=MATCHES)))
+        defer.returnValue(matchIds[0])
+
+    def _storeTxn(self, transaction, match, profileIds=None,
+                  journalKey=None):
+        if isJournalApplied(transaction, journalKey):
+            return None
         # record match result
         sql = ('INSERT INTO matches (profile_id_home, profile_id_away, '
                'score_home, score_away, team_id_home, team_id_away) '
@@ -395,20 +790,15 @@ class MatchData:
             match.home_profile.id, match.away_profile.id,
             match.score_home, match.score_away, 
             match.home_team_id, match.away_team_id))
-        transaction.execute('SELECT LAST_INSERT_ID()')
-        matchId = transaction.fetchall()[0][0]
+        matchId = transaction.lastrowid
         # update winning streaks
-        if match.score_home > match.score_away:
-            # home win
-            _writeStreak(match.home_profile.id, True)
-            _writeStreak(match.away_profile.id, False)
-        elif match.score_home < match.score_away:
-            # away win
-            _writeStreak(match.home_profile.id, False)
-            _writeStreak(match.away_profile.id, True)
-        else:
-            # draw
-            _writeStreak(match.home_profile.id, False)
-            _writeStreak(match.away_profile.id, False)
+        home_win = int(match.score_home > match.score_away)
+        away_win = int(match.score_home < match.score_away)
+        transaction.executemany(STREAKS_UPSERT_SQL, [
+            (id, win, win) for id, win in [
+                (match.home_profile.id, home_win),
+                (match.away_profile.id, away_win)]
+            if profileIds is None or id in profileIds])
+        markJournalApplied(transaction, journalKey)
         return matchId
 
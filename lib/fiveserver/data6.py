@@ -4,10 +4,61 @@ Data-layer for PES6
 
 from twisted.internet import defer
 from datetime import timedelta
-from fiveserver.model import user
+from fiveserver.model import user, lobby
 from fiveserver import data
 
 
+# Stats of a profile: raw matches plus rollups of archived
+# ones (see data.ROLLUPS_SQL). Args: (profileId,)
+MATCH_GAMES_SQL = (
+    'SELECT count(id) FROM matches_played '
+    'WHERE profile_id=%s')
+MATCH_WINS_SQL = (
+    'SELECT count(matches.id) FROM matches, matches_played '
+    'WHERE matches.id=matches_played.match_id AND profile_id=%s '
+    'AND ((home=1 and score_home>score_away) OR '
+    '(home=0 and score_home<score_away))')
+MATCH_LOSSES_SQL = (
+    'SELECT count(matches.id) FROM matches, matches_played '
+    'WHERE matches.id=matches_played.match_id AND profile_id=%s '
+    'AND ((home=1 and score_home<score_away) OR '
+    '(home=0 and score_home>score_away))')
+MATCH_DRAWS_SQL = (
+    'SELECT count(matches.id) FROM matches, matches_played '
+    'WHERE matches.id=matches_played.match_id AND profile_id=%s '
+    'AND score_home=score_away')
+MATCH_GOALS_HOME_SQL = (
+    'SELECT sum(score_home),sum(score_away) '
+    'FROM matches, matches_played '
+    'WHERE matches.id=matches_played.match_id '
+    'AND profile_id=%s AND home=1')
+MATCH_GOALS_AWAY_SQL = (
+    'SELECT sum(score_away),sum(score_home) '
+    'FROM matches, matches_played '
+    'WHERE matches.id=matches_played.match_id '
+    'AND profile_id=%s AND home=0')
+# Args: (profileId, numMatches)
+LAST_TEAMS_SQL = (
+    'SELECT match_id, team_id_home, team_id_away, home '
+    'FROM matches_played, matches '
+    'WHERE profile_id=%s AND matches.id=match_id '
+    'ORDER BY match_id DESC LIMIT %s')
+
+
+def lastTeamsFromRows(rows):
+    """
+    Return ids of teams used, from result of last teams query
+    """
+    teams = []
+    for row in rows:
+        match_id, team_id_home, team_id_away, home = row
+        if home:
+            teams.append(team_id_home)
+        else:
+            teams.append(team_id_away)
+    return teams
+
+
 class UserData(data.UserData):
     """
     Same as PES5 UserData
@@ -19,32 +70,37 @@ class ProfileData(data.ProfileData):
     of new fields: rating, comment
     """
 
-    def __init__(self, dbController):
-        self.dbController = dbController
+    # columns, as expected by _makeProfile
+    selectColumns = [
+        'id', 'user_id', 'ordinal', 'name', '`rank`', 'rating', 'points',
+        'disconnects', 'updated_on', 'seconds_played', 'comment']
+
+    def _newProfile(self, row):
+        (id, userId, ordinal, name, rank, rating, 
+         points, disconnects, updatedOn, secondsPlayed, comment) = row
+        p = user.Profile(ordinal)
+        p.id = id
+        p.userId = userId
+        p.name = name
+        p.rank = rank
+        p.rating = rating
+        p.points = points
+        p.disconnects = disconnects
+        p.updatedOn = updatedOn
+        p.playTime = timedelta(seconds=secondsPlayed)
+        p.comment = comment
+        p.markClean()
+        return p
 
     @defer.inlineCallbacks
-    def get(self, id):
+    def _get(self, id):
         sql = ('SELECT id,user_id,ordinal,name,`rank`,'
                'rating,points,disconnects,updated_on,seconds_played,comment '
                'FROM profiles WHERE deleted = 0 AND id = %s')
-        rows = yield self.dbController.dbRead(0, sql, id)
-        results = []
-        for row in rows:
-            (id, userId, ordinal, name, rank, rating, 
-             points, disconnects, updatedOn, secondsPlayed, comment) = row
-            playTime = timedelta(seconds=secondsPlayed)
-            p = user.Profile(ordinal)
-            p.id = id
-            p.userId = userId
-            p.name = name
-            p.rank = rank
-            p.rating = rating
-            p.points = points
-            p.disconnects = disconnects
-            p.updatedOn = updatedOn
-            p.playTime = playTime
-            p.comment = comment
-            results.append(p)
+        rows = yield self.dbController.dbRead(
+            'profile.get', sql, id, pin=data.profilePin(id), shard=id,
+            poolClass=data.INTERACTIVE)
+        results = [self._makeProfile(row) for row in rows]
         defer.returnValue(results)
 
     @defer.inlineCallbacks
@@ -53,58 +109,42 @@ class ProfileData(data.ProfileData):
                'rating,points,disconnects,updated_on,seconds_played,comment '
                'FROM profiles WHERE deleted = 0 AND user_id = %s '
                'ORDER BY updated_on ASC')
-        rows = yield self.dbController.dbRead(0, sql, userId)
-        results = []
-        for row in rows:
-            (id, userId, ordinal, name, rank, rating, 
-             points, disconnects, updatedOn, secondsPlayed, comment) = row
-            playTime = timedelta(seconds=secondsPlayed)
-            p = user.Profile(ordinal)
-            p.id = id
-            p.userId = userId
-            p.name = name
-            p.rank = rank
-            p.rating = rating
-            p.points = points
-            p.disconnects = disconnects
-            p.updatedOn = updatedOn
-            p.playTime = playTime
-            p.comment = comment
-            results.append(p)
+        rows = yield self.dbController.dbRead(
+            'profile.byUserId', sql, userId,
+            pin=data.userPin(userId), shard=userId, poolClass=data.INTERACTIVE)
+        results = [self._makeProfile(row) for row in rows]
         defer.returnValue(results)
 
     @defer.inlineCallbacks
     def browse(self, offset=0, limit=30):
         sql = ('SELECT count(id) '
                'FROM profiles WHERE deleted = 0')
-        rows = yield self.dbController.dbRead(0, sql)
-        total = int(rows[0][0])
+        rows = yield self.dbController.dbRead('profile.count', sql,
+            poolClass=data.ADMIN)
+        total = sum(int(row[0]) for row in rows)
         sql = ('SELECT id,user_id,ordinal,name,`rank`,'
                'rating,points,disconnects,updated_on,seconds_played,comment '
                'FROM profiles WHERE deleted = 0 '
                'ORDER BY name LIMIT %s OFFSET %s')
-        rows = yield self.dbController.dbRead(0, sql, limit, offset)
-        results = []
-        for row in rows:
-            (id, userId, ordinal, name, rank, rating, 
-             points, disconnects, updatedOn, secondsPlayed, comment) = row
-            playTime = timedelta(seconds=secondsPlayed)
-            p = user.Profile(ordinal)
-            p.id = id
-            p.userId = userId
-            p.name = name
-            p.rank = rank
-            p.rating = rating
-            p.points = points
-            p.disconnects = disconnects
-            p.updatedOn = updatedOn
-            p.playTime = playTime
-            p.comment = comment
-            results.append(p)
+        rows = yield data.readPage(self.dbController, 'profile.browse',
+            sql, offset, limit, lambda row: row[3], poolClass=data.ADMIN)
+        results = [self._makeProfile(row) for row in rows]
         defer.returnValue((total, results))
 
-    @defer.inlineCallbacks
-    def store(self, p):
+    # field -> column
+    columns = [
+        ('userId', 'user_id'),
+        ('index', 'ordinal'),
+        ('name', 'name'),
+        ('rank', '`rank`'),
+        ('rating', 'rating'),
+        ('points', 'points'),
+        ('disconnects', 'disconnects'),
+        ('playTime', 'seconds_played'),
+        ('comment', 'comment'),
+    ]
+
+    def _upsert(self, p):
         sql = ('INSERT INTO profiles (id,user_id,ordinal,name,'
                '`rank`,rating,points,disconnects,seconds_played,comment) '
                'VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) '
@@ -112,38 +152,25 @@ class ProfileData(data.ProfileData):
                'deleted=0, user_id=%s, ordinal=%s, name=%s, '
                '`rank`=%s, rating=%s, points=%s, '
                'disconnects=%s, seconds_played=%s, comment=%s')
-        params = (p.id, p.userId, p.index, p.name, 
-                  p.rank, p.rating, p.points, p.disconnects, int(p.playTime.total_seconds()),
+        # new profiles (id <= 0) get id from auto-increment
+        params = (p.id if p.id and p.id > 0 else None,
+                  p.userId, p.index, p.name, p.rank, p.rating, p.points,
+                  p.disconnects, int(p.playTime.total_seconds()),
                   p.comment, p.userId, p.index, p.name, p.rank,
                   p.rating, p.points, p.disconnects, int(p.playTime.total_seconds()),
                   p.comment)
-        yield self.dbController.dbWrite(0, sql, *params)
-        defer.returnValue(True)
+        return sql, params
 
     @defer.inlineCallbacks
-    def findByName(self, profileName):
+    def _findByName(self, profileName):
         sql = ('SELECT id,user_id,ordinal,name, '
                '`rank`,rating,points,disconnects,updated_on,'
                'seconds_played,comment '
                'FROM profiles WHERE deleted = 0 AND name = %s')
-        rows = yield self.dbController.dbRead(0, sql, profileName)
-        results = []
-        for row in rows:
-            (id, userId, ordinal, name, rank, rating, 
-             points, disconnects, updatedOn, secondsPlayed, comment) = row
-            playTime = timedelta(seconds=secondsPlayed)
-            p = user.Profile(ordinal)
-            p.id = id
-            p.userId = userId
-            p.name = name
-            p.rank = rank
-            p.rating = rating
-            p.points = points
-            p.disconnects = disconnects
-            p.updatedOn = updatedOn
-            p.playTime = playTime
-            p.comment = comment
-            results.append(p)
+        rows = yield self.dbController.dbRead(
+            'profile.byName', sql, profileName, primary=True,
+            poolClass=data.INTERACTIVE)
+        results = [self._makeProfile(row) for row in rows]
         defer.returnValue(results)
 
 
@@ -154,112 +181,174 @@ class MatchData:
 
     @defer.inlineCallbacks
     def getGames(self, profileId):
-        sql = ('SELECT count(id) FROM matches_played '
-               'WHERE profile_id=%s')
-        rows = yield self.dbController.dbRead(0, sql, profileId)
-        defer.returnValue(rows[0][0])
+        rows, rollups = yield data.readWithRollups(self.dbController,
+            'match.games', MATCH_GAMES_SQL, (profileId,), profileId)
+        defer.returnValue(rows[0][0] + rollups[0])
+
+    @defer.inlineCallbacks
+    def getGamesOfProfiles(self, profileIds):
+        """
+        Return numbers of games of several profiles of one
+        user (hence one shard), read in one batch
+        """
+        ids = [id for id in profileIds if id]
+        if not ids:
+            defer.returnValue([0 for id in profileIds])
+        queries = []
+        for id in ids:
+            queries.append((MATCH_GAMES_SQL, (id,)))
+            queries.append((data.ROLLUPS_SQL, (id,)))
+        results = yield self.dbController.dbReadBatch(
+            'match.gamesOfProfiles', queries,
+            pin=[data.profilePin(id) for id in ids], shard=ids[0],
+            poolClass=data.MATCHES)
+        games = dict(zip(ids, [
+            rows[0][0] + data.rollupsFromRows(rollups)[0]
+            for rows, rollups in zip(results[0::2], results[1::2])]))
+        defer.returnValue([games.get(id, 0) for id in profileIds])
 
     @defer.inlineCallbacks
     def getWins(self, profileId):
-        sql = ('SELECT count(matches.id) FROM matches, matches_played '
-               'WHERE matches.id=matches_played.match_id AND profile_id=%s '
-               'AND ((home=1 and score_home>score_away) OR '
-               '(home=0 and score_home<score_away))')
-        rows = yield self.dbController.dbRead(0, sql, profileId)
-        defer.returnValue(rows[0][0])
+        rows, rollups = yield data.readWithRollups(self.dbController,
+            'match.wins', MATCH_WINS_SQL, (profileId,), profileId)
+        defer.returnValue(rows[0][0] + rollups[1])
 
     @defer.inlineCallbacks
     def getLosses(self, profileId):
-        sql = ('SELECT count(matches.id) FROM matches, matches_played '
-               'WHERE matches.id=matches_played.match_id AND profile_id=%s '
-               'AND ((home=1 and score_home<score_away) OR '
-               '(home=0 and score_home>score_away))')
-        rows = yield self.dbController.dbRead(0, sql, profileId)
-        defer.returnValue(rows[0][0])
+        rows, rollups = yield data.readWithRollups(self.dbController,
+            'match.losses', MATCH_LOSSES_SQL, (profileId,), profileId)
+        defer.returnValue(rows[0][0] + rollups[2])
 
     @defer.inlineCallbacks
     def getDraws(self, profileId):
-        sql = ('SELECT count(matches.id) FROM matches, matches_played '
-               'WHERE matches.id=matches_played.match_id AND profile_id=%s '
-               'AND score_home=score_away')
-        rows = yield self.dbController.dbRead(0, sql, profileId)
-        defer.returnValue(rows[0][0])
+        rows, rollups = yield data.readWithRollups(self.dbController,
+            'match.draws', MATCH_DRAWS_SQL, (profileId,), profileId)
+        defer.returnValue(rows[0][0] + rollups[3])
+
+    # Goals at home/away: rollups do not keep them apart,
+    # so these two count matches not archived yet only
 
     @defer.inlineCallbacks
     def getGoalsHome(self, profileId):
-        sql = ('SELECT sum(score_home),sum(score_away) '
-               'FROM matches, matches_played '
-               'WHERE matches.id=matches_played.match_id '
-               'AND profile_id=%s AND home=1')
-        rows = yield self.dbController.dbRead(0, sql, profileId)
-        scored = rows[0][0] or 0
-        allowed = rows[0][1] or 0
-        defer.returnValue((int(scored), int(allowed)))
+        rows = yield self.dbController.dbRead(
+            'match.goalsHome', MATCH_GOALS_HOME_SQL, profileId,
+            pin=data.profilePin(profileId), shard=profileId,
+            poolClass=data.MATCHES)
+        defer.returnValue(data.goalsFromRows(rows))
 
     @defer.inlineCallbacks
     def getGoalsAway(self, profileId):
-        sql = ('SELECT sum(score_away),sum(score_home) '
-               'FROM matches, matches_played '
-               'WHERE matches.id=matches_played.match_id '
-               'AND profile_id=%s AND home=0')
-        rows = yield self.dbController.dbRead(0, sql, profileId)
-        scored = rows[0][0] or 0
-        allowed = rows[0][1] or 0
-        defer.returnValue((int(scored), int(allowed)))
+        rows = yield self.dbController.dbRead(
+            'match.goalsAway', MATCH_GOALS_AWAY_SQL, profileId,
+            pin=data.profilePin(profileId), shard=profileId,
+            poolClass=data.MATCHES)
+        defer.returnValue(data.goalsFromRows(rows))
 
     @defer.inlineCallbacks
     def getStreaks(self, profileId):
-        sql = ('SELECT wins, best FROM streaks '
-               'WHERE profile_id=%s')
-        rows = yield self.dbController.dbRead(0, sql, profileId)
-        wins, best = 0, 0
-        if len(rows)>0:
-            wins, best = rows[0][0], rows[0][1]
-        defer.returnValue((wins, best))
+        rows = yield self.dbController.dbRead(
+            'match.streaks', data.STREAKS_SQL, profileId,
+            pin=data.profilePin(profileId), shard=profileId,
+            poolClass=data.MATCHES)
+        defer.returnValue(data.streaksFromRows(rows))
 
     @defer.inlineCallbacks
     def getLastTeamsUsed(self, profileId, numMatches):
-        sql = ('SELECT match_id, team_id_home, team_id_away, home '
-               'FROM matches_played, matches '
-               'WHERE profile_id=%s AND matches.id=match_id '
-               'ORDER BY match_id DESC LIMIT %s')
         args = (profileId, numMatches,)
-        rows = yield self.dbController.dbRead(0, sql, *args)
-        teams = []
-        for row in rows:
-            match_id, team_id_home, team_id_away, home = row
-            if home:
-                teams.append(team_id_home)
-            else:
-                teams.append(team_id_away)
-        defer.returnValue(teams)
+        rows = yield self.dbController.dbRead(
+            'match.lastTeams', LAST_TEAMS_SQL, *args,
+            pin=data.profilePin(profileId), shard=profileId,
+            poolClass=data.MATCHES)
+        defer.returnValue(lastTeamsFromRows(rows))
+
+    def getStatsQueries(self, profileId, numLastTeams):
+        """
+        Return list of (sql, args) that getStats reads
+        """
+        args = (profileId,)
+        return [
+            (MATCH_WINS_SQL, args),
+            (MATCH_LOSSES_SQL, args),
+            (MATCH_DRAWS_SQL, args),
+            (MATCH_GOALS_HOME_SQL, args),
+            (MATCH_GOALS_AWAY_SQL, args),
+            (data.STREAKS_SQL, args),
+            (data.ROLLUPS_SQL, args),
+            (LAST_TEAMS_SQL, (profileId, numLastTeams))]
 
     @defer.inlineCallbacks
-    def store(self, match):
-        matchId = yield self.dbController.dbWriteInteraction(
-            0, self._storeTxn, match)
-        defer.returnValue(matchId)
-
-    def _storeTxn(self, transaction, match):
-        def _writeStreak(profile_id, win):
-            wins, best = 0, 0
-            sql = ('SELECT wins, best FROM streaks '
-                   'WHERE profile_id=%s')
-            transaction.execute(sql, (profile_id,))
-            data = transaction.fetchall()
-            if len(data)>0:
-                wins, best = data[0][0], data[0][1]
-            if win:
-                wins += 1
-                best = max(wins, best)
-            else:
-                wins = 0
-            sql = ('INSERT INTO streaks (profile_id, wins, best) '
-                   'VALUES (%s,%s,%s) ON DUPLICATE KEY UPDATE '
-                   'wins=%s, best=%s')
-            transaction.execute(sql, (
-                profile_id, wins, best, wins, best))
+    def getStats(self, profileId, numLastTeams):
+        """
+        Read all stats of a profile in one batch. Return tuple:
+        (wins, losses, draws, goals scored, goals allowed,
+        current streak, best streak, last teams used). Last
+        teams come from matches not archived yet.
+        """
+        results = yield self.dbController.dbReadBatch('match.stats',
+            self.getStatsQueries(profileId, numLastTeams),
+            pin=data.profilePin(profileId), shard=profileId,
+            poolClass=data.MATCHES)
+        wins, losses, draws = [rows[0][0] for rows in results[:3]]
+        scoredHome, allowedHome = data.goalsFromRows(results[3])
+        scoredAway, allowedAway = data.goalsFromRows(results[4])
+        current, best = data.streaksFromRows(results[5])
+        (games, rolledWins, rolledLosses, rolledDraws,
+         rolledScored, rolledAllowed) = data.rollupsFromRows(results[6])
+        defer.returnValue((wins + rolledWins, losses + rolledLosses,
+            draws + rolledDraws,
+            scoredHome + scoredAway + rolledScored,
+            allowedHome + allowedAway + rolledAllowed,
+            current, best, lastTeamsFromRows(results[7])))
 
+    def toRecord(self, match):
+        """
+        Return match as plain dict, for the match journal
+        """
+        ts = match.teamSelection
+        return {'home': [profile.id for profile in
+                    [ts.home_captain] + list(ts.home_more_players)],
+                'away': [profile.id for profile in
+                    [ts.away_captain] + list(ts.away_more_players)],
+                'score': [match.score_home, match.score_away],
+                'teams': [ts.home_team_id, ts.away_team_id]}
+
+    def fromRecord(self, record):
+        ts = lobby.TeamSelection()
+        home = [data.profileRef(id) for id in record['home']]
+        away = [data.profileRef(id) for id in record['away']]
+        ts.home_captain, ts.home_more_players = home[0], home[1:]
+        ts.away_captain, ts.away_more_players = away[0], away[1:]
+        ts.home_team_id, ts.away_team_id = record['teams']
+        match = lobby.Match6(ts)
+        match.score_home_1st, match.score_away_1st = record['score']
+        return match
+
+    @defer.inlineCallbacks
+    def store(self, match, journalKey=None):
+        """
+        Write match to the shard of each participant: every shard
+        gets the match with all its players, and streaks of its
+        own players. Return the match id from the shard of the
+        home captain. With journalKey, a match already stored
+        with that key is not stored again (and its id is None).
+        """
+        teamSelection = match.teamSelection
+        players = [teamSelection.home_captain, teamSelection.away_captain]
+        players.extend(teamSelection.home_more_players)
+        players.extend(teamSelection.away_more_players)
+        profileIds = [profile.id for profile in players]
+        matchIds = []
+        for ids in self.dbController.groupByShard(profileIds).values():
+            matchIds.append((yield self.dbController.dbWriteInteraction(
+                'match.store', self._storeTxn, match, ids, journalKey,
+                pin=[data.profilePin(id) for id in ids], shard=ids[0],
+                poolClass=data.MATCHES)))
+        defer.returnValue(matchIds[0])
+
+    def _storeTxn(self, transaction, match, profileIds=None,
+                  journalKey=None):
+        if data.isJournalApplied(transaction, journalKey):
+            return None
         # record match result
         sql = ('INSERT INTO matches '
                '(score_home, score_away, team_id_home, team_id_away) '
@@ -267,39 +356,25 @@ class MatchData:
         transaction.execute(sql, ( 
             match.score_home, match.score_away, 
             match.teamSelection.home_team_id, match.teamSelection.away_team_id))
-        transaction.execute('SELECT LAST_INSERT_ID()')
-        matchId = transaction.fetchall()[0][0]
+        matchId = transaction.lastrowid
         # record players of the match
         home_players = [match.teamSelection.home_captain]
         home_players.extend(match.teamSelection.home_more_players)
         away_players = [match.teamSelection.away_captain]
         away_players.extend(match.teamSelection.away_more_players)
-        for profile in home_players:
-            sql = ('INSERT INTO matches_played (match_id, profile_id, home) '
-                   'VALUES (%s, %s, 1)')
-            transaction.execute(sql, (matchId, profile.id))
-        for profile in away_players:
-            sql = ('INSERT INTO matches_played (match_id, profile_id, home) '
-                   'VALUES (%s, %s, 0)')
-            transaction.execute(sql, (matchId, profile.id))
+        sql = ('INSERT INTO matches_played (match_id, profile_id, home) '
+               'VALUES (%s, %s, %s)')
+        transaction.executemany(sql,
+            [(matchId, profile.id, 1) for profile in home_players] +
+            [(matchId, profile.id, 0) for profile in away_players])
         # update winning streaks
-        if match.score_home > match.score_away:
-            # home win
-            for profile in home_players:
-                _writeStreak(profile.id, True)
-            for profile in away_players:
-                _writeStreak(profile.id, False)
-        elif match.score_home < match.score_away:
-            # away win
-            for profile in home_players:
-                _writeStreak(profile.id, False)
-            for profile in away_players:
-                _writeStreak(profile.id, True)
-        else:
-            # draw
-            for profile in home_players:
-                _writeStreak(profile.id, False)
-            for profile in away_players:
-                _writeStreak(profile.id, False)
+        home_win = int(match.score_home > match.score_away)
+        away_win = int(match.score_home < match.score_away)
+        transaction.executemany(data.STREAKS_UPSERT_SQL, [
+            (profile.id, win, win) for profile, win in
+            [(profile, home_win) for profile in home_players] +
+            [(profile, away_win) for profile in away_players]
+            if profileIds is None or profile.id in profileIds])
+        data.markJournalApplied(transaction, journalKey)
         return matchId
 
@@ -0,0 +1,115 @@
+"""
+Per-query statistics of the DB layer
+"""
+
+from collections import deque
+from time import time
+
+from fiveserver import log
+
+
+# upper bounds of latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+SLOW_QUERY_SECONDS = 0.5
+SLOW_QUERY_LOG_SIZE = 100
+SLOW_QUERY_MAX_SQL = 500 # characters of sql kept in slow-query log
+
+
+class QueryStat:
+    """
+    Numbers of one query label: calls, errors, time
+    and latency histogram
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.count = 0
+        self.errors = 0
+        self.totalTime = 0.0
+        self.maxTime = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, elapsed, error=False):
+        self.count += 1
+        if error:
+            self.errors += 1
+        self.totalTime += elapsed
+        self.maxTime = max(self.maxTime, elapsed)
+        ms = elapsed * 1000
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def getAverage(self):
+        if self.count == 0:
+            return 0.0
+        return self.totalTime / self.count
+
+    def getErrorRate(self):
+        if self.count == 0:
+            return 0.0
+        return float(self.errors) / self.count
+
+    def getPercentile(self, p):
+        """
+        Upper bound of the histogram bucket containing the
+        given percentile, in milliseconds. None means that it
+        is above the last bucket.
+        """
+        if self.count == 0:
+            return 0
+        target = p * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target:
+                if i < len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[i]
+                return None
+        return None
+
+
+class QueryStats:
+    """
+    Statistics of all query labels, plus a log of slow
+    queries: the most recent ones with their sql and timings.
+    """
+
+    def __init__(self, slowQuerySeconds=SLOW_QUERY_SECONDS,
+                 slowLogSize=SLOW_QUERY_LOG_SIZE):
+        self.slowQuerySeconds = slowQuerySeconds
+        self._stats = dict()
+        self.slowQueries = deque(maxlen=slowLogSize)
+        self.since = time()
+
+    def getStat(self, key):
+        try: return self._stats[key]
+        except KeyError:
+            stat = self._stats[key] = QueryStat(key)
+            return stat
+
+    def getStats(self):
+        """
+        Return stats of all labels, biggest total time first
+        """
+        return sorted(self._stats.values(),
+                      key=lambda stat: stat.totalTime, reverse=True)
+
+    def getTotalTime(self):
+        return sum(stat.totalTime for stat in self._stats.values())
+
+    def record(self, key, sqlQuery, elapsed, server, error=False):
+        self.getStat(key).add(elapsed, error)
+        if self.slowQuerySeconds and elapsed >= self.slowQuerySeconds:
+            sql = str(sqlQuery)[:SLOW_QUERY_MAX_SQL]
+            self.slowQueries.append((time(), key, sql, elapsed, server))
+            log.msg('WARN: slow query [%s] %0.1fms on %s: %s' % (
+                key, elapsed*1000, server, sql))
+
+    def reset(self):
+        self._stats.clear()
+        self.slowQueries.clear()
+        self.since = time()
@@ -37,3 +37,8 @@ class ConfigurationError(PacketServerError):
     """
     An error in server configuration
     """
+
+class DatabaseBusyError(PacketServerError):
+    """
+    Too many DB calls of one pool class are waiting
+    """
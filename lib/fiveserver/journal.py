@@ -0,0 +1,308 @@
+"""
+Match journal: results of finished matches are appended to a
+local file first, and applied to the database afterwards, by a
+worker that retries until the database takes them
+"""
+
+from datetime import datetime, timedelta
+import json
+import os
+import time
+
+from twisted.internet import reactor, defer, threads
+
+from fiveserver import log, data
+
+
+FSYNC_SECONDS = 0.05 # how long appends wait to share one fsync
+APPLY_CONCURRENCY = 4 # entries applied at the same time
+RETRY_MIN_SECONDS = 1
+RETRY_MAX_SECONDS = 60
+MAX_APPLY_ATTEMPTS = 20 # then the entry goes to the dead-letter file
+COMPACT_SIZE = 1024*1024 # bytes of journal before it is compacted
+KEEP_DAYS = 7 # how long keys of applied entries stay in DB
+PRUNE_SECONDS = 3600
+
+# errors that retrying cannot fix: bad record, or the database
+# rejects the statements
+PERMANENT_ERRORS = [
+    'IntegrityError', 'ProgrammingError', 'DataError', 'NotSupportedError',
+    'KeyError', 'IndexError', 'TypeError', 'ValueError', 'AttributeError']
+
+
+class MatchJournal:
+    """
+    Append-only journal of match results. Every line is a JSON
+    object: either a match entry (op "match", with the record of
+    the match, as returned by matchData.toRecord) or a marker
+    that an entry is done with (op "applied" or "dead"). Entries
+    are written in batches, with one fsync per batch. When the
+    file grows big, it is rewritten with only the entries that
+    have not been applied yet.
+
+    Durable entries are applied with matchData.store, in journal
+    order for any given profile, and retried with backoff when
+    the database fails. The key of the entry goes into the same
+    transaction as the match, so an entry replayed after a crash
+    is not stored twice. On start, entries without a marker are
+    replayed. Entries that cannot be applied (permanent errors,
+    or too many attempts) go to the dead-letter file, path.dead,
+    to be looked at by hand.
+    """
+
+    def __init__(self, path, matchData, fsyncSeconds=FSYNC_SECONDS,
+                 keepDays=KEEP_DAYS):
+        self.path = path
+        self.deadPath = '%s.dead' % path
+        self.matchData = matchData
+        self.fsyncSeconds = fsyncSeconds
+        self.keepDays = keepDays
+        self._file = None
+        self._size = 0
+        self._compactedSize = 0
+        self._buffer = []
+        self._durable = []
+        self._flushCall = None
+        self._flushing = None
+        self._pruneCall = None
+        self._pending = [] # (key, record) not applied yet, in order
+        self._running = dict()
+        self._seq = 0
+        self.appended = 0
+        self.applied = 0
+        self.retries = 0
+        self.dead = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _newKey(self):
+        self._seq += 1
+        return '%d.%d.%d' % (time.time()*1000, os.getpid(), self._seq)
+
+    def start(self):
+        """
+        Open the journal, and replay the entries that have not
+        been applied yet
+        """
+        entries = dict()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for lineno, line in enumerate(f):
+                    try:
+                        entry = json.loads(line)
+                        key = entry['key']
+                        if entry['op'] == 'match':
+                            entries[key] = entry['record']
+                        else:
+                            entries.pop(key, None)
+                    except (ValueError, KeyError):
+                        log.msg('WARN: skipping bad line %d of '
+                                'match journal %s' % (lineno+1, self.path))
+        # rewrite the file with only the unapplied entries
+        self._rewrite([self._line('match', key, record)
+                       for key, record in entries.items()])
+        self._size = self._compactedSize = os.path.getsize(self.path)
+        if entries:
+            log.msg('Match journal: replaying %d entries' % len(entries))
+        self._pending.extend(entries.items())
+        self._dispatch()
+        self._pruneCall = reactor.callLater(PRUNE_SECONDS, self._prune)
+
+    def _line(self, op, key, record=None):
+        entry = {'op': op, 'key': key}
+        if record is not None:
+            entry['record'] = record
+        return json.dumps(entry) + '\n'
+
+    def _rewrite(self, lines):
+        """
+        Replace the journal file with the given lines, and
+        reopen it for appending. Return number of bytes written.
+        """
+        text = ''.join(lines)
+        temp = '%s.tmp' % self.path
+        with open(temp, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'a')
+        return len(text)
+
+    def append(self, match):
+        """
+        Add match to the journal. Return a Deferred, which
+        fires with the key of the entry once it is on disk.
+        The database gets the match after that.
+        """
+        key = self._newKey()
+        record = self.matchData.toRecord(match)
+        d = defer.Deferred()
+        self._buffer.append(self._line('match', key, record))
+        self._durable.append((key, record, d))
+        self.appended += 1
+        self._scheduleFlush()
+        return d
+
+    def _scheduleFlush(self):
+        if self._flushCall is None and self._flushing is None:
+            self._flushCall = reactor.callLater(
+                self.fsyncSeconds, self._scheduledFlush)
+
+    def _scheduledFlush(self):
+        self._flushCall = None
+        self.flush()
+
+    def flush(self):
+        """
+        Write and fsync buffered lines. Return a Deferred,
+        which fires when they are on disk.
+        """
+        if self._flushing is not None:
+            d = defer.Deferred()
+            self._flushing.addBoth(lambda _: self.flush().chainDeferred(d))
+            return d
+        if not self._buffer:
+            return defer.succeed(0)
+        lines, self._buffer = self._buffer, []
+        durable, self._durable = self._durable, []
+        # compact when mostly applied entries and markers are left,
+        # keeping lines of entries not applied yet
+        compact = None
+        if self._size > max(COMPACT_SIZE, 2*self._compactedSize):
+            compact = [self._line('match', key, record)
+                       for key, record in self._pending]
+        self._flushing = threads.deferToThread(self._write, lines, compact)
+        self._flushing.addCallbacks(
+            self._written, self._writeFailed,
+            callbackArgs=(durable, compact is not None),
+            errbackArgs=(durable,))
+        return self._flushing
+
+    def _write(self, lines, compact):
+        if compact is not None:
+            return self._rewrite(compact + lines)
+        text = ''.join(lines)
+        self._file.write(text)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return len(text)
+
+    def _written(self, size, durable, compacted):
+        self._flushing = None
+        if compacted:
+            self._size = self._compactedSize = size
+        else:
+            self._size += size
+        self._makeDurable(durable)
+        if self._buffer:
+            self._scheduleFlush()
+        return size
+
+    def _writeFailed(self, error, durable):
+        self._flushing = None
+        log.msg('WARN: cannot write match journal %s: %s' % (
+            self.path, error.value))
+        # still apply them: the database is the next best place
+        self._makeDurable(durable)
+        if self._buffer:
+            self._scheduleFlush()
+        return 0
+
+    def _makeDurable(self, durable):
+        for key, record, d in durable:
+            self._pending.append((key, record))
+        self._dispatch()
+        for key, record, d in durable:
+            d.callback(key)
+
+    def _dispatch(self):
+        """
+        Start applying entries, oldest first. An entry waits
+        while an older entry of any of its profiles is pending.
+        """
+        busy = set()
+        for key, record in self._pending:
+            if len(self._running) >= APPLY_CONCURRENCY:
+                break
+            profiles = set(record['home'] + record['away'])
+            if key not in self._running and not profiles & busy:
+                self._running[key] = record
+                self._apply(key, record, 1)
+            busy |= profiles
+
+    def _apply(self, key, record, attempt):
+        d = defer.maybeDeferred(self.matchData.fromRecord, record)
+        d.addCallback(self.matchData.store, journalKey=key)
+        d.addCallbacks(self._applied, self._applyFailed,
+            callbackArgs=(key,), errbackArgs=(key, record, attempt))
+
+    def _done(self, key, op):
+        del self._running[key]
+        self._pending = [(k, r) for k, r in self._pending if k != key]
+        self._buffer.append(self._line(op, key))
+        self._scheduleFlush()
+        self._dispatch()
+
+    def _applied(self, matchId, key):
+        self.applied += 1
+        self._done(key, 'applied')
+
+    def _applyFailed(self, error, key, record, attempt):
+        if error.value.__class__.__name__ in PERMANENT_ERRORS or \
+                attempt >= MAX_APPLY_ATTEMPTS:
+            if self._bury(key, record, error):
+                return
+        self.retries += 1
+        delay = min(RETRY_MIN_SECONDS * 2**(attempt-1), RETRY_MAX_SECONDS)
+        log.msg('WARN: cannot apply match journal entry %s '
+                '(retrying in %ds): %s' % (key, delay, error.value))
+        # still running: keeps later entries of its profiles waiting
+        reactor.callLater(delay, self._apply, key, record, attempt+1)
+
+    def _bury(self, key, record, error):
+        """
+        Move entry to the dead-letter file, so that later
+        entries of its profiles can go on. Return True if done.
+        """
+        log.msg('ALERT: match journal entry %s cannot be applied (%s: %s). '
+                'Moving it to %s' % (key, error.value.__class__.__name__,
+                error.value, self.deadPath))
+        entry = {'key': key, 'record': record, 'error': str(error.value)}
+        try:
+            with open(self.deadPath, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except IOError as info:
+            log.msg('ALERT: cannot write %s: %s' % (self.deadPath, info))
+            return False
+        self.dead += 1
+        self._done(key, 'dead')
+        return True
+
+    def _prune(self):
+        """
+        Delete old keys of applied entries from DB: entries are
+        replayed only after a crash, soon after being applied
+        """
+        self._pruneCall = reactor.callLater(PRUNE_SECONDS, self._prune)
+        d = data.pruneJournalApplied(self.matchData.dbController,
+            datetime.now() - timedelta(days=self.keepDays))
+        d.addErrback(lambda error: log.msg(
+            'WARN: cannot prune journal_applied: %s' % error.value))
+        return d
+
+    def shutdown(self):
+        """
+        Write everything buffered, cancelling scheduled calls.
+        Entries not applied yet are replayed on next start.
+        """
+        for call in (self._flushCall, self._pruneCall):
+            if call is not None and call.active():
+                call.cancel()
+        self._flushCall = self._pruneCall = None
+        return self.flush()
@@ -0,0 +1,145 @@
+"""
+In-memory leaderboard: order statistics over profile points
+"""
+
+from bisect import bisect_left, insort
+
+
+DEFAULT_MAX_POINTS = 1000
+
+
+class FenwickTree:
+    """
+    Binary indexed tree of counts. Point updates, prefix sums
+    and k-th element search all run in O(log n).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._tree = [0]*(size+1)
+
+    def add(self, index, delta):
+        i = index + 1
+        while i <= self.size:
+            self._tree[i] += delta
+            i += i & (-i)
+
+    def prefixSum(self, index):
+        """
+        Return sum of counts in buckets [0, index)
+        """
+        total, i = 0, index
+        while i > 0:
+            total += self._tree[i]
+            i -= i & (-i)
+        return total
+
+    def search(self, k):
+        """
+        Find the bucket holding k-th (0-based) element.
+        Return a (bucket, offset-within-bucket) pair.
+        """
+        pos, rem = 0, k
+        step = 1 << self.size.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and self._tree[nxt] <= rem:
+                pos = nxt
+                rem -= self._tree[nxt]
+            step >>= 1
+        return pos, rem
+
+
+class Leaderboard:
+    """
+    Keeps all profiles ordered by points (descending) and
+    seconds played (descending), the same ordering that
+    ProfileData.computeRanks uses. Rank follows computeRanks
+    semantics too: profiles with equal points share a rank.
+    """
+
+    def __init__(self, maxPoints=DEFAULT_MAX_POINTS):
+        self.loaded = False
+        self.version = 0
+        self._reset(maxPoints)
+
+    def _reset(self, maxPoints):
+        self.maxPoints = maxPoints
+        self._tree = FenwickTree(maxPoints+1)
+        self._buckets = [[] for i in range(maxPoints+1)]
+        self._entries = dict()
+
+    def _bucket(self, points):
+        # higher points go into lower buckets
+        return self.maxPoints - max(0, points)
+
+    def _grow(self, points):
+        entries = list(self._entries.items())
+        self._reset(max(points, self.maxPoints*2))
+        for profileId, (name, points, seconds) in entries:
+            self._insert(profileId, name, points, seconds)
+
+    def _insert(self, profileId, name, points, seconds):
+        if points > self.maxPoints:
+            self._grow(points)
+        b = self._bucket(points)
+        insort(self._buckets[b], (-seconds, profileId))
+        self._tree.add(b, 1)
+        self._entries[profileId] = (name, points, seconds)
+
+    def _remove(self, profileId):
+        name, points, seconds = self._entries.pop(profileId)
+        b = self._bucket(points)
+        bucket = self._buckets[b]
+        i = bisect_left(bucket, (-seconds, profileId))
+        del bucket[i]
+        self._tree.add(b, -1)
+
+    def load(self, rows):
+        """
+        Replace contents with (id, name, points, seconds_played) rows
+        """
+        self._reset(self.maxPoints)
+        for profileId, name, points, seconds in rows:
+            self._insert(profileId, name, points, seconds)
+        self.loaded = True
+        self.version += 1
+
+    def update(self, profileId, name, points, seconds):
+        if profileId in self._entries:
+            self._remove(profileId)
+        self._insert(profileId, name, points, seconds)
+        self.version += 1
+
+    def remove(self, profileId):
+        if profileId in self._entries:
+            self._remove(profileId)
+            self.version += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def getRank(self, profileId):
+        """
+        Return rank of the profile, or None if it is unknown
+        """
+        try: name, points, seconds = self._entries[profileId]
+        except KeyError:
+            return None
+        return self._tree.prefixSum(self._bucket(points)) + 1
+
+    def getPage(self, offset=0, limit=30):
+        """
+        Return list of (rank, profileId, name, points) tuples,
+        starting at given offset in the leaderboard ordering.
+        """
+        results = []
+        k, end = offset, min(offset+limit, len(self._entries))
+        while k < end:
+            b, rem = self._tree.search(k)
+            rank = self._tree.prefixSum(b) + 1
+            for negSeconds, profileId in self._buckets[b][rem:rem+end-k]:
+                name, points, seconds = self._entries[profileId]
+                results.append((rank, profileId, name, points))
+                k += 1
+        return results
@@ -1,6 +1,23 @@
 from twisted.internet import defer
+from twisted.python import failure
+from collections import OrderedDict
 from fiveserver.model import user
-from fiveserver import errors
+from fiveserver import errors, rating
+
+
+STATS_CACHE_SIZE = 10000
+NUM_LAST_TEAMS = 5
+
+
+def getTeamIds(match):
+    """
+    Return (home team id, away team id) of a match: PES6
+    matches keep them in their team selection
+    """
+    teamSelection = getattr(match, 'teamSelection', None)
+    if teamSelection is not None:
+        return teamSelection.home_team_id, teamSelection.away_team_id
+    return match.home_team_id, match.away_team_id
 
 
 class ProfileLogic:
@@ -11,6 +28,9 @@ class ProfileLogic:
     def __init__(self, matchData, profileData):
         self.matchData = matchData
         self.profileData = profileData
+        self.matchJournal = None
+        self._statsCache = OrderedDict()
+        self._statsLoading = dict()
 
     @defer.inlineCallbacks
     def getFullProfileInfoByName(self, profileName):
@@ -30,34 +50,128 @@ class ProfileLogic:
                 'profile not found for id: %s' % profileId)
         defer.returnValue((profiles[0], stats))
 
-    @defer.inlineCallbacks
     def getStats(self, profileId):
-        # wins, losses, draws
-        results = yield defer.DeferredList([
-            self.matchData.getWins(profileId),
-            self.matchData.getLosses(profileId),
-            self.matchData.getDraws(profileId)])
-        (_,wins),(_,losses),(_,draws) = results
-        # goals
-        results = yield defer.DeferredList([
-            self.matchData.getGoalsHome(profileId),
-            self.matchData.getGoalsAway(profileId)])
-        (_, (scored_home, allowed_home)) = results[0]
-        (_, (scored_away, allowed_away)) = results[1]
-        goals_scored = scored_home + scored_away
-        goals_allowed = allowed_home + allowed_away
-        # streaks
-        results = yield self.matchData.getStreaks(profileId)
-        current, best = results
-        # last 5 teams
-        if hasattr(self.matchData, 'getLastTeamsUsed'):
-            teams = yield self.matchData.getLastTeamsUsed(profileId, 5)
-        else:
-            teams = None
+        """
+        Return stats of a profile. Stats are loaded from DB once
+        and then kept up to date by recordMatch.
+        """
+        try: stats = self._statsCache[profileId]
+        except KeyError:
+            # one load per profile at a time: a second one could
+            # finish later and replace stats updated in between
+            d = defer.Deferred()
+            try: self._statsLoading[profileId].append(d)
+            except KeyError:
+                waiting = self._statsLoading[profileId] = [d]
+                self.loadStats(profileId).addBoth(
+                    self._statsLoaded, profileId, waiting)
+            return d
+        self._statsCache.move_to_end(profileId)
+        return defer.succeed(stats)
 
+    def _statsLoaded(self, result, profileId, waiting):
+        # not cached if forgotten while loading
+        if self._statsLoading.get(profileId) is waiting:
+            del self._statsLoading[profileId]
+            if not isinstance(result, failure.Failure):
+                result = self._cacheStats(result)
+        for d in waiting:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _cacheStats(self, stats):
+        """
+        Cache loaded stats, unless the profile already has
+        cached stats: those are never replaced. Return the
+        cached ones.
+        """
+        try: stats = self._statsCache[stats.profile_id]
+        except KeyError:
+            self._statsCache[stats.profile_id] = stats
+        self._statsCache.move_to_end(stats.profile_id)
+        while len(self._statsCache) > STATS_CACHE_SIZE:
+            self._statsCache.popitem(last=False)
+        return stats
+
+    def forgetStats(self, profileId):
+        self._statsCache.pop(profileId, None)
+        self._statsLoading.pop(profileId, None)
+
+    @defer.inlineCallbacks
+    def loadStats(self, profileId):
+        # all stats in one DB round-trip
+        results = yield self.matchData.getStats(profileId, NUM_LAST_TEAMS)
+        (wins, losses, draws, goals_scored, goals_allowed,
+         current, best, teams) = results
         stats = user.Stats(
             profileId, wins, losses, draws,
             goals_scored, goals_allowed,
             current, best, teams)
         defer.returnValue(stats)
 
+    @defer.inlineCallbacks
+    def recordMatch(self, ratingMath, match, homeProfiles, awayProfiles):
+        """
+        Store the match and update stats and points of all
+        participants incrementally: O(1) per participant, without
+        re-reading their match history. Stats are fetched (usually
+        from cache) before the match is stored, so that they
+        never already include it. With a match journal, the match
+        only has to reach the journal: the result is then the key
+        of the journal entry, not the match id.
+        """
+        participants = list(homeProfiles) + list(awayProfiles)
+        results = yield defer.DeferredList([
+            self.getStats(profile.id) for profile in participants])
+        statsList = [stats for _, stats in results]
+        if self.matchJournal is not None:
+            matchId = yield self.matchJournal.append(match)
+        else:
+            matchId = yield self.matchData.store(match)
+        # opponents' strength, as it was before the match
+        homePoints = sum(p.points for p in homeProfiles)/len(homeProfiles)
+        awayPoints = sum(p.points for p in awayProfiles)/len(awayProfiles)
+        homeTeamId, awayTeamId = getTeamIds(match)
+        newPoints = []
+        for i, (profile, stats) in enumerate(zip(participants, statsList)):
+            if i < len(homeProfiles):
+                scored, allowed = match.score_home, match.score_away
+                teamId, opponentPoints = homeTeamId, awayPoints
+            else:
+                scored, allowed = match.score_away, match.score_home
+                teamId, opponentPoints = awayTeamId, homePoints
+            if scored > allowed:
+                outcome = rating.WIN
+            elif scored < allowed:
+                outcome = rating.LOSS
+            else:
+                outcome = rating.DRAW
+            self.updateStats(stats, scored, allowed, outcome, teamId)
+            newPoints.append(ratingMath.updatePoints(
+                profile.points, stats, outcome, opponentPoints))
+        for profile, points in zip(participants, newPoints):
+            profile.points = points
+        defer.returnValue(matchId)
+
+    def updateStats(self, stats, scored, allowed, outcome, teamId=None):
+        """
+        Account for one more match in (cached) stats
+        """
+        if outcome == rating.WIN:
+            stats.wins += 1
+            stats.streak_current += 1
+            stats.streak_best = max(stats.streak_best, stats.streak_current)
+        else:
+            if outcome == rating.LOSS:
+                stats.losses += 1
+            else:
+                stats.draws += 1
+            stats.streak_current = 0
+        stats.goals_scored += scored
+        stats.goals_allowed += allowed
+        if teamId is not None and hasattr(
+                self.matchData, 'getLastTeamsUsed'):
+            stats.teams = [teamId] + stats.teams[:NUM_LAST_TEAMS-1]
+        self._cacheStats(stats)
@@ -8,7 +8,54 @@ from fiveserver import log
 from fiveserver.model import util
 
 
-class Profile:
+class Persistent:
+    """
+    Tracks which of the persistent fields were assigned a
+    different value since the object was last marked clean
+    (loaded from or written to DB). Until then, all fields
+    are considered dirty.
+    """
+
+    persistentFields = ()
+
+    def __setattr__(self, name, value):
+        if name in self.persistentFields:
+            dirty = self.__dict__.get('_dirty')
+            if dirty is not None and (
+                    name not in self.__dict__ or
+                    self.__dict__[name] != value):
+                dirty.add(name)
+        self.__dict__[name] = value
+
+    def markClean(self):
+        self.__dict__['_dirty'] = set()
+
+    def markDirty(self, fields=None):
+        """
+        Mark given fields dirty. With no fields given, all of
+        them become dirty, as if the object was never stored.
+        """
+        if fields is None:
+            self.__dict__['_dirty'] = None
+        elif self.__dict__.get('_dirty') is not None:
+            self._dirty.update(fields)
+
+    def getDirtyFields(self):
+        """
+        Return set of changed fields, or None if
+        the object is not known to be in DB.
+        """
+        dirty = self.__dict__.get('_dirty')
+        if dirty is None:
+            return None
+        return set(dirty)
+
+
+class Profile(Persistent):
+
+    persistentFields = (
+        'userId', 'index', 'name', 'favPlayer', 'favTeam', 'rank',
+        'rating', 'points', 'disconnects', 'playTime', 'comment')
 
     def __init__(self, index):
         self.index = index   # 1
@@ -40,7 +87,9 @@ class UserInfo:
         self.rosterHash = rosterHash
 
 
-class User:
+class User(Persistent):
+
+    persistentFields = ('username', 'serial', 'hash', 'nonce')
     
     def __init__(self, hash):
         self.hash = hash
@@ -62,6 +111,20 @@ class User:
         else:
             self.lobbyConnection.sendData(packetId, data)
 
+    def copySession(self):
+        """
+        Return a copy of this user for another service connection:
+        same persistent data and Profile objects, but none of the
+        per-connection state.
+        """
+        usr = User(self.hash)
+        for name in ('id', 'username', 'serial', 'nonce', 'updatedOn'):
+            if name in self.__dict__:
+                usr.__dict__[name] = self.__dict__[name]
+        usr.profiles = list(self.profiles)
+        usr.markClean()
+        return usr
+
     def getProfileById(self, profileId):
         for i, profile in enumerate(self.profiles):
             if profile.id == profileId:
@@ -3,6 +3,9 @@ Protocol implementations for PES5/PES6 packet server.
 """
 
 from twisted.internet.protocol import Protocol, ServerFactory
+from twisted.internet import defer
+from collections import deque
+import functools
 import time
 
 from fiveserver.model import packet
@@ -24,6 +27,78 @@ def isSameGame(factory, userA, userB):
     return result
 
 
+class DbRequestGate:
+    """
+    Admission control of DB-backed requests of one connection:
+    at most maxInFlight of them are handled at once, up to
+    maxQueued more wait, and the rest are dropped. A request
+    identical to one already waiting or in progress (same packet
+    id and data) is dropped too: the answer to the first one
+    answers it. Keeps numbers for the admin service, which lists
+    the top DB consumers.
+    """
+
+    def __init__(self, protocol, maxInFlight, maxQueued):
+        self.protocol = protocol
+        self.maxInFlight = maxInFlight
+        self.maxQueued = maxQueued
+        self.inFlight = 0
+        self.requests = 0
+        self.collapsed = 0
+        self.dropped = 0
+        self.busyTime = 0.0
+        self.since = time.time()
+        self._queue = deque()
+        self._pending = set()
+
+    def getName(self):
+        try: return self.protocol._user.profile.name
+        except AttributeError:
+            pass
+        try: return self.protocol._user.username
+        except AttributeError:
+            return ''
+
+    def getQueueDepth(self):
+        return len(self._queue)
+
+    def submit(self, handler, pkt):
+        self.requests += 1
+        key = (pkt.header.id, pkt.data)
+        if key in self._pending:
+            self.collapsed += 1
+            return None
+        if self.inFlight >= self.maxInFlight:
+            if len(self._queue) >= self.maxQueued:
+                self.dropped += 1
+                if self.dropped % 100 == 1:
+                    log.msg('WARN: too many DB requests from %s {%s}: '
+                            '%d dropped' % (
+                            self.protocol.addr, self.getName(),
+                            self.dropped))
+                return None
+            self._pending.add(key)
+            self._queue.append((handler, pkt, key))
+            return None
+        self._pending.add(key)
+        return self._run(handler, pkt, key)
+
+    def _run(self, handler, pkt, key):
+        self.inFlight += 1
+        d = defer.maybeDeferred(handler, pkt)
+        d.addBoth(self._done, key, time.time())
+        return d
+
+    def _done(self, result, key, startTime):
+        self.inFlight -= 1
+        self.busyTime += time.time() - startTime
+        self._pending.discard(key)
+        while self._queue and self.inFlight < self.maxInFlight:
+            handler, pkt, nextKey = self._queue.popleft()
+            self._run(handler, pkt, nextKey)
+        return result
+
+
 class PacketReceiver(Protocol):
     """
     Base class for packet-receiving protocols
@@ -122,11 +197,28 @@ class PacketDispatcher(PacketReceiver):
     def connectionMade(self):
         PacketReceiver.connectionMade(self)
         self._handlers = dict()
+        self.dbRequestGate = DbRequestGate(self,
+            self.factory.maxDbRequestsInFlight,
+            self.factory.maxDbRequestsQueued)
+        self.factory.dbRequestGates.add(self.dbRequestGate)
         self.register()
 
+    def connectionLost(self, reason):
+        PacketReceiver.connectionLost(self, reason)
+        self.factory.dbRequestGates.discard(self.dbRequestGate)
+
     def addHandler(self, packet_id, handler):
         self._handlers[packet_id] = handler
 
+    def addDbHandler(self, packet_id, handler):
+        """
+        Same as addHandler, for read-only requests that go
+        to DB: these are admitted by dbRequestGate, so that
+        one client cannot keep the DB busy for everybody
+        """
+        self._handlers[packet_id] = functools.partial(
+            self.dbRequestGate.submit, handler)
+
     def register(self):
         """
         Override this. Child classes should
@@ -6,14 +6,12 @@ from twisted.internet import reactor, defer
 from twisted.application import service
 from twisted.web import client
 
-from Crypto.Cipher import Blowfish
 from datetime import datetime, timedelta
 from hashlib import md5
 import binascii
 import struct
 import time
 import re
-import zlib
 
 from fiveserver.model import packet, user, lobby, util
 from fiveserver.model.util import PacketFormatter
@@ -198,7 +196,7 @@ class LoginService(PacketDispatcher):
 
     @defer.inlineCallbacks
     def authenticate_3003(self, pkt):
-        cipher = Blowfish.new(binascii.a2b_hex(self.factory.cipherKey), Blowfish.MODE_ECB)
+        cipher = self.factory.cipher
         if self.factory.serverConfig.Debug:
             log.debug('[BLOWFISH]: %s' % PacketFormatter.format(pkt, cipher))
         clientRosterHash = self.getRosterHash(cipher.decrypt(pkt.data))
@@ -247,13 +245,12 @@ class LoginService(PacketDispatcher):
     @defer.inlineCallbacks
     def getProfiles_3010(self, pkt):
         if self.factory.serverConfig.ShowStats:
-            results = yield defer.DeferredList([
-                self.factory.matchData.getGames(
-                    profile.id) for profile in self._user.profiles])
+            results = yield self.factory.matchData.getGamesOfProfiles([
+                profile.id for profile in self._user.profiles])
             profiles = self._user.profiles
         else:
             # hide all stats
-            results = yield defer.succeed([(True, 0)
+            results = yield defer.succeed([0
                 for profile in self._user.profiles])
             profiles = [self.makePristineProfile(profile)
                 for profile in self._user.profiles]
@@ -268,7 +265,7 @@ class LoginService(PacketDispatcher):
                     self.factory.ratingMath.getDivision(profile.points)),
                 b'points':struct.pack('!i', profile.points),
                 b'games':struct.pack('!H', games)}
-            for (_, games), (i, profile) in zip(
+            for games, (i, profile) in zip(
                 results, enumerate(profiles))])
         self.sendData(0x3012, data)
         defer.returnValue(None)
@@ -330,7 +327,7 @@ class LoginService(PacketDispatcher):
             data = struct.pack('!I',0xfffffedd)
             self.sendData(0x3087, data)
         else:
-            settings = yield self.factory.profileData.getSettings(
+            settings = yield self.factory.getSettings(
                 self._user.profile.id)
             if settings.settings1 is None or settings.settings2 is None:
                 data = struct.pack('!I',0xfffffedd)
@@ -341,10 +338,8 @@ class LoginService(PacketDispatcher):
                     struct.pack('!I', self._user.profile.id))
                 self.sendData(0x3087, data)
                 # send settings
-                data = zlib.decompress(settings.settings1)
-                self.sendData(0x3088, data)
-                data = zlib.decompress(settings.settings2)
-                self.sendData(0x3088, data)
+                self.sendData(0x3088, settings.settings1)
+                self.sendData(0x3088, settings.settings2)
                 self.sendZeros(0x3089, 0)
         defer.returnValue(None)
 
@@ -380,41 +375,37 @@ class LoginService(PacketDispatcher):
                     thisLobby = self.factory.getLobbies()[
                         self._user.state.lobbyId]
                     if thisLobby.typeCode != 0x20: # no-stats
-                        # record the match in DB
-                        yield self.factory.matchData.store(match)
+                        # record the match in DB, update stats
+                        # and re-calculate points
+                        yield self.factory.profileLogic.recordMatch(
+                            self.factory.ratingMath, match,
+                            [match.home_profile], [match.away_profile])
                         # update player play time
                         match.home_profile.playTime += duration
                         match.away_profile.playTime += duration
-                        # re-calculate points
-                        results = yield defer.DeferredList([
-                            self.getStats(match.home_profile.id),
-                            self.getStats(match.away_profile.id)])
-                        (_,home_stats), (_,away_stats) = results
-                        rm = self.factory.ratingMath
-                        match.home_profile.points = rm.getPoints(home_stats)
-                        match.away_profile.points = rm.getPoints(away_stats)
                         # store updated profiles
-                        yield self.factory.storeProfile(match.home_profile)
-                        yield self.factory.storeProfile(match.away_profile)
+                        yield self.factory.storeProfileAfterMatch(
+                            match.home_profile)
+                        yield self.factory.storeProfileAfterMatch(
+                            match.away_profile)
         yield defer.succeed(None)
         defer.returnValue(None)
 
     def do_3088(self, pkt):
-        if pkt.data[2] == b'\3':
+        # settings are compressed only when stored
+        if pkt.data[2:3] == b'\3':
             # update settings
-            settings1 = zlib.compress(pkt.data)
-            self._user.profile.settings.settings1 = settings1
+            self._user.profile.settings.settings1 = bytes(pkt.data)
         else:
             # update settings
-            settings2 = zlib.compress(pkt.data)
-            self._user.profile.settings.settings2 = settings2
+            self._user.profile.settings.settings2 = bytes(pkt.data)
 
     @defer.inlineCallbacks
     def do_3089(self, pkt):
         self.sendZeros(0x308b,4)
         if self.factory.isStoreSettingsEnabled():
             # store settings
-            yield self.factory.profileData.storeSettings(
+            yield self.factory.storeSettings(
                 self._user.profile.id, self._user.profile.settings)
         defer.returnValue(None)
 
@@ -438,7 +429,7 @@ class LoginService(PacketDispatcher):
     def register(self):
         self.addHandler(0x3001, self.do_3001)
         self.addHandler(0x3003, self.authenticate_3003)
-        self.addHandler(0x3010, self.getProfiles_3010)
+        self.addDbHandler(0x3010, self.getProfiles_3010)
         self.addHandler(0x3020, self.createProfile_3020)
         self.addHandler(0x3030, self.deleteProfile_3030)
         self.addHandler(0x3040, self.selectProfile_3040)
@@ -494,6 +485,8 @@ class NetworkMenuService(LoginService):
     def connectionLost(self, reason):
         LoginService.connectionLost(self, reason)
         if self._user and self._user.lobbyConnection and self._user.state:
+            # leaving the lobby: user logs out
+            self.factory.endSession(hash=self._user.hash)
             try: thisLobby = self.factory.getLobbies()[
                 self._user.state.lobbyId]
             except IndexError:
@@ -507,7 +500,7 @@ class NetworkMenuService(LoginService):
                             room.match.away_team_id is not None:
                         # record the disconnect in DB
                         self._user.profile.disconnects += 1
-                        self.factory.storeProfile(self._user.profile)
+                        self.factory.storeProfileLater(self._user.profile)
                     # configuration determines how to treat disconnects:
                     if self.factory.serverConfig.Disconnects.get(
                             'CountAsLoss',{}).get('Enabled',False):
@@ -588,6 +581,9 @@ class NetworkMenuService(LoginService):
     def formatProfileInfo(self, profile, stats):
         if not self.factory.serverConfig.ShowStats:
             profile = self.makePristineProfile(profile)
+            rank = profile.rank
+        else:
+            rank = self.factory.getProfileRank(profile)
         return (b'%(id)s%(name)s%(division)s%(points)s%(games)s'
                 b'%(wins)s%(losses)s%(draws)s%(win-strk)s'
                 b'%(win-best)s%(disconnects)s%(PAD1)s'
@@ -613,7 +609,7 @@ class NetworkMenuService(LoginService):
                     b'goals-allowed': struct.pack('!H', stats.goals_allowed),
                     b'fav-team': struct.pack('!H', profile.favTeam),
                     b'fav-player': struct.pack('!i', profile.favPlayer),
-                    b'rank': struct.pack('!i', profile.rank),
+                    b'rank': struct.pack('!i', rank),
                 })
 
     def formatRoomSettings(self, settings):
@@ -781,14 +777,14 @@ class NetworkMenuService(LoginService):
     @defer.inlineCallbacks
     def setFavouriteTeam_4110(self, pkt):
         self._user.profile.favTeam = struct.unpack('!H', pkt.data[0:2])[0]
-        yield self.factory.storeProfile(self._user.profile)
+        yield self.factory.storeProfileLater(self._user.profile)
         self.sendZeros(0x4112,4)
         defer.returnValue(None)
 
     @defer.inlineCallbacks
     def setFavouritePlayer_4114(self, pkt):
         self._user.profile.favPlayer = struct.unpack('!i', pkt.data[0:4])[0]
-        yield self.factory.storeProfile(self._user.profile)
+        yield self.factory.storeProfileLater(self._user.profile)
         self.sendZeros(0x4116,4)
         defer.returnValue(None)
 
@@ -829,6 +825,7 @@ class NetworkMenuService(LoginService):
             thisLobby.exit(self._user)
             # user now considered OFFLINE
             self.factory.userOffline(self._user)
+            self.factory.endSession(hash=self._user.hash)
             # notify every remaining occupant in the lobby
             for usr in thisLobby.players.values():
                 usr.sendData(0x4221,struct.pack('!i',self._user.profile.id))
@@ -836,10 +833,10 @@ class NetworkMenuService(LoginService):
     def register(self):
         LoginService.register(self) # also handle all parent packets
         self.addHandler(0x4100, self.do_4100)
-        self.addHandler(0x4102, self.getProfile_4102)
+        self.addDbHandler(0x4102, self.getProfile_4102)
         self.addHandler(0x4200, self.getLobbies_4200)
         self.addHandler(0x4202, self.selectLobby_4202)
-        self.addHandler(0x4210, self.getUserList_4210)
+        self.addDbHandler(0x4210, self.getUserList_4210)
         self.addHandler(0x4300, self.getRoomList_4300)
         self.addHandler(0x3080, self.do_3080)
         self.addHandler(0x4580, self.getFriends_4580)
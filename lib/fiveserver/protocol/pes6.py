@@ -126,13 +126,12 @@ class LoginService(RosterHandler, pes5.LoginService):
     @defer.inlineCallbacks
     def getProfiles_3010(self, pkt):
         if self.factory.serverConfig.ShowStats:
-            results = yield defer.DeferredList([
-                self.factory.matchData.getGames(
-                    profile.id) for profile in self._user.profiles])
+            results = yield self.factory.matchData.getGamesOfProfiles([
+                profile.id for profile in self._user.profiles])
             profiles = self._user.profiles
         else:
             # hide all stats
-            results = yield defer.succeed([(True, 0)
+            results = yield defer.succeed([0
                 for profile in self._user.profiles])
             profiles = [self.makePristineProfile(profile)
                 for profile in self._user.profiles]
@@ -149,7 +148,7 @@ class LoginService(RosterHandler, pes5.LoginService):
                 b'games':struct.pack('!H', games),
                 b'rating':struct.pack('!H',profile.rating),
                 } 
-            for (_, games), (i, profile) in zip(
+            for games, (i, profile) in zip(
                 results, enumerate(profiles))])
         self.sendData(0x3012, data)
         defer.returnValue(None)
@@ -239,6 +238,9 @@ class MainService(RosterHandler, pes5.MainService):
     def formatProfileInfo(self, profile, stats):
         if not self.factory.serverConfig.ShowStats:
             profile = self.makePristineProfile(profile)
+            rank = profile.rank
+        else:
+            rank = self.factory.getProfileRank(profile)
         return (b'%(id)s%(name)s%(groupid)s%(groupname)s'
                     b'%(groupmemberstatus)s%(division)s'
                     b'%(points)s%(rating)s%(matches)s'
@@ -273,7 +275,7 @@ class MainService(RosterHandler, pes5.MainService):
                 b'goals-allowed': struct.pack('!i', stats.goals_allowed),
                 b'comment': util.padWithZeros((
                     profile.comment or 'Fiveserver rules!'), 256),
-                b'rank': struct.pack('!i',profile.rank),
+                b'rank': struct.pack('!i',rank),
                 b'competition-gold-medals': struct.pack('!H', 0),
                 b'competition-silver-medals': struct.pack('!H', 0),
                 b'unknown1': struct.pack('!H', 0),
@@ -715,6 +717,7 @@ class MainService(RosterHandler, pes5.MainService):
         usrLobby.exit(usr)
         # user now considered OFFLINE
         self.factory.userOffline(usr)
+        self.factory.endSession(hash=usr.hash)
         # notify every remaining occupant in the lobby
         for otherUsr in usrLobby.players.values():
             otherUsr.sendData(0x4221,struct.pack('!i', usr.profile.id))
@@ -886,21 +889,28 @@ class MainService(RosterHandler, pes5.MainService):
             usr.sendData(0x436b, data)
         # create new TeamSelection object
         room.teamSelection = lobby.TeamSelection()
+        slots, ds = [], []
         for x in range(4):
             profile_id = struct.unpack('!i',pkt.data[x*8:x*8+4])[0]
             away = 1 == pkt.data[x*8+4]
             if profile_id!=0:
-                profile = yield self.factory.getPlayerProfile(profile_id)
-                if x in [0,1]:
-                    if not away:
-                        room.teamSelection.home_captain = profile
-                    else:
-                        room.teamSelection.away_captain = profile
+                slots.append((x, away))
+                ds.append(self.factory.getPlayerProfile(profile_id))
+        # look up all players at once
+        results = yield defer.DeferredList(ds, consumeErrors=True)
+        for (x, away), (success, profile) in zip(slots, results):
+            if not success:
+                profile.raiseException()
+            if x in [0,1]:
+                if not away:
+                    room.teamSelection.home_captain = profile
+                else:
+                    room.teamSelection.away_captain = profile
+            else:
+                if not away:
+                    room.teamSelection.home_more_players.append(profile)
                 else:
-                    if not away:
-                        room.teamSelection.home_more_players.append(profile)
-                    else:
-                        room.teamSelection.away_more_players.append(profile)
+                    room.teamSelection.away_more_players.append(profile)
         self.sendRoomUpdate(room)
 
     def setGameSettings_436c(self, pkt):
@@ -971,21 +981,19 @@ class MainService(RosterHandler, pes5.MainService):
         thisLobby = self.factory.getLobbies()[
             self._user.state.lobbyId]
         if thisLobby.typeCode != 0x20: # no-stats
-            # record the match in DB
-            yield self.factory.matchData.store(match)
-            participants = [match.teamSelection.home_captain,
-                match.teamSelection.away_captain]
-            participants.extend(match.teamSelection.home_more_players)
-            participants.extend(match.teamSelection.away_more_players)
-            for profile in participants:
+            home_players = [match.teamSelection.home_captain]
+            home_players.extend(match.teamSelection.home_more_players)
+            away_players = [match.teamSelection.away_captain]
+            away_players.extend(match.teamSelection.away_more_players)
+            # record the match in DB, update stats
+            # and re-calculate points
+            yield self.factory.profileLogic.recordMatch(
+                self.factory.ratingMath, match, home_players, away_players)
+            for profile in home_players + away_players:
                 # update player play time
                 profile.playTime += duration
-                # re-calculate points
-                stats = yield self.getStats(profile.id)
-                rm = self.factory.ratingMath
-                profile.points = rm.getPoints(stats)
                 # store updated profile
-                yield self.factory.storeProfile(profile)
+                yield self.factory.storeProfileAfterMatch(profile)
         else:
             yield defer.succeed(None)
 
@@ -1038,7 +1046,7 @@ class MainService(RosterHandler, pes5.MainService):
     @defer.inlineCallbacks
     def setComment_4110(self, pkt):
         self._user.profile.comment = pkt.data
-        yield self.factory.storeProfile(self._user.profile)
+        yield self.factory.storeProfileLater(self._user.profile)
         self.sendZeros(0x4111,4)
 
     def relayRoomSettings_4350(self, pkt):
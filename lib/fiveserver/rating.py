@@ -1,5 +1,39 @@
 import math
 
+try: import numpy
+except ImportError:
+    numpy = None
+
+
+from fiveserver import errors
+
+
+DEFAULT_WEIGHTS = (0.44, 0.56)
+DEFAULT_DRAW_FACTOR = 0.333
+DIVISION_THRESHOLDS = [250,450,600,750]
+
+# match outcomes, from the player's point of view
+WIN, DRAW, LOSS = 1.0, 0.5, 0.0
+
+
+def makeRatingMath(ratingConfig=None):
+    """
+    Create rating engine from "Rating" section of server
+    configuration (or defaults, if there is none)
+    """
+    if not ratingConfig:
+        ratingConfig = dict()
+    engine = ratingConfig.get('engine', 'performance')
+    try: engineClass = ENGINES[engine]
+    except KeyError:
+        raise errors.ConfigurationError(
+            'Unknown rating engine: "%s"' % engine)
+    return engineClass.fromConfig(ratingConfig)
+
+
+def registerEngine(name, engineClass):
+    ENGINES[name] = engineClass
+
 
 class RatingMath:
     """
@@ -28,13 +62,23 @@ class RatingMath:
     1.00| 563 660 954 996 999 1000
     """
 
-    def __init__(self, w1, w2):
+    # points can be re-computed from win/draw/loss counts alone
+    fromAggregates = True
+
+    def __init__(self, w1, w2, drawFactor=DEFAULT_DRAW_FACTOR):
         """
         w1 and w2 must be normalized weights
         (meaning: w1+w2 = 1.0)
         """
         self.w1 = w1
         self.w2 = w2
+        self.drawFactor = drawFactor
+
+    def fromConfig(cls, ratingConfig):
+        w1, w2 = ratingConfig.get('weights', DEFAULT_WEIGHTS)
+        drawFactor = ratingConfig.get('drawFactor', DEFAULT_DRAW_FACTOR)
+        return cls(w1, w2, drawFactor)
+    fromConfig = classmethod(fromConfig)
 
     def getScore(self, perf, num_games):
         return self.w2 + self.w1*perf*perf + self.w2*(
@@ -45,15 +89,98 @@ class RatingMath:
         if num_games == 0:
             perf = 0.0
         else:
-            perf = (stats.wins + 0.333*stats.draws)/num_games
+            perf = (stats.wins + self.drawFactor*stats.draws)/num_games
         return int(1000*self.getScore(perf, num_games))
 
+    def updatePoints(self, points, stats, outcome, opponentPoints):
+        """
+        Return new points of a player after a match.
+        stats must already include this match (see
+        ProfileLogic.recordMatch), outcome is one of WIN, DRAW, LOSS
+        and opponentPoints are average points of the opponents
+        before the match. O(1): the performance curve only
+        needs the cached counters.
+        """
+        return self.getPoints(stats)
+
     def getDivision(self, points):
         """
         Calculate division, based on number of points
         """
-        for division, threshold in enumerate([250,450,600,750]):
+        for division, threshold in enumerate(DIVISION_THRESHOLDS):
             if points < threshold:
                 return division
-        return 4
+        return len(DIVISION_THRESHOLDS)
+
+    def getPointsArray(self, wins, draws, losses):
+        """
+        Vectorized getPoints: takes equal-length sequences of
+        wins, draws and losses and returns a sequence of points.
+        Uses NumPy, if available.
+        """
+        if numpy is None:
+            return [self.getPoints(_Counts(w, d, l))
+                    for w, d, l in zip(wins, draws, losses)]
+        wins = numpy.asarray(wins, dtype=numpy.float64)
+        draws = numpy.asarray(draws, dtype=numpy.float64)
+        num_games = wins + draws + numpy.asarray(losses, dtype=numpy.float64)
+        perf = numpy.where(num_games > 0,
+            (wins + self.drawFactor*draws)/numpy.maximum(num_games, 1), 0.0)
+        score = self.w2 + self.w1*perf*perf + self.w2*(
+            -numpy.exp(-num_games*0.05))
+        return (1000*score).astype(numpy.int64)
+
+    def getDivisionArray(self, points):
+        """
+        Vectorized getDivision
+        """
+        if numpy is None:
+            return [self.getDivision(p) for p in points]
+        return numpy.searchsorted(
+            DIVISION_THRESHOLDS, numpy.asarray(points), side='right')
+
+
+class EloRatingMath(RatingMath):
+    """
+    Elo-style rating: points move by k*(outcome - expected)
+    after each match, where expected outcome is derived from
+    the difference between player's and opponents' points.
+    Points depend on the order of matches, so they cannot be
+    re-computed from aggregates.
+    """
+
+    fromAggregates = False
+
+    def __init__(self, k=32, scale=400.0, initial=500):
+        RatingMath.__init__(self, *DEFAULT_WEIGHTS)
+        self.k = k
+        self.scale = scale
+        self.initial = initial
+
+    def fromConfig(cls, ratingConfig):
+        return cls(ratingConfig.get('k', 32),
+                   ratingConfig.get('scale', 400.0),
+                   ratingConfig.get('initial', 500))
+    fromConfig = classmethod(fromConfig)
+
+    def updatePoints(self, points, stats, outcome, opponentPoints):
+        games = stats.wins + stats.draws + stats.losses
+        if games <= 1 and points == 0:
+            points = self.initial
+        expected = 1.0/(1.0 + 10.0**((opponentPoints - points)/self.scale))
+        return max(0, int(round(points + self.k*(outcome - expected))))
+
+
+ENGINES = {
+    'performance': RatingMath,
+    'elo': EloRatingMath,
+}
+
+
+class _Counts:
+
+    def __init__(self, wins, draws, losses):
+        self.wins = wins
+        self.draws = draws
+        self.losses = losses
 
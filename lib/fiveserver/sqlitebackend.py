@@ -0,0 +1,134 @@
+"""
+SQLite storage backend.
+
+A DB-API module that adbapi.ConnectionPool can use instead of
+MySQLdb: it runs the MySQL-flavoured SQL of the data layer on
+SQLite, translating what differs (placeholders, upserts). Files
+are opened in WAL mode, so that readers do not wait for the
+writer. With memory=True, the database lives in memory only,
+shared by all connections of the process, for benchmarks and
+throw-away servers.
+"""
+
+from datetime import datetime
+import re
+import sqlite3
+
+
+apilevel = '2.0'
+threadsafety = 1
+paramstyle = 'format' # as MySQLdb: translated to qmark
+
+Error = sqlite3.Error
+DatabaseError = sqlite3.DatabaseError
+OperationalError = sqlite3.OperationalError
+IntegrityError = sqlite3.IntegrityError
+InterfaceError = sqlite3.InterfaceError
+ProgrammingError = sqlite3.ProgrammingError
+
+BUSY_TIMEOUT = 30 # seconds to wait for the write lock
+
+# memory databases disappear with their last connection:
+# one connection per database is kept open here
+_keepers = dict()
+_translated = dict()
+
+
+def _convertTimestamp(value):
+    return datetime.fromisoformat(value.decode('ascii'))
+
+sqlite3.register_converter('timestamp', _convertTimestamp)
+
+
+def translate(sql):
+    """
+    Return SQLite version of a MySQL statement
+    """
+    try: return _translated[sql]
+    except KeyError:
+        pass
+    result = sql.replace('%s', '?')
+    # MySQL upsert fires on any unique key, just as
+    # SQLite upsert without conflict target does
+    result = re.sub(r'\bON DUPLICATE KEY UPDATE\b',
+                    'ON CONFLICT DO UPDATE SET', result, flags=re.I)
+    result = re.sub(r'\bVALUES\((\w+)\)', r'excluded.\1', result,
+                    flags=re.I)
+    result = re.sub(r'\bGREATEST\(', 'MAX(', result, flags=re.I)
+    _translated[sql] = result
+    return result
+
+
+class Cursor:
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, args=None):
+        return self._cursor.execute(translate(sql), tuple(args or ()))
+
+    def executemany(self, sql, seq):
+        return self._cursor.executemany(
+            translate(sql), [tuple(args) for args in seq])
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class Connection:
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        return Cursor(self._conn.cursor())
+
+    def autocommit(self, on):
+        """
+        Same as MySQLdb: used by command-line tools
+        """
+        if on:
+            self._conn.isolation_level = None
+        else:
+            self._conn.isolation_level = ''
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def _open(path, memory):
+    if memory:
+        database = 'file:%s?mode=memory&cache=shared' % path
+    else:
+        database = path
+    conn = sqlite3.connect(database, uri=memory, timeout=BUSY_TIMEOUT,
+        check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+    if not memory:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
+
+
+def connect(path, memory=False):
+    """
+    DB-API connect: path of the database file,
+    or name of the memory database
+    """
+    if memory and path not in _keepers:
+        _keepers[path] = _open(path, memory)
+    return Connection(_open(path, memory))
+
+
+def createSchema(path, memory=False, schemaFile=None):
+    """
+    Create tables from the schema file, unless they
+    exist already
+    """
+    conn = connect(path, memory)
+    try:
+        with open(schemaFile) as f:
+            conn.executescript(f.read())
+        conn.commit()
+    finally:
+        conn.close()
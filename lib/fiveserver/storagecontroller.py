@@ -1,104 +1,408 @@
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, error as netError
 from twisted.enterprise import adbapi
 
+from collections import deque
+import functools
+import sqlite3
 from time import time
-from random import uniform
-from fiveserver import log
+from random import choice
+from fiveserver import log, dbstats, cache, errors
 
 
 KEEPALIVE_QUERY = "SELECT (1)"
 KEEPALIVE_INTERVAL = 60
 MIN_KEEPALIVE_INTERVAL = 15
-REFRESH_WEIGHTS = 60 # once per minute
+
+EWMA_ALPHA = 0.2 # weight of the newest latency sample
+DEFAULT_LATENCY = 0.005 # seconds, assumed until measured
+EJECT_AFTER_ERRORS = 3 # consecutive connection errors
+EJECT_SECONDS = 5 # first ejection, doubles on each failed probe
+MAX_EJECT_SECONDS = 300
+HEALTHCHECK_TICK = 1 # seconds
+READ_YOUR_WRITES_SECONDS = 5 # reads of recently written data go to primary
+RECENT_WRITES_SWEEP = 1000 # writes between sweeps of expired pins
+GROUP_COMMIT_MAX_WRITES = 200 # writes per group-commit transaction
+POOL_CLASSES = ['interactive', 'matches', 'admin', 'batch']
+DEFAULT_POOL_CLASS = 'interactive'
+POOL_CLASS_QUEUE_LIMIT = 1000
+
+BACKENDS = ['mysql', 'sqlite', 'memory']
+DRIVERS = ['adbapi', 'aiomysql'] # for mysql backend
+
+# MySQL client errors: can't connect (2002, 2003), server has
+# gone away (2006), lost connection (2013, 2055). Deadlocks, lock
+# wait timeouts, etc. are OperationalErrors too, but the server
+# is fine.
+CONNECTION_ERROR_CODES = [2002, 2003, 2006, 2013, 2055]
+
+
+def isConnectionError(error):
+    """
+    Return True if the failure means that the connection or
+    the server is gone, and not that the query failed. SQLite
+    has no server: "database is locked" is not such an error.
+    """
+    value = error.value
+    if isinstance(value, (adbapi.ConnectionLost, netError.ConnectionLost)):
+        return True
+    if isinstance(value, sqlite3.Error):
+        return False
+    try: code = value.args[0]
+    except (AttributeError, IndexError):
+        return False
+    return code in CONNECTION_ERROR_CODES
+
+
+def parseServer(server, port):
+    """
+    Split "host:port" server spec. Several stand-in databases
+    on one machine can then be listed as 127.0.0.1:3307, etc.
+    """
+    host, sep, serverPort = str(server).partition(':')
+    if sep:
+        return host, int(serverPort)
+    return host, port
 
 
 def getDbPool(db_servers, user, passwd, db, port=3306, reconnect=True,
-              min_connections=3, max_connections=5):
+              min_connections=3, max_connections=5, driver='adbapi'):
     """
-    Return a sequence of MySQL ConnectionPools.
+    Return a sequence of MySQL ConnectionPools. With "aiomysql"
+    driver, these are asyncio-native pools (see aiopool), which
+    need Twisted's asyncio reactor.
     """
-    return [
-        adbapi.ConnectionPool("MySQLdb", db=db,
-                              host=db_server, user=user, passwd=passwd,
-                              charset='utf8', use_unicode=True, port=port,
+    if driver == 'aiomysql':
+        from fiveserver import aiopool
+    pools = []
+    for db_server in db_servers:
+        host, serverPort = parseServer(db_server, port)
+        if driver == 'aiomysql':
+            pools.append(aiopool.AioConnectionPool(host, serverPort,
+                user, passwd, db, min_connections=min_connections,
+                max_connections=max_connections))
+            continue
+        pools.append(
+            adbapi.ConnectionPool("MySQLdb", db=db,
+                              host=host, user=user, passwd=passwd,
+                              charset='utf8', use_unicode=True,
+                              port=serverPort,
                               cp_reconnect=reconnect,
                               cp_min=min_connections,
-                              cp_max=max_connections)
-        for db_server in db_servers]
+                              cp_max=max_connections))
+    return pools
+
+
+def getSqlitePool(path, memory=False, max_connections=5):
+    """
+    Return a sequence with one SQLite ConnectionPool.
+    Memory databases get one connection: with shared cache,
+    SQLite does not wait for locks, it fails right away.
+    """
+    if memory:
+        max_connections = 1
+    return [adbapi.ConnectionPool("fiveserver.sqlitebackend",
+                                  path, memory=memory,
+                                  cp_min=1, cp_max=max_connections)]
+
+
+def getPoolName(pool):
+    try: kw = pool.connkw
+    except AttributeError:
+        return repr(pool)
+    if pool.dbapiName == 'fiveserver.sqlitebackend':
+        if kw.get('memory'):
+            return 'memory:%s' % pool.connargs[0]
+        return 'sqlite:%s' % pool.connargs[0]
+    if pool.dbapiName == 'aiomysql':
+        return 'aio:%s:%s' % (kw.get('host'), kw.get('port', 3306))
+    return '%s:%s' % (kw.get('host'), kw.get('port', 3306))
+
+
+def getInteractionName(interaction):
+    """
+    What slow-query log shows instead of sql for interactions
+    """
+    return 'interaction: %s' % getattr(
+        interaction, '__qualname__', repr(interaction))
 
 
 class WeightedPoolItem:
+    """
+    One database server: its connection pool and
+    the numbers used to decide whether to use it.
+    """
+
     def __init__(self, value):
         self.value = value
-        self._sum  = 1
-        self._count = 1
-        self._lastRefresh = time()
-        
+        self.name = getPoolName(value)
+        self.latency = None # EWMA, seconds
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutiveErrors = 0
+        self.ejectedUntil = None
+        self.ejectSeconds = EJECT_SECONDS
+        self.ejections = 0
+        self.lastUsed = time()
+
+    def isEjected(self):
+        return self.ejectedUntil is not None
+
     def getWeight(self):
-        return self._sum/self._count
+        """
+        Expected wait for one more request
+        """
+        latency = self.latency
+        if latency is None:
+            latency = DEFAULT_LATENCY
+        return (self.outstanding + 1) * latency
+
+    def startRequest(self):
+        self.outstanding += 1
+        self.requests += 1
+        self.lastUsed = time()
 
     def addStat(self, stat):
-        if REFRESH_WEIGHTS < self._lastRefresh - time():
-            self._sum = stat
-            self._count = 1
+        self.outstanding = max(0, self.outstanding - 1)
+        self.consecutiveErrors = 0
+        if self.latency is None:
+            self.latency = stat
+        else:
+            self.latency += EWMA_ALPHA * (stat - self.latency)
+
+    def addError(self, error):
+        self.outstanding = max(0, self.outstanding - 1)
+        self.errors += 1
+        if not isConnectionError(error):
             return
+        self.consecutiveErrors += 1
+        if not self.isEjected() and \
+                self.consecutiveErrors >= EJECT_AFTER_ERRORS:
+            self.eject()
 
-        self._sum+= stat
-        self._count+= 1
+    def eject(self):
+        self.ejectedUntil = time() + self.ejectSeconds
+        self.ejections += 1
+        log.msg('WARN: DB server %s ejected for %d seconds' % (
+            self.name, self.ejectSeconds))
+        self.ejectSeconds = min(MAX_EJECT_SECONDS, self.ejectSeconds*2)
+
+    def restore(self):
+        log.msg('NOTICE: DB server %s is back' % self.name)
+        self.ejectedUntil = None
+        self.ejectSeconds = EJECT_SECONDS
+        self.consecutiveErrors = 0
 
 
 class WeightedPool:
+    """
+    Picks the server with the least expected wait: number of
+    outstanding requests times EWMA latency. Ejected servers
+    get no requests, unless all of them are ejected.
+    """
+
     def __init__(self, items):
         self._items = []
         for item in items:
             self._items.append(WeightedPoolItem(item))
 
-    def weightedChoice(self, choices):
-        sumWeight = 0
-        for choice, (cumulative, count) in choices.items():
-            sumWeight+= cumulative/count
+    def getItems(self):
+        return list(self._items)
 
     def getPoolItem(self):
         if 0==len(self._items):
             log.msg('WARN: item requested from an empty pool')
-            raise Exception()
-        sumWeight = 0
-        for item in self._items:
-            sumWeight+= item.getWeight()
-        n = uniform(0, sumWeight)
-        for item in self._items:
-            if n < sumWeight:
-                break
-            n = n - item.getWeight()
-        return item
-        
-
-class KeepAliveManager:
+            raise Exception('empty DB pool')
+        candidates = [item for item in self._items if not item.isEjected()]
+        if not candidates:
+            # nothing healthy: try the one to be re-probed first
+            return min(self._items, key=lambda item: item.ejectedUntil)
+        if len(candidates) == 1:
+            return candidates[0]
+        best = min(item.getWeight() for item in candidates)
+        return choice([item for item in candidates
+                       if item.getWeight() == best])
+
+
+class PoolClass:
+    """
+    Admission gate of one workload (pool class), e.g. logins
+    or batch jobs: at most "size" of its DB calls run at once,
+    others wait in line, and beyond queueLimit waiting calls
+    fail at once with DatabaseBusyError. While sizes of all
+    classes add up to no more than the connection pool, one
+    class cannot hold up another.
+    """
+
+    def __init__(self, name, size, queueLimit=POOL_CLASS_QUEUE_LIMIT):
+        self.name = name
+        self.size = size
+        self.queueLimit = queueLimit
+        self.running = 0
+        self.calls = 0
+        self.waits = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+        self.maxQueueDepth = 0
+        self.rejected = 0
+        self._waiting = deque()
+        self._dispatching = False
+
+    def getQueueDepth(self):
+        return len(self._waiting)
+
+    def getAverageWait(self):
+        if self.waits == 0:
+            return 0.0
+        return self.totalWait / self.waits
+
+    def run(self, f, *args, **kw):
+        self.calls += 1
+        if self.running < self.size and not self._waiting:
+            return self._start(f, args, kw)
+        if len(self._waiting) >= self.queueLimit:
+            self.rejected += 1
+            return defer.fail(errors.DatabaseBusyError(
+                'DB pool class "%s" is busy: %d calls waiting' % (
+                self.name, len(self._waiting))))
+        d = defer.Deferred()
+        self._waiting.append((time(), d, f, args, kw))
+        self.maxQueueDepth = max(self.maxQueueDepth, len(self._waiting))
+        return d
+
+    def _start(self, f, args, kw):
+        self.running += 1
+        d = defer.maybeDeferred(f, *args, **kw)
+        d.addBoth(self._done)
+        return d
+
+    def _done(self, result):
+        self.running -= 1
+        self._dispatch()
+        return result
+
+    def _dispatch(self):
+        # a loop, not recursion: calls that finish at once
+        # (e.g. cache hits) must not grow the stack
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            while self._waiting and self.running < self.size:
+                queuedAt, d, f, args, kw = self._waiting.popleft()
+                waited = time() - queuedAt
+                self.waits += 1
+                self.totalWait += waited
+                self.maxWait = max(self.maxWait, waited)
+                self._start(f, args, kw).chainDeferred(d)
+        finally:
+            self._dispatching = False
+
+
+def gated(method):
+    """
+    Decorator of StorageController calls: the call goes through
+    the gate of the pool class given as "poolClass" keyword
+    argument, when pool classes are configured
+    """
+    @functools.wraps(method)
+    def _gated(self, *args, poolClass=DEFAULT_POOL_CLASS, **kw):
+        gate = self.getPoolClass(poolClass)
+        if gate is None:
+            return method(self, *args, **kw)
+        return gate.run(method, self, *args, **kw)
+    return _gated
+
+
+class HealthCheckManager:
+    """
+    Keeps idle connections alive and brings ejected servers
+    back: once the ejection time is over, a server is probed,
+    and it gets traffic again only if the probe succeeds.
+    """
+
     def __init__(self, storageController, interval=KEEPALIVE_INTERVAL,
                  query=KEEPALIVE_QUERY):
         self.storageController = storageController
         self.interval = interval
         self.query = query
-        
+        self._probing = set()
+
     def start(self):
-        reactor.callLater(self.interval, self._keepAlive)
-        
-    def _keepAlive(self):
-        log.debug(
-            'DEBUG: KeepAliveManager:: keep-alive query: %s' % self.query)
-        for item in self.storageController.readPool._items:
-            item.value.runQuery(self.query)
-        if self.storageController.writePool is not \
-                self.storageController.readPool:
-            for item in self.storageController.writePool._items:
-                item.value.runQuery(self.query)
+        reactor.callLater(HEALTHCHECK_TICK, self._check)
+
+    def getItems(self):
+        items = []
+        for controller in self.storageController.getControllers():
+            items.extend(controller.readPool.getItems())
+            if controller.writePool is not controller.readPool:
+                items.extend(controller.writePool.getItems())
+        return items
+
+    def _check(self):
+        now = time()
+        for item in self.getItems():
+            if item in self._probing:
+                continue
+            if item.isEjected():
+                if item.ejectedUntil <= now:
+                    self.probe(item)
+            elif now - item.lastUsed >= self.interval:
+                self.probe(item)
         self.start()
-            
+
+    def probe(self, item):
+        def _ok(result):
+            self._probing.discard(item)
+            item.addStat(time()-startTime)
+            if item.isEjected():
+                item.restore()
+        def _failed(error):
+            self._probing.discard(item)
+            item.addError(error)
+            log.msg('WARN: DB server %s probe failed: %s' % (
+                item.name, error.value))
+            if item.isEjected():
+                item.eject()
+        log.debug(
+            'DEBUG: HealthCheckManager:: probe %s: %s' % (
+            item.name, self.query))
+        self._probing.add(item)
+        startTime = time()
+        item.startRequest()
+        d = item.value.runQuery(self.query)
+        d.addCallbacks(_ok, _failed)
+        return d
+
 
 class StorageController:
+    """
+    Routes writes to the write servers and reads to the read
+    servers (replicas). Writes can "pin" what they change, e.g.
+    pin=('profile', 1001), or a list of such keys: for the next
+    readYourWritesSeconds, reads with the same pin go to the write
+    servers, so that replication lag never hides a fresh write
+    from the server that made it. Reads can also ask for the
+    write servers explicitly, with primary=True.
+    The "key" argument of all calls labels the call site, e.g.
+    'profile.get': counts, latencies and errors are kept per
+    label in queryStats, and slow queries are logged.
+    Reads of the labels enabled in queryCache (cache.QueryCache)
+    are answered from memory while no write touched their tables.
+    With groupCommitSeconds, writes (dbWrite, dbInsert) submitted
+    within that window are executed in one transaction, so that
+    they share one commit.
+    All calls take a "poolClass" argument: the workload they
+    belong to. With poolClasses, each class gets its own share
+    of the connections (see PoolClass).
+    """
     name = 'StorageController'
-    
-    def __init__(self, readPool=None, writePool=None):
+    shardCount = 1
+
+    def __init__(self, readPool=None, writePool=None,
+                 readYourWritesSeconds=READ_YOUR_WRITES_SECONDS,
+                 slowQuerySeconds=dbstats.SLOW_QUERY_SECONDS,
+                 queryCache=None, groupCommitSeconds=0, poolClasses=None):
         if readPool is None: readPool = []
         self.readPool = WeightedPool(readPool)
         if readPool is writePool:
@@ -106,82 +410,494 @@ class StorageController:
         else:
             if writePool is None: writePool = []
             self.writePool = WeightedPool(writePool)
+        self.readYourWritesSeconds = readYourWritesSeconds
+        self._recentWrites = dict()
+        self._writesSinceSweep = 0
+        self.queryStats = dbstats.QueryStats(slowQuerySeconds)
+        self.queryCache = queryCache
+        self.groupCommitSeconds = groupCommitSeconds
+        self._pendingWrites = []
+        self._flushCall = None
+        self.poolClasses = dict(
+            (poolClass.name, poolClass) for poolClass in poolClasses or [])
+
+    def _getPins(self, pin):
+        if pin is None:
+            return []
+        if isinstance(pin, list):
+            return pin
+        return [pin]
+
+    def _markWritten(self, pin):
+        if self.writePool is self.readPool or not self.readYourWritesSeconds:
+            return
+        until = time() + self.readYourWritesSeconds
+        for p in self._getPins(pin):
+            self._recentWrites[p] = until
+        self._writesSinceSweep += 1
+        if self._writesSinceSweep >= RECENT_WRITES_SWEEP:
+            self._sweepRecentWrites()
+
+    def _sweepRecentWrites(self):
+        now = time()
+        for p, until in list(self._recentWrites.items()):
+            if until <= now:
+                del self._recentWrites[p]
+        self._writesSinceSweep = 0
+
+    def isPinned(self, pin):
+        """
+        Return True, if something with the given pin
+        has been written recently
+        """
+        now = time()
+        for p in self._getPins(pin):
+            try: until = self._recentWrites[p]
+            except KeyError:
+                continue
+            if until > now:
+                return True
+            del self._recentWrites[p]
+        return False
+
+    def getControllers(self):
+        return [self]
+
+    def getPoolClass(self, name):
+        """
+        Return gate of the pool class, or of the default class,
+        if that one is not configured. None means no gate.
+        """
+        try: return self.poolClasses[name]
+        except KeyError:
+            return self.poolClasses.get(DEFAULT_POOL_CLASS)
 
-    def dbWrite(self, key, sqlQuery, *args):
+    def getShardIndex(self, id):
+        return 0
+
+    def groupByShard(self, ids):
+        """
+        Return dict: shard index -> list of ids on that shard
+        """
+        return {0: list(ids)}
+
+    def _getReadPool(self, pin, primary):
+        if primary or self.isPinned(pin):
+            return self.writePool
+        return self.readPool
+
+    def _record(self, key, sqlQuery, poolItem, startTime, error=False):
+        elapsed = time()-startTime
+        self.queryStats.record(
+            key, sqlQuery, elapsed, poolItem.name, error)
+        return elapsed
+
+    @gated
+    def dbWrite(self, key, sqlQuery, *args, pin=None, shard=None):
+        if self.groupCommitSeconds:
+            return self._queueWrite(False, key, sqlQuery, args, pin)
+        return self._dbWrite(False, key, sqlQuery, args, pin)
+
+    @gated
+    def dbInsert(self, key, sqlQuery, *args, pin=None, shard=None):
+        if self.groupCommitSeconds:
+            return self._queueWrite(True, key, sqlQuery, args, pin)
+        return self._dbWrite(True, key, sqlQuery, args, pin)
+
+    def _dbWrite(self, isInsert, key, sqlQuery, args, pin):
         startTime = time()
         poolItem = self.writePool.getPoolItem()
         #log.msg('dbWrite-DEBUG: sql: %s' % sqlQuery)
         #log.msg('dbWrite-DEBUG: args: %s' % str(args))
-        d = poolItem.value.runQuery(sqlQuery, args)
-        d.addCallback(self.dbWriteSuccess, poolItem, startTime)
-        d.addErrback(self.dbWriteError, poolItem, startTime)
+        self._markWritten(pin)
+        poolItem.startRequest()
+        if isInsert:
+            d = poolItem.value.runInteraction(self._insert, sqlQuery, args)
+        else:
+            d = poolItem.value.runQuery(sqlQuery, args)
+        d.addCallback(self.dbWriteSuccess, poolItem, startTime,
+                      key, sqlQuery, pin)
+        d.addErrback(self.dbWriteError, poolItem, startTime, key, sqlQuery)
+        if self.queryCache is not None:
+            d.addBoth(self._invalidate, cache.getTables(sqlQuery))
         return d
-        
-    def dbWriteSuccess(self, results, poolItem, startTime):
-        poolItem.addStat(time()-startTime)
+
+    def dbWriteSuccess(self, results, poolItem, startTime,
+                       key, sqlQuery, pin=None):
+        poolItem.addStat(self._record(key, sqlQuery, poolItem, startTime))
+        # replication of the write only starts now
+        self._markWritten(pin)
         return results
 
-    def dbInsert(self, key, sqlQuery, *args):
+    def _queueWrite(self, isInsert, key, sqlQuery, args, pin):
+        d = defer.Deferred()
+        self._markWritten(pin)
+        self._pendingWrites.append(
+            (isInsert, key, sqlQuery, args, pin, d, time()))
+        if len(self._pendingWrites) >= GROUP_COMMIT_MAX_WRITES:
+            self.flushWrites()
+        elif self._flushCall is None:
+            self._flushCall = reactor.callLater(
+                self.groupCommitSeconds, self.flushWrites)
+        if self.queryCache is not None:
+            d.addBoth(self._invalidate, cache.getTables(sqlQuery))
+        return d
+
+    def flushWrites(self):
+        """
+        Execute queued writes in one transaction
+        """
+        if self._flushCall is not None:
+            if self._flushCall.active():
+                self._flushCall.cancel()
+            self._flushCall = None
+        writes, self._pendingWrites = self._pendingWrites, []
+        if not writes:
+            return
         startTime = time()
         poolItem = self.writePool.getPoolItem()
-        #log.msg('dbInsert-DEBUG: sql: %s' % sqlQuery)
-        #log.msg('dbInsert-DEBUG: args: %s' % str(args))
-        d = poolItem.value.runInteraction(self._insert, sqlQuery, args)
-        d.addCallback(self.dbWriteSuccess, poolItem, startTime)
-        d.addErrback(self.dbWriteError, poolItem, startTime)
-        return d
-    
+        poolItem.startRequest()
+        d = poolItem.value.runInteraction(self._writeGroup, writes)
+        d.addCallbacks(self._groupCommitted, self._groupFailed,
+            callbackArgs=(writes, poolItem, startTime),
+            errbackArgs=(writes, poolItem, startTime))
+
+    def _writeGroup(self, trans, writes):
+        results = []
+        for isInsert, key, sqlQuery, args, pin, d, queuedAt in writes:
+            trans.execute(sqlQuery, args)
+            if isInsert:
+                results.append(trans.lastrowid)
+            else:
+                results.append(trans.fetchall())
+        return results
+
+    def _groupCommitted(self, results, writes, poolItem, startTime):
+        poolItem.addStat(time() - startTime)
+        for (isInsert, key, sqlQuery, args, pin, d, queuedAt), result in \
+                zip(writes, results):
+            # each write waited for the whole group
+            self.queryStats.record(
+                key, sqlQuery, time() - queuedAt, poolItem.name)
+            self._markWritten(pin)
+            d.callback(result)
+
+    def _groupFailed(self, error, writes, poolItem, startTime):
+        poolItem.addError(error)
+        if isConnectionError(error):
+            # whether it was committed is unknown: same as
+            # for a single write, the callers have to know
+            log.msg('ALERT: group commit of %d writes failed: %s '
+                    '(type: %s, server: %s)' % (
+                    len(writes), error.value, error.value.__class__,
+                    poolItem.name))
+            for isInsert, key, sqlQuery, args, pin, d, queuedAt in writes:
+                self.queryStats.record(key, sqlQuery, time() - queuedAt,
+                    poolItem.name, error=True)
+                d.errback(error)
+            return
+        # the transaction was rolled back (bad write, deadlock,
+        # lock wait timeout): write them one by one, each with
+        # its own result
+        log.msg('WARN: group commit of %d writes failed: %s. '
+                'Writing them one by one' % (len(writes), error.value))
+        for isInsert, key, sqlQuery, args, pin, d, queuedAt in writes:
+            self._dbWrite(isInsert, key, sqlQuery, args, pin).chainDeferred(d)
+
     def _insert(self, trans, query, query_args):
         trans.execute(query,query_args)
-        trans.execute('SELECT LAST_INSERT_ID()')
-        data = trans.fetchall()
-        lastInsertID = data[0][0]
-        return lastInsertID
-    
-    def dbRead(self, key, sqlQuery, *args):
+        return trans.lastrowid
+
+    @gated
+    def dbRead(self, key, sqlQuery, *args,
+               pin=None, primary=False, shard=None):
+        queryCache = self.queryCache
+        if queryCache is not None and queryCache.isCached(key):
+            results = queryCache.get(key, sqlQuery, args)
+            if results is not None:
+                return defer.succeed(results)
+            generations = queryCache.getGenerations(
+                cache.getTables(sqlQuery))
         startTime = time()
-        poolItem = self.readPool.getPoolItem()
+        pool = self._getReadPool(pin, primary)
+        poolItem = pool.getPoolItem()
         #log.msg('dbRead-DEBUG: sql: %s' % sqlQuery)
         #log.msg('dbRead-DEBUG: args: %s' % str(args))
+        poolItem.startRequest()
         d = poolItem.value.runQuery(sqlQuery, args)
-        d.addCallback(self.dbReadSuccess, poolItem, startTime)
-        d.addErrback(self.dbReadError, poolItem, startTime)
+        d.addCallback(self.dbReadSuccess, poolItem, startTime,
+                      key, sqlQuery)
+        d.addErrback(self.dbReadError, poolItem, startTime, key, sqlQuery)
+        if queryCache is not None and queryCache.isCached(key):
+            d.addCallback(self._cacheResults, key, sqlQuery, args,
+                          generations, pool is not self.writePool)
         return d
 
-    def dbReadSuccess(self, results, poolItem, startTime):
-        poolItem.addStat(time()-startTime)
+    def _cacheResults(self, results, key, sqlQuery, args,
+                      generations, fromReplica):
+        # a replica may not have caught up with recent writes yet
+        if not (fromReplica and self.queryCache.changedWithin(
+                cache.getTables(sqlQuery), self.readYourWritesSeconds)):
+            self.queryCache.put(key, sqlQuery, args, results, generations)
         return results
 
-    def dbReadInteraction(self, key, interaction, *args):
+    def _invalidate(self, result, tables):
+        self.queryCache.invalidate(tables)
+        return result
+
+    def dbReadSuccess(self, results, poolItem, startTime, key, sqlQuery):
+        poolItem.addStat(self._record(key, sqlQuery, poolItem, startTime))
+        return results
+
+    @gated
+    def dbReadInteraction(self, key, interaction, *args,
+                          pin=None, primary=False, shard=None):
         startTime = time()
-        poolItem = self.writePool.getPoolItem()
+        poolItem = self._getReadPool(pin, primary).getPoolItem()
+        poolItem.startRequest()
         d = poolItem.value.runInteraction(interaction, *args)
-        d.addCallback(self.dbReadSuccess, poolItem, startTime)
-        d.addErrback(self.dbReadError, poolItem, startTime)
+        sqlQuery = getInteractionName(interaction)
+        d.addCallback(self.dbReadSuccess, poolItem, startTime,
+                      key, sqlQuery)
+        d.addErrback(self.dbReadError, poolItem, startTime, key, sqlQuery)
         return d
 
-    def dbWriteInteraction(self, key, interaction, *args):
+    @gated
+    def dbReadBatch(self, key, statements,
+                    pin=None, primary=False, shard=None):
+        """
+        Run several independent reads, given as a list of
+        (sql, args) pairs, one after another on one connection:
+        one pool round-trip instead of one per statement.
+        Return list of result sets, in the same order.
+        """
+        startTime = time()
+        poolItem = self._getReadPool(pin, primary).getPoolItem()
+        poolItem.startRequest()
+        d = poolItem.value.runInteraction(self._readBatch, statements)
+        sqlQuery = '; '.join(sql for sql, args in statements)
+        d.addCallback(self.dbReadSuccess, poolItem, startTime,
+                      key, sqlQuery)
+        d.addErrback(self.dbReadError, poolItem, startTime, key, sqlQuery)
+        return d
+
+    def _readBatch(self, trans, statements):
+        results = []
+        for sql, args in statements:
+            trans.execute(sql, args)
+            results.append(trans.fetchall())
+        return results
+
+    @gated
+    def dbWriteInteraction(self, key, interaction, *args,
+                           pin=None, shard=None):
         startTime = time()
         poolItem = self.writePool.getPoolItem()
-        d = poolItem.value.runInteraction(interaction, *args)
-        d.addCallback(self.dbWriteSuccess, poolItem, startTime)
-        d.addErrback(self.dbWriteError, poolItem, startTime)
+        self._markWritten(pin)
+        poolItem.startRequest()
+        sqlQuery = getInteractionName(interaction)
+        if self.queryCache is not None:
+            tracker = []
+            d = poolItem.value.runInteraction(
+                self._trackTables, tracker, interaction, *args)
+            d.addBoth(self._invalidateTracked, tracker)
+        else:
+            d = poolItem.value.runInteraction(interaction, *args)
+        d.addCallback(self.dbWriteSuccess, poolItem, startTime,
+                      key, sqlQuery, pin)
+        d.addErrback(self.dbWriteError, poolItem, startTime, key, sqlQuery)
         return d
 
+    def _trackTables(self, trans, tracker, interaction, *args):
+        tracker.append(cache.TableTracker(trans))
+        return interaction(tracker[0], *args)
+
+    def _invalidateTracked(self, result, tracker):
+        if tracker:
+            self.queryCache.invalidate(tracker[0].tables)
+        return result
+
     def error(self, error):
         log.msg('ERROR: error in DB retrieval: %s' % error.value)
         error.raiseException()
 
-    def dbReadError(self, error, startTime, poolItem):
+    def dbReadError(self, error, poolItem, startTime, key, sqlQuery):
+        poolItem.addError(error)
+        self._record(key, sqlQuery, poolItem, startTime, error=True)
         log.msg(
-            'ALERT: dbReadError: %s (type: %s)' % (
-            error.value, error.value.__class__))
+            'ALERT: dbReadError [%s]: %s (type: %s, server: %s)' % (
+            key, error.value, error.value.__class__, poolItem.name))
         return error
 
-    def dbWriteError(self, error, startTime, poolItem):
+    def dbWriteError(self, error, poolItem, startTime, key, sqlQuery):
+        poolItem.addError(error)
+        self._record(key, sqlQuery, poolItem, startTime, error=True)
         log.msg(
-            'ALERT: dbWriteError: %s (type: %s)' % (
-            error.value, error.value.__class__))
+            'ALERT: dbWriteError [%s]: %s (type: %s, server: %s)' % (
+            key, error.value, error.value.__class__, poolItem.name))
         log.msg(error.getTraceback())
         return error
 
+
+class ShardedStorageController:
+    """
+    Spreads the data over several shards, each one with its own
+    write and read servers (a StorageController). A user lives on
+    one shard, together with its profiles, their settings and
+    matches. The shard of a user or profile follows from its id:
+    (id - 1) % number of shards. For that, MySQL of every shard
+    must have auto_increment_increment set to the number of shards
+    and auto_increment_offset to the shard number (1, 2, ...),
+    which is checked by verify().
+
+    Calls take a "shard" argument: id of the user or profile
+    whose data is read or written. Reads without it go to all
+    shards, and rows of all shards are returned (scatter-gather).
+    Writes without it, i.e. inserts of new users, go to the
+    shards in turn.
+    """
+    name = 'ShardedStorageController'
+
+    def __init__(self, controllers):
+        self.controllers = list(controllers)
+        self.shardCount = len(self.controllers)
+        self._nextShard = 0
+
+    def getControllers(self):
+        return list(self.controllers)
+
+    def getShardIndex(self, id):
+        return (int(id) - 1) % self.shardCount
+
+    def groupByShard(self, ids):
+        """
+        Return dict: shard index -> list of ids on that shard
+        """
+        groups = dict()
+        for id in ids:
+            groups.setdefault(self.getShardIndex(id), []).append(id)
+        return groups
+
+    def _getController(self, shard):
+        if shard is None:
+            index = self._nextShard
+            self._nextShard = (index + 1) % self.shardCount
+            return self.controllers[index]
+        return self.controllers[self.getShardIndex(shard)]
+
+    def isPinned(self, pin):
+        for controller in self.controllers:
+            if controller.isPinned(pin):
+                return True
+        return False
+
+    def _scatter(self, method, *args, **kw):
+        ds = [getattr(controller, method)(*args, **kw)
+              for controller in self.controllers]
+        d = defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+        d.addCallbacks(self._gathered, self._scatterFailed)
+        return d
+
+    def _gathered(self, results):
+        rows = []
+        for success, result in results:
+            rows.extend(result)
+        return rows
+
+    def _gatheredBatch(self, results):
+        # result sets of every statement, from all shards
+        resultSets = None
+        for success, result in results:
+            if resultSets is None:
+                resultSets = [list(rows) for rows in result]
+            else:
+                for rows, shardRows in zip(resultSets, result):
+                    rows.extend(shardRows)
+        return resultSets
+
+    def _scatterFailed(self, error):
+        # failure of the first shard that failed
+        return error.value.subFailure
+
+    def dbRead(self, key, sqlQuery, *args, shard=None, **kw):
+        if shard is None:
+            return self._scatter('dbRead', key, sqlQuery, *args, **kw)
+        return self._getController(shard).dbRead(
+            key, sqlQuery, *args, **kw)
+
+    def dbReadInteraction(self, key, interaction, *args, shard=None, **kw):
+        if shard is None:
+            return self._scatter(
+                'dbReadInteraction', key, interaction, *args, **kw)
+        return self._getController(shard).dbReadInteraction(
+            key, interaction, *args, **kw)
+
+    def dbReadBatch(self, key, statements, shard=None, **kw):
+        if shard is None:
+            ds = [controller.dbReadBatch(key, statements, **kw)
+                  for controller in self.controllers]
+            d = defer.DeferredList(
+                ds, fireOnOneErrback=True, consumeErrors=True)
+            d.addCallbacks(self._gatheredBatch, self._scatterFailed)
+            return d
+        return self._getController(shard).dbReadBatch(
+            key, statements, **kw)
+
+    def dbWrite(self, key, sqlQuery, *args, shard=None, **kw):
+        return self._getController(shard).dbWrite(
+            key, sqlQuery, *args, **kw)
+
+    def dbInsert(self, key, sqlQuery, *args, shard=None, **kw):
+        return self._getController(shard).dbInsert(
+            key, sqlQuery, *args, **kw)
+
+    def dbWriteInteraction(self, key, interaction, *args, shard=None, **kw):
+        return self._getController(shard).dbWriteInteraction(
+            key, interaction, *args, **kw)
+
+    def flushWrites(self):
+        for controller in self.controllers:
+            controller.flushWrites()
+
+    @defer.inlineCallbacks
+    def verify(self):
+        """
+        Check auto-increment settings of all shards, which
+        keep ids of every shard on that shard. Return True
+        if all is well.
+        """
+        sql = 'SELECT @@auto_increment_increment, @@auto_increment_offset'
+        ok = True
+        for i, controller in enumerate(self.controllers):
+            rows = yield controller.dbRead('shard.verify', sql, primary=True)
+            increment, offset = int(rows[0][0]), int(rows[0][1])
+            if increment != self.shardCount or offset != i + 1:
+                log.msg(
+                    'ALERT: shard %d: auto_increment_increment=%d, '
+                    'auto_increment_offset=%d, expected %d and %d' % (
+                    i + 1, increment, offset, self.shardCount, i + 1))
+                ok = False
+        defer.returnValue(ok)
+
+    def verifyOrStop(self):
+        """
+        Verify shards once the reactor is running, and stop the
+        server if they are misconfigured or cannot be checked:
+        rows inserted meanwhile would get ids of other shards.
+        """
+        def _verified(ok):
+            if not ok:
+                log.msg('ALERT: shards are misconfigured. '
+                        'Stopping the server')
+                reactor.stop()
+            return ok
+        def _failed(error):
+            log.msg('ALERT: cannot verify shards: %s. '
+                    'Stopping the server' % error.value)
+            reactor.stop()
+            return False
+        def _verify():
+            d = self.verify()
+            d.addCallbacks(_verified, _failed)
+            return d
+        reactor.callWhenRunning(_verify)
@@ -0,0 +1,81 @@
+"""
+Offline maintenance tools. These talk to the database directly
+(DB-API, no Twisted) and are meant to be run from command line:
+
+    PYTHONPATH=./lib python3 -m fiveserver.tools.<tool> <server.yaml> ...
+"""
+
+import yaml
+
+
+def loadServerConfig(yamlFile):
+    inf = open(yamlFile)
+    cfg = yaml.load(inf.read(), Loader=yaml.SafeLoader)
+    inf.close()
+    return cfg or dict()
+
+
+def getShardConfigs(dbConfig):
+    """
+    Return list of DB configurations: one per shard, if "shards"
+    are configured, otherwise just the given one.
+    """
+    shards = dbConfig.get('shards')
+    if not shards:
+        return [dbConfig]
+    configs = []
+    for shard in shards:
+        shardConfig = dict(dbConfig)
+        del shardConfig['shards']
+        shardConfig['readServers'] = shard['readServers']
+        shardConfig['writeServers'] = shard['writeServers']
+        configs.append(shardConfig)
+    return configs
+
+
+def connect(dbConfig, host=None, replica=False):
+    """
+    Open DB-API connection to the database described by
+    "DB" section of server configuration. If host is not
+    given, the first of writeServers is used, or the first
+    of readServers, if replica is True: heavy reads should
+    go there. Hosts can be given as "host:port". With shards,
+    the first shard is used (see getShardConfigs). SQLite
+    and memory backends are supported too: the same SQL works.
+    """
+    backend = dbConfig.get('backend', 'mysql')
+    if backend != 'mysql':
+        from fiveserver import sqlitebackend
+        memory = backend == 'memory'
+        path = dbConfig.get('path') or dbConfig['name']
+        if dbConfig.get('schema'):
+            sqlitebackend.createSchema(path, memory, dbConfig['schema'])
+        return sqlitebackend.connect(path, memory)
+    import MySQLdb
+    dbConfig = getShardConfigs(dbConfig)[0]
+    if host is None:
+        if replica:
+            host = dbConfig['readServers'][0]
+        else:
+            host = dbConfig['writeServers'][0]
+    host, sep, port = str(host).partition(':')
+    if sep:
+        port = int(port)
+    else:
+        port = dbConfig.get('port', 3306)
+    return MySQLdb.connect(
+        host=host, user=dbConfig['user'], passwd=dbConfig['password'],
+        db=dbConfig['name'], port=port,
+        charset='utf8', use_unicode=True)
+
+
+def hasTable(conn, table):
+    cursor = conn.cursor()
+    try:
+        cursor.execute('SELECT 1 FROM %s LIMIT 1' % table)
+        cursor.fetchall()
+        return True
+    except Exception:
+        return False
+    finally:
+        cursor.close()
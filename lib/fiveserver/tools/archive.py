@@ -0,0 +1,212 @@
+"""
+Archive of old matches.
+
+Stats of a profile count every match it has ever played, so
+the stats queries get slower as matches pile up. This tool moves
+matches older than a few months out of the tables that the stats
+queries read: every profile gets one rollup row per month (games,
+wins, losses, draws, goals) and the raw rows go to the archive
+tables (matches_archive, plus matches_played_archive for PES6).
+Stats are raw matches plus rollups (see data.ROLLUPS_SQL), so
+they stay the same.
+
+Runs online, next to the server: matches are moved oldest first,
+in small batches, each in one short transaction, and the tool
+can be stopped and started again at any time. Totals are the same
+before and after every batch, so stats cached by the server stay
+valid. Streaks are not affected; PES6 "last teams" are taken from
+matches not archived yet.
+
+Usage:
+    python3 -m fiveserver.tools.archive ./etc/conf/sixserver.yaml \
+        [--months 3] [--batch-size 500] [--pause 0.05] [--dry-run]
+"""
+
+import argparse
+from datetime import date
+import sys
+import time
+
+from fiveserver.tools import loadServerConfig, connect, hasTable
+from fiveserver.tools import getShardConfigs
+
+
+COUNT_SQL = 'SELECT count(id) FROM matches WHERE played_on < %s'
+OLD_MATCHES_SQL = (
+    'SELECT id FROM matches WHERE played_on < %s ORDER BY id LIMIT %s')
+
+# one row per participant: (profile_id, home, score_home,
+# score_away, played_on)
+PARTICIPANTS_SQL_PES5 = (
+    'SELECT profile_id_home, 1, score_home, score_away, played_on '
+    'FROM matches WHERE id IN (%s) UNION ALL '
+    'SELECT profile_id_away, 0, score_home, score_away, played_on '
+    'FROM matches WHERE id IN (%s)')
+PARTICIPANTS_SQL_PES6 = (
+    'SELECT profile_id, home, score_home, score_away, played_on '
+    'FROM matches_played, matches '
+    'WHERE matches.id=match_id AND match_id IN (%s)')
+
+ROLLUPS_UPSERT_SQL = (
+    'INSERT INTO match_rollups (profile_id, month, games, wins, losses, '
+    'draws, goals_scored, goals_allowed) VALUES (%s,%s,%s,%s,%s,%s,%s,%s) '
+    'ON DUPLICATE KEY UPDATE games=games+VALUES(games), '
+    'wins=wins+VALUES(wins), losses=losses+VALUES(losses), '
+    'draws=draws+VALUES(draws), '
+    'goals_scored=goals_scored+VALUES(goals_scored), '
+    'goals_allowed=goals_allowed+VALUES(goals_allowed)')
+
+MATCH_COLUMNS_PES5 = (
+    'id, profile_id_home, profile_id_away, score_home, score_away, '
+    'team_id_home, team_id_away, played_on')
+MATCH_COLUMNS_PES6 = (
+    'id, score_home, score_away, team_id_home, team_id_away, played_on')
+PLAYED_COLUMNS = 'id, match_id, profile_id, home'
+
+
+def getCutoff(months, today=None):
+    """
+    Return first day of the month "months" months ago:
+    only whole months are rolled up
+    """
+    today = today or date.today()
+    year, month = today.year, today.month - months
+    while month <= 0:
+        month += 12
+        year -= 1
+    return '%04d-%02d-01 00:00:00' % (year, month)
+
+
+def rollUp(participants):
+    """
+    Return rollup rows for the given participant rows:
+    one per profile and month
+    """
+    rollups = dict()
+    for profileId, home, scoreHome, scoreAway, playedOn in participants:
+        if home:
+            scored, allowed = scoreHome, scoreAway
+        else:
+            scored, allowed = scoreAway, scoreHome
+        key = (profileId, playedOn.strftime('%Y-%m-01'))
+        try: values = rollups[key]
+        except KeyError:
+            values = rollups[key] = [0, 0, 0, 0, 0, 0]
+        values[0] += 1
+        if scored > allowed:
+            values[1] += 1
+        elif scored < allowed:
+            values[2] += 1
+        else:
+            values[3] += 1
+        values[4] += scored
+        values[5] += allowed
+    return [key + tuple(values) for key, values in rollups.items()]
+
+
+def archiveBatch(conn, isPes6, cutoff, batchSize):
+    """
+    Move one batch of old matches to the archive, in one
+    transaction. Return (matches moved, rollup rows written)
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute(OLD_MATCHES_SQL, (cutoff, batchSize))
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return 0, 0
+        marks = ','.join(['%s'] * len(ids))
+        if isPes6:
+            cursor.execute(PARTICIPANTS_SQL_PES6 % marks, ids)
+        else:
+            cursor.execute(PARTICIPANTS_SQL_PES5 % (marks, marks), ids*2)
+        rollups = rollUp(cursor.fetchall())
+        cursor.executemany(ROLLUPS_UPSERT_SQL, rollups)
+        if isPes6:
+            cursor.execute(
+                'INSERT INTO matches_played_archive (%s) SELECT %s '
+                'FROM matches_played WHERE match_id IN (%s)' % (
+                PLAYED_COLUMNS, PLAYED_COLUMNS, marks), ids)
+            cursor.execute(
+                'DELETE FROM matches_played WHERE match_id IN (%s)' % marks,
+                ids)
+            columns = MATCH_COLUMNS_PES6
+        else:
+            columns = MATCH_COLUMNS_PES5
+        cursor.execute(
+            'INSERT INTO matches_archive (%s) SELECT %s '
+            'FROM matches WHERE id IN (%s)' % (columns, columns, marks), ids)
+        cursor.execute('DELETE FROM matches WHERE id IN (%s)' % marks, ids)
+        conn.commit()
+        return len(ids), len(rollups)
+    except:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def rate(count, seconds):
+    if seconds <= 0:
+        return 'n/a'
+    return '%0.0f matches/sec' % (count/seconds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Roll up and archive old matches')
+    parser.add_argument('config', help='server configuration (yaml)')
+    parser.add_argument('--months', type=int, default=3,
+        help='number of recent months (besides the current one) '
+             'kept as raw matches')
+    parser.add_argument('--batch-size', type=int, default=500,
+        help='number of matches moved per transaction')
+    parser.add_argument('--pause', type=float, default=0.05,
+        help='seconds to wait between batches')
+    parser.add_argument('--dry-run', action='store_true',
+        help='only count the matches that would be archived')
+    args = parser.parse_args(argv)
+
+    cfg = loadServerConfig(args.config)
+    cutoff = getCutoff(args.months)
+    print('archiving matches played before %s' % cutoff)
+    total = 0
+    for shard, dbConfig in enumerate(getShardConfigs(cfg['DB'])):
+        conn = connect(dbConfig)
+        if not hasTable(conn, 'match_rollups'):
+            print('No match_rollups table: run the migrate tool first')
+            return 1
+        isPes6 = hasTable(conn, 'matches_played')
+        if args.dry_run:
+            cursor = conn.cursor()
+            cursor.execute(COUNT_SQL, (cutoff,))
+            count = cursor.fetchall()[0][0]
+            cursor.close()
+            conn.close()
+            print('shard %d: %d matches to archive' % (shard, count))
+            total += count
+            continue
+        t0 = time.time()
+        moved, rollups = 0, 0
+        while True:
+            batchMoved, batchRollups = archiveBatch(
+                conn, isPes6, cutoff, args.batch_size)
+            if not batchMoved:
+                break
+            moved += batchMoved
+            rollups += batchRollups
+            if args.pause:
+                time.sleep(args.pause)
+        conn.close()
+        elapsed = time.time() - t0
+        print('shard %d: %d matches archived, %d rollup rows written, '
+              '%0.2fs (%s)' % (
+              shard, moved, rollups, elapsed, rate(moved, elapsed)))
+        total += moved
+    print('total: %d matches%s' % (
+        total, ' (dry run: nothing written)' if args.dry_run else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
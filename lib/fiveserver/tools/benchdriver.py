@@ -0,0 +1,114 @@
+"""
+Benchmark of DB drivers: adbapi (threads) versus aiomysql (asyncio).
+
+Fires logins (findByHashWithProfiles, as FiveServerConfig.getUser
+does) through a StorageController of each driver, with a given
+number of requests in flight, and reports queries per second and
+latency percentiles. Runs on Twisted's asyncio reactor, which both
+drivers can use. The ConnectionPool section of the configuration
+applies to both; --max-connections overrides its maxConnections.
+
+Usage:
+    python3 -m fiveserver.tools.benchdriver ./etc/conf/sixserver.yaml \
+        [--inflight 200] [--logins 5000] [--max-connections 100]
+"""
+
+import argparse
+import sys
+import time
+
+from twisted.internet import asyncioreactor
+asyncioreactor.install()
+
+from twisted.internet import defer, reactor, task
+
+from fiveserver import data, data6
+from fiveserver.config import DatabaseConfig
+from fiveserver.tools import loadServerConfig, connect, hasTable
+
+
+def percentile(values, p):
+    return values[min(len(values)-1, int(len(values)*p))]
+
+
+@defer.inlineCallbacks
+def run(dbConfig, isPes6, hashes, inflight):
+    controller = dbConfig.getStorageController()
+    userData = data.UserData(controller)
+    if isPes6:
+        profileData = data6.ProfileData(controller)
+    else:
+        profileData = data.ProfileData(controller)
+    # warm up: open connections
+    yield userData.findByHashWithProfiles(hashes[0], profileData)
+    latencies = []
+    semaphore = defer.DeferredSemaphore(inflight)
+
+    @defer.inlineCallbacks
+    def _login(hash):
+        t0 = time.time()
+        yield userData.findByHashWithProfiles(hash, profileData)
+        latencies.append(time.time() - t0)
+
+    t0 = time.time()
+    yield defer.DeferredList([semaphore.run(_login, hash)
+        for hash in hashes], fireOnOneErrback=True, consumeErrors=True)
+    elapsed = time.time() - t0
+    dbConfig.getWritePool().close()
+    if dbConfig.getReadPool() is not dbConfig.getWritePool():
+        dbConfig.getReadPool().close()
+    latencies.sort()
+    defer.returnValue((len(hashes)/elapsed,
+        1000.0*percentile(latencies, 0.5),
+        1000.0*percentile(latencies, 0.99)))
+
+
+@defer.inlineCallbacks
+def runAll(reactor, cfg, isPes6, hashes, args):
+    print('%d logins, in flight: %d' % (len(hashes), args.inflight))
+    print('%-10s %12s %10s %10s' % ('', 'queries/sec', 'p50 ms', 'p99 ms'))
+    for driver in args.drivers:
+        dbCfg = dict(cfg['DB'], driver=driver)
+        if args.max_connections:
+            dbCfg['ConnectionPool'] = dict(
+                dbCfg.get('ConnectionPool') or dict(),
+                maxConnections=args.max_connections)
+        results = yield run(
+            DatabaseConfig(**dbCfg), isPes6, hashes, args.inflight)
+        print('%-10s %12.0f %10.2f %10.2f' % ((driver,) + results))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark DB drivers')
+    parser.add_argument('config', help='server configuration (yaml)')
+    parser.add_argument('--inflight', type=int, default=200,
+        help='number of logins in flight')
+    parser.add_argument('--logins', type=int, default=5000,
+        help='total number of logins per driver')
+    parser.add_argument('--max-connections', type=int, default=0,
+        help='size of connection pools (default: from config)')
+    parser.add_argument('--drivers', nargs='+',
+        default=['adbapi', 'aiomysql'], help='drivers to compare')
+    args = parser.parse_args(argv)
+
+    cfg = loadServerConfig(args.config)
+    conn = connect(cfg['DB'])
+    isPes6 = hasTable(conn, 'matches_played')
+    cursor = conn.cursor()
+    cursor.execute('SELECT hash FROM users WHERE deleted = 0 LIMIT %s',
+        (args.logins,))
+    hashes = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+    if not hashes:
+        print('No users in the database')
+        return 1
+    hashes = (hashes * (args.logins//len(hashes) + 1))[:args.logins]
+    reactor.suggestThreadPoolSize(
+        max(args.max_connections, 10))
+    task.react(runAll, (cfg, isPes6, hashes, args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,134 @@
+"""
+Benchmark of login hydration under concurrent login bursts.
+
+Loads existing users with their profiles the way FiveServerConfig.getUser
+does: with two queries (findByHash + getByUserId, as before) and with
+the single JOIN query (findByHashWithProfiles). Logins are fired in
+bursts by a number of concurrent workers, each with its own DB
+connection, and latency percentiles are reported.
+
+Usage:
+    python3 -m fiveserver.tools.benchlogin ./etc/conf/sixserver.yaml \
+        [--concurrency 20] [--logins 2000]
+"""
+
+import argparse
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from twisted.internet import defer
+
+from fiveserver import data, data6
+from fiveserver.tools import loadServerConfig, connect, hasTable
+
+
+class DirectController:
+    """
+    Stands in for StorageController: runs queries synchronously
+    on a DB-API connection of the calling thread. Returned
+    Deferreds have already fired.
+    """
+
+    def __init__(self, dbConfig):
+        self.dbConfig = dbConfig
+        self._local = threading.local()
+
+    def isPinned(self, pin):
+        return False
+
+    def dbRead(self, key, sql, *args, pin=None, primary=False, shard=None,
+               poolClass=None):
+        try: conn = self._local.conn
+        except AttributeError:
+            conn = self._local.conn = connect(self.dbConfig)
+            conn.autocommit(True)
+        cursor = conn.cursor()
+        cursor.execute(sql, args)
+        rows = cursor.fetchall()
+        cursor.close()
+        return defer.succeed(rows)
+
+
+def result(d):
+    results = []
+    d.addBoth(results.append)
+    return results[0]
+
+
+def loginTwoQueries(userData, profileData, hash):
+    users = result(userData.findByHash(hash))
+    return result(profileData.getByUserId(users[0].id))
+
+
+def loginJoin(userData, profileData, hash):
+    return result(userData.findByHashWithProfiles(hash, profileData))[0][1]
+
+
+def percentile(values, p):
+    return values[min(len(values)-1, int(len(values)*p))]
+
+
+def run(login, userData, profileData, hashes, concurrency, burst):
+    def _timed(hash):
+        t0 = time.time()
+        login(userData, profileData, hash)
+        return time.time() - t0
+    latencies = []
+    t0 = time.time()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for i in range(0, len(hashes), burst):
+            latencies.extend(pool.map(_timed, hashes[i:i+burst]))
+    elapsed = time.time() - t0
+    latencies.sort()
+    return (len(hashes)/elapsed,
+            1000.0*percentile(latencies, 0.5),
+            1000.0*percentile(latencies, 0.99))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark login hydration')
+    parser.add_argument('config', help='server configuration (yaml)')
+    parser.add_argument('--concurrency', type=int, default=20,
+        help='number of concurrent workers')
+    parser.add_argument('--burst', type=int, default=100,
+        help='logins fired at once')
+    parser.add_argument('--logins', type=int, default=2000,
+        help='total number of logins per variant')
+    args = parser.parse_args(argv)
+
+    cfg = loadServerConfig(args.config)
+    conn = connect(cfg['DB'])
+    isPes6 = hasTable(conn, 'matches_played')
+    cursor = conn.cursor()
+    cursor.execute('SELECT hash FROM users WHERE deleted = 0 LIMIT %s',
+        (args.logins,))
+    hashes = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+    if not hashes:
+        print('No users in the database')
+        return 1
+    hashes = (hashes * (args.logins//len(hashes) + 1))[:args.logins]
+
+    controller = DirectController(cfg['DB'])
+    userData = data.UserData(controller)
+    if isPes6:
+        profileData = data6.ProfileData(controller)
+    else:
+        profileData = data.ProfileData(controller)
+
+    print('%d logins, concurrency: %d, burst: %d' % (
+        len(hashes), args.concurrency, args.burst))
+    print('%-12s %12s %10s %10s' % ('', 'logins/sec', 'p50 ms', 'p99 ms'))
+    for name, login in [('two queries', loginTwoQueries), ('join', loginJoin)]:
+        print('%-12s %12.0f %10.2f %10.2f' % ((name,) + run(
+            login, userData, profileData, hashes,
+            args.concurrency, args.burst)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
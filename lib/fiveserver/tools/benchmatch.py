@@ -0,0 +1,220 @@
+"""
+Benchmark of the match write transaction.
+
+Records synthetic matches between existing profiles, using both
+the current MatchData._storeTxn and the previous (read-modify-write)
+implementation, and reports statements and latency per match.
+Every match is rolled back, so the database is left unchanged.
+
+Usage:
+    python3 -m fiveserver.tools.benchmatch ./etc/conf/sixserver.yaml [-n 500]
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from fiveserver import data, data6
+from fiveserver.model import lobby, user
+from fiveserver.tools import loadServerConfig, connect, hasTable
+
+
+class CountingCursor:
+    """
+    Cursor wrapper that counts statements sent to the server.
+    executemany of INSERT ... VALUES is sent as one statement.
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.statements = 0
+
+    def execute(self, *args):
+        self.statements += 1
+        return self._cursor.execute(*args)
+
+    def executemany(self, *args):
+        self.statements += 1
+        return self._cursor.executemany(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def legacyStoreTxn6(transaction, match):
+    """
+    Match write transaction as it used to be: one SELECT and one
+    upsert per participant, row-by-row matches_played inserts.
+    """
+    def _writeStreak(profile_id, win):
+        wins, best = 0, 0
+        transaction.execute(
+            'SELECT wins, best FROM streaks WHERE profile_id=%s',
+            (profile_id,))
+        rows = transaction.fetchall()
+        if len(rows)>0:
+            wins, best = rows[0][0], rows[0][1]
+        if win:
+            wins += 1
+            best = max(wins, best)
+        else:
+            wins = 0
+        transaction.execute(
+            'INSERT INTO streaks (profile_id, wins, best) '
+            'VALUES (%s,%s,%s) ON DUPLICATE KEY UPDATE '
+            'wins=%s, best=%s', (profile_id, wins, best, wins, best))
+
+    transaction.execute(
+        'INSERT INTO matches '
+        '(score_home, score_away, team_id_home, team_id_away) '
+        'VALUES (%s,%s,%s,%s)', (
+        match.score_home, match.score_away,
+        match.teamSelection.home_team_id, match.teamSelection.away_team_id))
+    transaction.execute('SELECT LAST_INSERT_ID()')
+    matchId = transaction.fetchall()[0][0]
+    home_players = [match.teamSelection.home_captain]
+    home_players.extend(match.teamSelection.home_more_players)
+    away_players = [match.teamSelection.away_captain]
+    away_players.extend(match.teamSelection.away_more_players)
+    for profile in home_players:
+        transaction.execute(
+            'INSERT INTO matches_played (match_id, profile_id, home) '
+            'VALUES (%s, %s, 1)', (matchId, profile.id))
+    for profile in away_players:
+        transaction.execute(
+            'INSERT INTO matches_played (match_id, profile_id, home) '
+            'VALUES (%s, %s, 0)', (matchId, profile.id))
+    for profile in home_players:
+        _writeStreak(profile.id, match.score_home > match.score_away)
+    for profile in away_players:
+        _writeStreak(profile.id, match.score_home < match.score_away)
+    return matchId
+
+
+def legacyStoreTxn5(transaction, match):
+    def _writeStreak(profile_id, win):
+        wins, best = 0, 0
+        transaction.execute(
+            'SELECT wins, best FROM streaks WHERE profile_id=%s',
+            (profile_id,))
+        rows = transaction.fetchall()
+        if len(rows)>0:
+            wins, best = rows[0][0], rows[0][1]
+        if win:
+            wins += 1
+            best = max(wins, best)
+        else:
+            wins = 0
+        transaction.execute(
+            'INSERT INTO streaks (profile_id, wins, best) '
+            'VALUES (%s,%s,%s) ON DUPLICATE KEY UPDATE '
+            'wins=%s, best=%s', (profile_id, wins, best, wins, best))
+
+    transaction.execute(
+        'INSERT INTO matches (profile_id_home, profile_id_away, '
+        'score_home, score_away, team_id_home, team_id_away) '
+        'VALUES (%s,%s,%s,%s,%s,%s)', (
+        match.home_profile.id, match.away_profile.id,
+        match.score_home, match.score_away,
+        match.home_team_id, match.away_team_id))
+    transaction.execute('SELECT LAST_INSERT_ID()')
+    matchId = transaction.fetchall()[0][0]
+    _writeStreak(match.home_profile.id, match.score_home > match.score_away)
+    _writeStreak(match.away_profile.id, match.score_home < match.score_away)
+    return matchId
+
+
+def makeMatch6(profileIds, playersPerSide):
+    ids = random.sample(profileIds, playersPerSide*2)
+    profiles = []
+    for profileId in ids:
+        profile = user.Profile(0)
+        profile.id = profileId
+        profiles.append(profile)
+    ts = lobby.TeamSelection()
+    ts.home_captain, ts.away_captain = profiles[0], profiles[1]
+    ts.home_more_players = profiles[2::2]
+    ts.away_more_players = profiles[3::2]
+    ts.home_team_id = random.randint(0, 200)
+    ts.away_team_id = random.randint(0, 200)
+    match = lobby.Match6(ts)
+    match.score_home_1st = random.randint(0, 4)
+    match.score_away_1st = random.randint(0, 4)
+    return match
+
+
+def makeMatch5(profileIds, playersPerSide):
+    home, away = random.sample(profileIds, 2)
+    match = lobby.Match()
+    match.home_profile = user.Profile(0)
+    match.home_profile.id = home
+    match.away_profile = user.Profile(0)
+    match.away_profile.id = away
+    match.home_team_id = random.randint(0, 200)
+    match.away_team_id = random.randint(0, 200)
+    match.score_home = random.randint(0, 4)
+    match.score_away = random.randint(0, 4)
+    return match
+
+
+def run(conn, storeTxn, matches):
+    statements, latencies = 0, []
+    for match in matches:
+        cursor = CountingCursor(conn.cursor())
+        t0 = time.time()
+        storeTxn(cursor, match)
+        latencies.append(time.time() - t0)
+        conn.rollback()
+        statements += cursor.statements
+        cursor.close()
+    latencies.sort()
+    n = len(matches)
+    return (statements/n, 1000.0*sum(latencies)/n,
+            1000.0*latencies[min(n-1, int(n*0.99))])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark match write transaction')
+    parser.add_argument('config', help='server configuration (yaml)')
+    parser.add_argument('-n', type=int, default=500,
+        help='number of matches to record (and roll back)')
+    parser.add_argument('--players', type=int, default=2, choices=[1,2,3],
+        help='players per side (pes6 only)')
+    args = parser.parse_args(argv)
+
+    cfg = loadServerConfig(args.config)
+    conn = connect(cfg['DB'])
+    conn.autocommit(False)
+    cursor = conn.cursor()
+    cursor.execute('SELECT id FROM profiles WHERE deleted = 0 LIMIT 10000')
+    profileIds = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+
+    if hasTable(conn, 'matches_played'):
+        matchData = data6.MatchData(None)
+        makeMatch, legacy = makeMatch6, legacyStoreTxn6
+        players = args.players
+    else:
+        matchData = data.MatchData(None)
+        makeMatch, legacy = makeMatch5, legacyStoreTxn5
+        players = 1
+    if len(profileIds) < players*2:
+        print('Not enough profiles in the database: need at least %d' % (
+            players*2))
+        return 1
+    matches = [makeMatch(profileIds, players) for i in range(args.n)]
+
+    print('%d matches, %d player(s) per side' % (args.n, players))
+    print('%-10s %12s %12s %12s' % ('', 'stmts/match', 'avg ms', 'p99 ms'))
+    for name, storeTxn in [
+            ('legacy', legacy), ('current', matchData._storeTxn)]:
+        print('%-10s %12.1f %12.2f %12.2f' % (
+            (name,) + run(conn, storeTxn, matches)))
+    conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Benchmark of the stats queries.
+
+Runs the queries of MatchData.getStats (read for every profile
+shown in the game) for a sample of profiles and reports latency
+percentiles, along with the numbers of raw matches and rollup
+rows in the database. With --generate, it first adds that many
+synthetic matches between existing profiles, spread over the
+last --span months, oldest first, so that the effect of the
+archive (see tools.archive) can be measured on a big dataset:
+
+    benchstats <config> --generate 10000000   # once
+    benchstats <config>                       # before
+    archive <config>
+    benchstats <config>                       # after
+
+Generated matches are written for real: use a test database.
+
+Usage:
+    python3 -m fiveserver.tools.benchstats ./etc/conf/sixserver.yaml \
+        [--profiles 1000] [--generate 0] [--span 24] [--players 1]
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import random
+import sys
+import time
+
+from fiveserver import data, data6, logic
+from fiveserver.tools import loadServerConfig, connect, hasTable
+
+
+GENERATE_BATCH = 10000
+WARMUP_PROFILES = 10
+
+MAX_ID_SQL = (
+    'SELECT (SELECT coalesce(max(id),0) FROM matches), '
+    '(SELECT coalesce(max(id),0) FROM matches_archive)')
+
+
+def percentile(values, p):
+    return values[min(len(values)-1, int(len(values)*p))]
+
+
+def count(conn, table):
+    cursor = conn.cursor()
+    cursor.execute('SELECT count(*) FROM %s' % table)
+    result = cursor.fetchall()[0][0]
+    cursor.close()
+    return result
+
+
+def generate(conn, isPes6, profileIds, n, span, players):
+    """
+    Add n matches between random profiles, played from "span"
+    months ago until now, in id order
+    """
+    cursor = conn.cursor()
+    cursor.execute(MAX_ID_SQL)
+    nextId = max(cursor.fetchall()[0]) + 1
+    now = datetime.now()
+    start = now - timedelta(days=span*30)
+    step = (now - start) / max(n, 1)
+    t0 = time.time()
+    for i in range(0, n, GENERATE_BATCH):
+        matches, played = [], []
+        for j in range(i, min(n, i + GENERATE_BATCH)):
+            ids = random.sample(profileIds, 2*players)
+            scoreHome, scoreAway = random.randint(0, 5), random.randint(0, 5)
+            teamHome, teamAway = random.randint(0, 200), random.randint(0, 200)
+            playedOn = (start + step*j).strftime('%Y-%m-%d %H:%M:%S')
+            if isPes6:
+                matches.append((nextId, scoreHome, scoreAway,
+                                teamHome, teamAway, playedOn))
+                played.extend((nextId, id, 1) for id in ids[:players])
+                played.extend((nextId, id, 0) for id in ids[players:])
+            else:
+                matches.append((nextId, ids[0], ids[1], scoreHome, scoreAway,
+                                teamHome, teamAway, playedOn))
+            nextId += 1
+        if isPes6:
+            cursor.executemany(
+                'INSERT INTO matches (id, score_home, score_away, '
+                'team_id_home, team_id_away, played_on) '
+                'VALUES (%s,%s,%s,%s,%s,%s)', matches)
+            cursor.executemany(
+                'INSERT INTO matches_played (match_id, profile_id, home) '
+                'VALUES (%s,%s,%s)', played)
+        else:
+            cursor.executemany(
+                'INSERT INTO matches (id, profile_id_home, profile_id_away, '
+                'score_home, score_away, team_id_home, team_id_away, '
+                'played_on) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)', matches)
+        conn.commit()
+        done = min(n, i + GENERATE_BATCH)
+        if done % (100*GENERATE_BATCH) == 0 or done == n:
+            print('generated %d matches (%0.0fs)' % (done, time.time()-t0))
+    cursor.close()
+
+
+def measure(conn, matchData, profileIds):
+    """
+    Return sorted latencies of reading stats of the
+    given profiles, in milliseconds
+    """
+    cursor = conn.cursor()
+    latencies = []
+    for profileId in profileIds:
+        t0 = time.time()
+        for sql, args in matchData.getStatsQueries(
+                profileId, logic.NUM_LAST_TEAMS):
+            cursor.execute(sql, args)
+            cursor.fetchall()
+        latencies.append(1000.0*(time.time() - t0))
+    cursor.close()
+    latencies.sort()
+    return latencies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the stats queries')
+    parser.add_argument('config', help='server configuration (yaml)')
+    parser.add_argument('--profiles', type=int, default=1000,
+        help='number of profiles to read stats of')
+    parser.add_argument('--generate', type=int, default=0,
+        help='number of synthetic matches to add first')
+    parser.add_argument('--span', type=int, default=24,
+        help='months over which generated matches are spread')
+    parser.add_argument('--players', type=int, default=1,
+        help='players per side in generated matches (PES6)')
+    args = parser.parse_args(argv)
+
+    cfg = loadServerConfig(args.config)
+    conn = connect(cfg['DB'])
+    if not hasTable(conn, 'match_rollups'):
+        print('No match_rollups table: run the migrate tool first')
+        return 1
+    isPes6 = hasTable(conn, 'matches_played')
+    players = args.players if isPes6 else 1
+    cursor = conn.cursor()
+    cursor.execute('SELECT id FROM profiles WHERE deleted = 0')
+    profileIds = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    if len(profileIds) < 2*players:
+        print('Not enough profiles in the database')
+        return 1
+    if args.generate:
+        generate(conn, isPes6, profileIds, args.generate, args.span, players)
+
+    if isPes6:
+        matchData = data6.MatchData(None)
+    else:
+        matchData = data.MatchData(None)
+    sample = random.sample(profileIds, min(args.profiles, len(profileIds)))
+    measure(conn, matchData, sample[:WARMUP_PROFILES])
+    latencies = measure(conn, matchData, sample)
+    print('raw matches: %d, archived: %d, rollup rows: %d' % (
+        count(conn, 'matches'), count(conn, 'matches_archive'),
+        count(conn, 'match_rollups')))
+    print('stats of %d profiles: avg %0.2fms, p50 %0.2fms, p90 %0.2fms, '
+          'p99 %0.2fms' % (len(latencies),
+          sum(latencies)/len(latencies), percentile(latencies, 0.5),
+          percentile(latencies, 0.9), percentile(latencies, 0.99)))
+    conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
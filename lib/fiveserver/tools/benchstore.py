@@ -0,0 +1,117 @@
+"""
+Replay benchmark of profile/user stores.
+
+Replays a typical game session (login, cosmetic changes, a few
+matches, a disconnect) against ProfileData/UserData, with a
+recording DB controller instead of a real database, and reports
+statements and bytes sent to the database per session: full-row
+stores (as before dirty-field tracking) versus partial updates.
+
+Usage:
+    python3 -m fiveserver.tools.benchstore [--game pes6] [--matches 5]
+"""
+
+import argparse
+import sys
+from datetime import datetime, timedelta
+
+from twisted.internet import defer
+
+from fiveserver import data, data6
+
+
+class RecordingController:
+    """
+    Stands in for StorageController: records writes
+    and the number of bytes they would put on the wire.
+    """
+
+    def __init__(self):
+        self.statements = 0
+        self.bytes = 0
+
+    def dbWrite(self, key, sql, *args, pin=None, shard=None,
+                poolClass=None):
+        self.statements += 1
+        self.bytes += len(sql.encode('utf-8'))
+        for arg in args:
+            if isinstance(arg, bytes):
+                self.bytes += len(arg)
+            else:
+                self.bytes += len(str(arg).encode('utf-8'))
+        return defer.succeed([])
+
+    def dbInsert(self, key, sql, *args, pin=None, shard=None,
+                 poolClass=None):
+        self.dbWrite(key, sql, *args)
+        return defer.succeed(0)
+
+
+PROFILE_ROW5 = (1001, 17, 0, 'Replayer', 123, 45, 210,
+    480, 2, datetime.now(), 36000)
+PROFILE_ROW6 = (1001, 17, 0, 'Replayer', 210, 0,
+    480, 2, datetime.now(), 36000, b'Fiveserver rules! '*12)
+USER_ROW = (17, 'replayer', 'SERIAL-0000-0000', 'a'*32, None, datetime.now())
+
+
+def replaySession(game, matches, full):
+    """
+    Run one session, return (statements, bytes) written.
+    With full=True every store writes the whole row.
+    """
+    controller = RecordingController()
+    if game == 'pes6':
+        profileData = data6.ProfileData(controller)
+        profile = profileData._makeProfile(PROFILE_ROW6)
+    else:
+        profileData = data.ProfileData(controller)
+        profile = profileData._makeProfile(PROFILE_ROW5)
+    userData = data.UserData(controller)
+    usr = userData._makeUser(USER_ROW)
+
+    def store(obj, dataLayer):
+        if full:
+            obj.markDirty()
+        dataLayer.store(obj)
+
+    # cosmetic changes
+    if game == 'pes6':
+        profile.comment = b'Back again, who wants a game?'
+        store(profile, profileData)
+    else:
+        profile.favTeam = 46
+        store(profile, profileData)
+        profile.favPlayer = 1234
+        store(profile, profileData)
+    # matches: points and play time change
+    for i in range(matches):
+        profile.points += 3 if i % 2 == 0 else 0
+        profile.playTime += timedelta(minutes=15)
+        store(profile, profileData)
+    # in-match disconnect
+    profile.disconnects += 1
+    store(profile, profileData)
+    # logout: full player data store, nothing changed
+    store(profile, profileData)
+    store(usr, userData)
+    return controller.statements, controller.bytes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Replay benchmark of profile/user stores')
+    parser.add_argument('--game', choices=['pes5', 'pes6'], default='pes6')
+    parser.add_argument('--matches', type=int, default=5,
+        help='number of matches per session')
+    args = parser.parse_args(argv)
+
+    print('%s session: %d matches' % (args.game, args.matches))
+    print('%-10s %12s %12s' % ('', 'statements', 'bytes'))
+    for name, full in [('full-row', True), ('partial', False)]:
+        print('%-10s %12d %12d' % (
+            (name,) + replaySession(args.game, args.matches, full)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
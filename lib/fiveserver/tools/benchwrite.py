@@ -0,0 +1,101 @@
+"""
+Benchmark of write throughput: one commit per write versus
+group commit.
+
+Fires small profile updates (the kind the write-behind queue
+and match results produce) through a StorageController, with a
+given number of writes in flight, once with group commit off and
+then with each of the given windows. Reports writes per second
+and latency percentiles. The updates set columns to the values
+they already have, so the data does not change.
+
+Usage:
+    python3 -m fiveserver.tools.benchwrite ./etc/conf/sixserver.yaml \
+        [--inflight 200] [--writes 5000] [--windows 0.002 0.005]
+"""
+
+import argparse
+import sys
+import time
+
+from twisted.internet import defer, task
+
+from fiveserver.config import DatabaseConfig
+from fiveserver.tools import loadServerConfig, connect
+
+
+UPDATE_SQL = 'UPDATE profiles SET disconnects=%s WHERE id=%s'
+
+
+def percentile(values, p):
+    return values[min(len(values)-1, int(len(values)*p))]
+
+
+@defer.inlineCallbacks
+def run(dbConfig, profiles, inflight):
+    controller = dbConfig.getStorageController()
+    latencies = []
+    semaphore = defer.DeferredSemaphore(inflight)
+
+    @defer.inlineCallbacks
+    def _write(profile):
+        id, disconnects = profile
+        t0 = time.time()
+        yield controller.dbWrite(
+            'bench.write', UPDATE_SQL, disconnects, id, shard=id)
+        latencies.append(time.time() - t0)
+
+    t0 = time.time()
+    yield defer.DeferredList([semaphore.run(_write, profile)
+        for profile in profiles], fireOnOneErrback=True, consumeErrors=True)
+    elapsed = time.time() - t0
+    dbConfig.getWritePool().close()
+    latencies.sort()
+    defer.returnValue((len(profiles)/elapsed,
+        1000.0*percentile(latencies, 0.5),
+        1000.0*percentile(latencies, 0.99)))
+
+
+@defer.inlineCallbacks
+def runAll(reactor, cfg, profiles, args):
+    print('%d writes, in flight: %d' % (len(profiles), args.inflight))
+    print('%-14s %12s %10s %10s' % ('', 'writes/sec', 'p50 ms', 'p99 ms'))
+    for window in [0] + args.windows:
+        dbCfg = dict(cfg['DB'], groupCommitSeconds=window)
+        results = yield run(DatabaseConfig(**dbCfg), profiles, args.inflight)
+        if window:
+            name = 'group %gms' % (window*1000)
+        else:
+            name = 'no grouping'
+        print('%-14s %12.0f %10.2f %10.2f' % ((name,) + results))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark write throughput with group commit')
+    parser.add_argument('config', help='server configuration (yaml)')
+    parser.add_argument('--inflight', type=int, default=200,
+        help='number of writes in flight')
+    parser.add_argument('--writes', type=int, default=5000,
+        help='total number of writes per variant')
+    parser.add_argument('--windows', type=float, nargs='+',
+        default=[0.002, 0.005], help='group commit windows, in seconds')
+    args = parser.parse_args(argv)
+
+    cfg = loadServerConfig(args.config)
+    conn = connect(cfg['DB'])
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, disconnects FROM profiles LIMIT %s',
+        (args.writes,))
+    profiles = [tuple(row) for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+    if not profiles:
+        print('No profiles in the database')
+        return 1
+    profiles = (profiles * (args.writes//len(profiles) + 1))[:args.writes]
+    task.react(runAll, (cfg, profiles, args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
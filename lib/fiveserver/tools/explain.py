@@ -0,0 +1,245 @@
+"""
+EXPLAIN check of the hot queries.
+
+Drives the data layer (data.py or data6.py, whichever matches
+the database) through the calls that the server makes all the
+time: logins, profile and settings lookups, stats, match results,
+browsing and ranking. A recording controller stands in for the
+database, so the statements checked are exactly those that the
+data layer sends. Then the database is asked for the plan of
+every SELECT recorded, and the check fails (exit code 1) when
+any of them would scan a whole table without an index to use:
+after a query change, or on a database that misses migrations.
+
+MySQL may still choose a full scan of a small table that has a
+usable index: only scans with no possible key are failures.
+
+Usage:
+    python3 -m fiveserver.tools.explain ./etc/conf/sixserver.yaml [-v]
+"""
+
+import argparse
+import re
+import sys
+
+from twisted.internet import defer
+
+from fiveserver import data, data6, logic
+from fiveserver.tools import loadServerConfig, connect, hasTable
+
+
+SAMPLE_ID = 1
+SAMPLE_HASH = 'a'*32
+SELECT_RE = re.compile(r'^\s*SELECT\s+(.*?)\s+FROM\s', re.I | re.S)
+SAMPLE_RECORD5 = {'home': [1], 'away': [2], 'score': [2, 1],
+                  'teams': [10, 20]}
+SAMPLE_RECORD6 = {'home': [1, 3], 'away': [2], 'score': [2, 1],
+                  'teams': [10, 20]}
+
+
+class RecordingTransaction:
+
+    def __init__(self, controller, key):
+        self.controller = controller
+        self.key = key
+        self.lastrowid = 0
+
+    def execute(self, sql, args=None):
+        self.controller.record(self.key, sql, args or ())
+
+    def executemany(self, sql, seq):
+        for args in seq:
+            self.controller.record(self.key, sql, args)
+
+    def fetchall(self):
+        return []
+
+
+class RecordingController:
+    """
+    Stands in for StorageController: records statements
+    instead of running them. Reads return one row of zeros,
+    as wide as the select list, which is enough for counts;
+    objects made of it do not matter, since nothing is done
+    with them.
+    """
+    shardCount = 1
+
+    def __init__(self):
+        self.queries = []
+
+    def record(self, key, sql, args):
+        self.queries.append((key, sql, tuple(args)))
+
+    def isPinned(self, pin):
+        return False
+
+    def groupByShard(self, ids):
+        return {0: list(ids)}
+
+    def dbRead(self, key, sql, *args, **kw):
+        self.record(key, sql, args)
+        return defer.succeed([zeroRow(sql)])
+
+    def dbReadBatch(self, key, queries, **kw):
+        for sql, args in queries:
+            self.record(key, sql, args)
+        return defer.succeed([[zeroRow(sql)] for sql, args in queries])
+
+    def dbWrite(self, key, sql, *args, **kw):
+        self.record(key, sql, args)
+        return defer.succeed([])
+
+    def dbInsert(self, key, sql, *args, **kw):
+        self.record(key, sql, args)
+        return defer.succeed(0)
+
+    def dbWriteInteraction(self, key, interaction, *args, **kw):
+        return defer.maybeDeferred(
+            interaction, RecordingTransaction(self, key), *args)
+
+
+def zeroRow(sql):
+    """
+    Return row of zeros with one column per item of the
+    select list of the query
+    """
+    m = SELECT_RE.match(sql)
+    if not m:
+        return (0,)
+    columns, depth = 1, 0
+    for c in m.group(1):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            columns += 1
+    return (0,) * columns
+
+
+def recordHotQueries(isPes6):
+    """
+    Return list of (key, sql, args) of the hot calls, and
+    list of (call name, error) of the calls that failed:
+    their queries are missing from the list
+    """
+    controller = RecordingController()
+    userData = data.UserData(controller)
+    if isPes6:
+        profileData = data6.ProfileData(controller)
+        matchData = data6.MatchData(controller)
+        record = SAMPLE_RECORD6
+    else:
+        profileData = data.ProfileData(controller)
+        matchData = data.MatchData(controller)
+        record = SAMPLE_RECORD5
+    calls = [
+        (userData.get, SAMPLE_ID),
+        (userData.findByHash, SAMPLE_HASH),
+        (userData.findByHashWithProfiles, SAMPLE_HASH, profileData),
+        (userData.findByUsername, 'sample'),
+        (userData.findByNonce, 'nonce'),
+        (userData.browse,),
+        (profileData.get, SAMPLE_ID),
+        (profileData.findByName, 'sample'),
+        (profileData.getByUserId, SAMPLE_ID),
+        (profileData.getSettings, SAMPLE_ID),
+        (profileData.browse,),
+        (profileData.computeRanks,),
+        (matchData.getGamesOfProfiles, [SAMPLE_ID, SAMPLE_ID+1]),
+        (matchData.getStats, SAMPLE_ID, logic.NUM_LAST_TEAMS),
+        (matchData.store, matchData.fromRecord(record), 'explain'),
+    ]
+    failed = []
+    for call in calls:
+        name = call[0].__qualname__
+        d = defer.maybeDeferred(*call)
+        d.addErrback(lambda error, name: failed.append((name, '%s: %s' % (
+            error.type.__name__, error.getErrorMessage()))), name)
+        if not d.called:
+            # the recording controller answers at once
+            failed.append((name, 'did not finish'))
+    return controller.queries, failed
+
+
+def explainMysql(cursor, sql, args):
+    """
+    Return (plan lines, full scans)
+    """
+    cursor.execute('EXPLAIN ' + sql, args)
+    columns = [column[0].lower() for column in cursor.description]
+    lines, scans = [], []
+    for row in cursor.fetchall():
+        row = dict(zip(columns, row))
+        lines.append('%s: type=%s key=%s possible_keys=%s %s' % (
+            row.get('table'), row.get('type'), row.get('key'),
+            row.get('possible_keys'), row.get('extra') or ''))
+        if row.get('type') == 'ALL' and not row.get('possible_keys'):
+            scans.append(row.get('table'))
+    return lines, scans
+
+
+def explainSqlite(cursor, sql, args):
+    """
+    Return (plan lines, full scans)
+    """
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, args)
+    lines = [row[-1] for row in cursor.fetchall()]
+    scans = [line.split()[1] for line in lines
+             if line.startswith('SCAN ') and ' USING ' not in line
+             and line != 'SCAN CONSTANT ROW']
+    return lines, scans
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Check plans of the hot queries')
+    parser.add_argument('config', help='server configuration (yaml)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help='show plans of all queries')
+    args = parser.parse_args(argv)
+
+    cfg = loadServerConfig(args.config)
+    conn = connect(cfg['DB'])
+    if cfg['DB'].get('backend', 'mysql') == 'mysql':
+        explain = explainMysql
+    else:
+        explain = explainSqlite
+    isPes6 = hasTable(conn, 'matches_played')
+
+    seen = set()
+    queries, failed = recordHotQueries(isPes6)
+    for name, message in failed:
+        # its queries could not be recorded, let alone checked
+        print('FAIL %-24s call failed: %s' % (name, message))
+    failures = len(failed)
+    cursor = conn.cursor()
+    for key, sql, sqlArgs in queries:
+        if not sql.lstrip().upper().startswith('SELECT') or sql in seen:
+            continue
+        seen.add(sql)
+        try: lines, scans = explain(cursor, sql, sqlArgs)
+        except Exception as info:
+            # e.g. missing table: migrations not applied
+            failures += 1
+            print('FAIL %-24s %s' % (key, info))
+            continue
+        if scans:
+            failures += 1
+            print('SCAN %-24s full scan of: %s' % (key, ', '.join(scans)))
+            print('     %s' % sql)
+        elif args.verbose:
+            print('OK   %-24s %s' % (key, sql))
+        if scans or args.verbose:
+            for line in lines:
+                print('       %s' % line)
+    cursor.close()
+    conn.close()
+    print('%d queries checked, %d failed' % (
+        len(seen), failures))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Schema migrations.
+
+Brings an existing database up to date with the schema: runs,
+in version order, the migration files that have not been applied
+yet, and records each one in the schema_migrations table (created
+when missing). Migrations live in sql/migrations (Fiveserver) and
+sql/migrations6 (Sixserver), named <version>_<name>.sql for MySQL
+and <version>_<name>.sqlite.sql for SQLite. With shards, every
+shard is migrated.
+
+New MySQL databases: source the schema file, then run this tool.
+SQLite schema files include all migrations already (they are
+run at every start); running the tool there only records them.
+
+Usage:
+    python3 -m fiveserver.tools.migrate ./etc/conf/sixserver.yaml \
+        [--sql-dir ./sql] [--dry-run]
+"""
+
+import argparse
+import os
+import re
+import sys
+
+from fiveserver.tools import loadServerConfig, connect, hasTable
+from fiveserver.tools import getShardConfigs
+
+
+MIGRATIONS_TABLE_SQL = (
+    'create table if not exists schema_migrations ('
+    'version int not null primary key, '
+    'name varchar(128) not null, '
+    'applied_on timestamp not null default current_timestamp)')
+APPLIED_SQL = 'SELECT version FROM schema_migrations'
+RECORD_SQL = 'INSERT INTO schema_migrations (version, name) VALUES (%s,%s)'
+
+MYSQL_FILE_RE = re.compile(r'^(\d+)_(\w+)\.sql$')
+SQLITE_FILE_RE = re.compile(r'^(\d+)_(\w+)\.sqlite\.sql$')
+
+
+def getMigrations(directory, sqlite):
+    """
+    Return list of (version, name, path), in version order
+    """
+    if sqlite:
+        fileRe = SQLITE_FILE_RE
+    else:
+        fileRe = MYSQL_FILE_RE
+    migrations = []
+    for filename in os.listdir(directory):
+        m = fileRe.match(filename)
+        if m:
+            migrations.append((int(m.group(1)), m.group(2),
+                               os.path.join(directory, filename)))
+    migrations.sort()
+    versions = [version for version, name, path in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError('duplicate migration versions in %s' % directory)
+    return migrations
+
+
+def splitStatements(script):
+    """
+    Return statements of an SQL script, without comments
+    """
+    lines = [line for line in script.splitlines()
+             if not line.strip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';')
+            if statement.strip()]
+
+
+def getApplied(conn):
+    cursor = conn.cursor()
+    cursor.execute(MIGRATIONS_TABLE_SQL)
+    cursor.execute(APPLIED_SQL)
+    applied = set(row[0] for row in cursor.fetchall())
+    cursor.close()
+    conn.commit()
+    return applied
+
+
+def applyMigration(conn, version, name, path):
+    """
+    Run statements of one migration and record it. MySQL commits
+    after every DDL statement: if one of them fails, the ones
+    before it stay applied, and the migration has to be finished
+    by hand.
+    """
+    with open(path) as f:
+        statements = splitStatements(f.read())
+    cursor = conn.cursor()
+    try:
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.execute(RECORD_SQL, (version, name))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Apply schema migrations')
+    parser.add_argument('config', help='server configuration (yaml)')
+    parser.add_argument('--sql-dir', default='./sql',
+        help='directory with migrations and migrations6 (default: ./sql)')
+    parser.add_argument('--dry-run', action='store_true',
+        help='only list migrations that would be applied')
+    args = parser.parse_args(argv)
+
+    cfg = loadServerConfig(args.config)
+    sqlite = cfg['DB'].get('backend', 'mysql') != 'mysql'
+    for shard, dbConfig in enumerate(getShardConfigs(cfg['DB'])):
+        conn = connect(dbConfig)
+        if hasTable(conn, 'matches_played'):
+            directory = os.path.join(args.sql_dir, 'migrations6')
+        else:
+            directory = os.path.join(args.sql_dir, 'migrations')
+        applied = getApplied(conn)
+        pending = [migration for migration in
+                   getMigrations(directory, sqlite)
+                   if migration[0] not in applied]
+        if not pending:
+            print('shard %d: up to date' % shard)
+        for version, name, path in pending:
+            if args.dry_run:
+                print('shard %d: would apply %03d %s' % (
+                    shard, version, name))
+                continue
+            try:
+                applyMigration(conn, version, name, path)
+            except Exception as info:
+                print('shard %d: migration %03d %s failed: %s' % (
+                    shard, version, name, info))
+                conn.close()
+                return 1
+            print('shard %d: applied %03d %s' % (shard, version, name))
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
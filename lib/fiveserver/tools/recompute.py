@@ -0,0 +1,193 @@
+"""
+Bulk re-computation of profile points.
+
+Needed whenever RatingMath weights or draw factor change
+("Rating" section of server configuration): stored points of
+all profiles become stale. This tool reads per-profile
+win/draw/loss aggregates in one pass, computes points for all
+profiles at once and writes back only the changed ones,
+in batches.
+
+Usage:
+    python3 -m fiveserver.tools.recompute ./etc/conf/sixserver.yaml [--dry-run]
+"""
+
+import argparse
+import sys
+import time
+
+from fiveserver import rating
+from fiveserver.tools import loadServerConfig, connect, hasTable
+from fiveserver.tools import getShardConfigs
+
+
+# per-profile aggregates for PES6 schema (matches_played)
+AGGREGATES_SQL_PES6 = (
+    'SELECT p.id, p.name, p.points, '
+    'COALESCE(a.wins,0), COALESCE(a.draws,0), COALESCE(a.losses,0) '
+    'FROM profiles p LEFT JOIN ('
+    'SELECT mp.profile_id, '
+    'SUM(CASE WHEN (mp.home=1 AND m.score_home>m.score_away) OR '
+    '(mp.home=0 AND m.score_home<m.score_away) THEN 1 ELSE 0 END) AS wins, '
+    'SUM(CASE WHEN m.score_home=m.score_away THEN 1 ELSE 0 END) AS draws, '
+    'SUM(CASE WHEN (mp.home=1 AND m.score_home<m.score_away) OR '
+    '(mp.home=0 AND m.score_home>m.score_away) THEN 1 ELSE 0 END) AS losses '
+    'FROM matches_played mp JOIN matches m ON m.id=mp.match_id '
+    'GROUP BY mp.profile_id) a ON a.profile_id=p.id '
+    'WHERE p.deleted = 0')
+
+# per-profile aggregates for PES5 schema (home/away profile in matches)
+AGGREGATES_SQL_PES5 = (
+    'SELECT p.id, p.name, p.points, '
+    'COALESCE(a.wins,0), COALESCE(a.draws,0), COALESCE(a.losses,0) '
+    'FROM profiles p LEFT JOIN ('
+    'SELECT profile_id, SUM(win) AS wins, SUM(draw) AS draws, '
+    'SUM(loss) AS losses FROM ('
+    'SELECT profile_id_home AS profile_id, '
+    'CASE WHEN score_home>score_away THEN 1 ELSE 0 END AS win, '
+    'CASE WHEN score_home=score_away THEN 1 ELSE 0 END AS draw, '
+    'CASE WHEN score_home<score_away THEN 1 ELSE 0 END AS loss '
+    'FROM matches UNION ALL '
+    'SELECT profile_id_away, '
+    'CASE WHEN score_away>score_home THEN 1 ELSE 0 END, '
+    'CASE WHEN score_home=score_away THEN 1 ELSE 0 END, '
+    'CASE WHEN score_away<score_home THEN 1 ELSE 0 END '
+    'FROM matches) t GROUP BY profile_id) a ON a.profile_id=p.id '
+    'WHERE p.deleted = 0')
+
+# aggregates of archived matches (see tools.archive)
+ROLLUPS_SQL = (
+    'SELECT profile_id, SUM(wins), SUM(draws), SUM(losses) '
+    'FROM match_rollups GROUP BY profile_id')
+
+UPDATE_SQL = 'UPDATE profiles SET points=%s WHERE id=%s'
+
+FETCH_SIZE = 10000
+
+
+def readAggregates(conn):
+    if hasTable(conn, 'matches_played'):
+        sql = AGGREGATES_SQL_PES6
+    else:
+        sql = AGGREGATES_SQL_PES5
+    ids, names, oldPoints, wins, draws, losses = [], [], [], [], [], []
+    cursor = conn.cursor()
+    cursor.execute(sql)
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            ids.append(row[0])
+            names.append(row[1])
+            oldPoints.append(int(row[2]))
+            wins.append(int(row[3]))
+            draws.append(int(row[4]))
+            losses.append(int(row[5]))
+    cursor.close()
+    if hasTable(conn, 'match_rollups'):
+        index = dict((id, i) for i, id in enumerate(ids))
+        cursor = conn.cursor()
+        cursor.execute(ROLLUPS_SQL)
+        for profileId, rolledWins, rolledDraws, rolledLosses in (
+                cursor.fetchall()):
+            try: i = index[profileId]
+            except KeyError:
+                continue # deleted profile
+            wins[i] += int(rolledWins)
+            draws[i] += int(rolledDraws)
+            losses[i] += int(rolledLosses)
+        cursor.close()
+    return ids, names, oldPoints, wins, draws, losses
+
+
+def writePoints(conn, changes, batchSize):
+    cursor = conn.cursor()
+    for i in range(0, len(changes), batchSize):
+        cursor.executemany(UPDATE_SQL, changes[i:i+batchSize])
+        conn.commit()
+    cursor.close()
+
+
+def rate(count, seconds):
+    if seconds <= 0:
+        return 'n/a'
+    return '%0.0f profiles/sec' % (count/seconds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Re-compute points of all profiles')
+    parser.add_argument('config', help='server configuration (yaml)')
+    parser.add_argument('--dry-run', action='store_true',
+        help='show what would change, but do not write anything')
+    parser.add_argument('--batch-size', type=int, default=1000,
+        help='number of profiles per UPDATE batch')
+    parser.add_argument('--show', type=int, default=50,
+        help='max number of changed profiles to list')
+    args = parser.parse_args(argv)
+
+    cfg = loadServerConfig(args.config)
+    ratingMath = rating.makeRatingMath(cfg.get('Rating'))
+    if not ratingMath.fromAggregates:
+        print('Points of "%s" rating engine depend on the order of '
+              'matches and cannot be re-computed from aggregates.' % (
+              cfg['Rating'].get('engine')))
+        return 1
+    # aggregates are read from replicas, points written to primary,
+    # shard by shard: all data of a profile is on one shard
+    shardConfigs = getShardConfigs(cfg['DB'])
+
+    t0 = time.time()
+    ids, names, oldPoints, wins, draws, losses = [], [], [], [], [], []
+    shards = []
+    for shard, dbConfig in enumerate(shardConfigs):
+        readConn = connect(dbConfig, replica=True)
+        for values, shardValues in zip(
+                (ids, names, oldPoints, wins, draws, losses),
+                readAggregates(readConn)):
+            values.extend(shardValues)
+        readConn.close()
+        shards.extend([shard] * (len(ids) - len(shards)))
+    t1 = time.time()
+    newPoints = ratingMath.getPointsArray(wins, draws, losses)
+    oldDivs = ratingMath.getDivisionArray(oldPoints)
+    newDivs = ratingMath.getDivisionArray(newPoints)
+    t2 = time.time()
+
+    changes = []
+    changesByShard = [[] for dbConfig in shardConfigs]
+    for i, profileId in enumerate(ids):
+        if newPoints[i] != oldPoints[i]:
+            changes.append((int(newPoints[i]), profileId))
+            changesByShard[shards[i]].append(changes[-1])
+            if args.dry_run and len(changes) <= args.show:
+                print('%-32s id=%-8s points: %5d -> %5d  '
+                      'division: %d -> %d' % (
+                    names[i], profileId, oldPoints[i], newPoints[i],
+                    oldDivs[i], newDivs[i]))
+    if args.dry_run and len(changes) > args.show:
+        print('... and %d more' % (len(changes) - args.show))
+    divChanges = sum(1 for a, b in zip(oldDivs, newDivs) if a != b)
+
+    if not args.dry_run:
+        for dbConfig, shardChanges in zip(shardConfigs, changesByShard):
+            conn = connect(dbConfig)
+            writePoints(conn, shardChanges, args.batch_size)
+            conn.close()
+    t3 = time.time()
+
+    n = len(ids)
+    print('profiles: %d, points changed: %d, division changed: %d%s' % (
+        n, len(changes), divChanges,
+        ' (dry run: nothing written)' if args.dry_run else ''))
+    print('read:    %0.2fs (%s)' % (t1-t0, rate(n, t1-t0)))
+    print('compute: %0.2fs (%s)' % (t2-t1, rate(n, t2-t1)))
+    if not args.dry_run:
+        print('write:   %0.2fs (%s)' % (t3-t2, rate(len(changes), t3-t2)))
+    print('total:   %0.2fs (%s)' % (t3-t0, rate(n, t3-t0)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Write-behind queue: coalesces pending updates of the same
+object into one write, which happens later
+"""
+
+import json
+
+from twisted.internet import reactor, defer, task
+
+from fiveserver import log
+
+
+DEFAULT_INTERVAL = 10 # seconds
+DEFAULT_DUMP_PATH = './log/writebehind.dump'
+SHUTDOWN_RETRIES = 3 # retries of a failed store during shutdown
+SHUTDOWN_RETRY_SECONDS = 1 # doubles on each attempt
+
+
+class WriteBehindQueue:
+    """
+    Keeps the latest version of every object queued for writing,
+    keyed by object id: any number of updates made to an object
+    between two flushes end up as a single store call.
+    Pending objects are flushed every "interval" seconds, or
+    explicitly with flush(). Until written, they can be looked
+    up with get(), so that readers see their own writes.
+    On shutdown, failed stores are retried a few times, and
+    objects that still cannot be stored are dumped to a file.
+    """
+
+    def __init__(self, store, interval=DEFAULT_INTERVAL,
+                 dumpPath=DEFAULT_DUMP_PATH):
+        self.store = store
+        self.interval = interval
+        self.dumpPath = dumpPath
+        self._pending = dict()
+        self._flushCall = None
+        self._shuttingDown = False
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, key):
+        return key in self._pending
+
+    def put(self, key, obj):
+        self._pending[key] = obj
+        if self._flushCall is None:
+            self._flushCall = reactor.callLater(
+                self.interval, self._scheduledFlush)
+
+    def get(self, key, defaultValue=None):
+        return self._pending.get(key, defaultValue)
+
+    def discard(self, key):
+        """
+        Forget pending write, if any. Used when the object
+        has just been written by other means.
+        """
+        self._pending.pop(key, None)
+
+    def _scheduledFlush(self):
+        self._flushCall = None
+        self.flush()
+
+    def flush(self, key=None):
+        """
+        Write the pending object with the given key, or all
+        pending objects if no key is given. Return a Deferred,
+        which fires when the writes are done.
+        """
+        if key is None:
+            items = list(self._pending.items())
+            self._pending.clear()
+        elif key in self._pending:
+            items = [(key, self._pending.pop(key))]
+        else:
+            return defer.succeed(0)
+        ds = []
+        for k, obj in items:
+            d = defer.maybeDeferred(self.store, obj)
+            d.addErrback(self._storeError, k, obj)
+            ds.append(d)
+        d = defer.DeferredList(ds)
+        d.addCallback(lambda results: len(results))
+        return d
+
+    def _storeError(self, error, key, obj):
+        log.msg('WARN: write-behind store failed for %s: %s' % (
+            key, error.value))
+        if self._shuttingDown:
+            # there is no next flush: retry now, with the
+            # newest version of the object
+            return self._retryStore(key, self._pending.pop(key, obj), 1)
+        # keep it for the next flush, unless a newer
+        # version has been queued in the meantime
+        if key not in self._pending:
+            self.put(key, obj)
+
+    def _retryStore(self, key, obj, attempt):
+        delay = SHUTDOWN_RETRY_SECONDS * 2**(attempt-1)
+        d = task.deferLater(reactor, delay, self.store, obj)
+        d.addErrback(self._retryError, key, obj, attempt)
+        return d
+
+    def _retryError(self, error, key, obj, attempt):
+        if attempt < SHUTDOWN_RETRIES:
+            log.msg('WARN: write-behind store failed for %s '
+                    '(attempt %d): %s' % (key, attempt+1, error.value))
+            return self._retryStore(key, obj, attempt+1)
+        log.msg('ALERT: write-behind store failed for %s: %s. '
+                'Giving up, dumping it to %s' % (
+                key, error.value, self.dumpPath))
+        self._dump(key, obj)
+
+    def _dump(self, key, obj):
+        """
+        Append object to the dump file, as one line of JSON
+        """
+        try:
+            with open(self.dumpPath, 'a') as f:
+                f.write(json.dumps({'key': key, 'object': vars(obj)},
+                                   default=str) + '\n')
+        except (IOError, TypeError) as info:
+            log.msg('ALERT: cannot dump write-behind object %s: %s. '
+                    'Lost: %r' % (key, info, obj))
+
+    def shutdown(self):
+        """
+        Flush everything, cancelling scheduled flush. The result
+        fires when every object has been stored or dumped.
+        """
+        self._shuttingDown = True
+        if self._flushCall is not None and self._flushCall.active():
+            self._flushCall.cancel()
+        self._flushCall = None
+        return self.flush()
@@ -0,0 +1,30 @@
+-- Tables of the match journal (journal_applied) and of the
+-- match archive (match_rollups, *_archive)
+
+create table if not exists journal_applied (
+    entry_key varchar(64) not null primary key,
+    applied_on timestamp not null default (datetime('now','localtime'))
+);
+
+create table if not exists match_rollups (
+    profile_id int not null,
+    month date not null,
+    games int not null default 0,
+    wins int not null default 0,
+    losses int not null default 0,
+    draws int not null default 0,
+    goals_scored int not null default 0,
+    goals_allowed int not null default 0,
+    primary key(profile_id, month)
+);
+
+create table if not exists matches_archive (
+    id integer primary key,
+    profile_id_home int not null,
+    profile_id_away int not null,
+    score_home int not null default 0,
+    score_away int not null default 0,
+    team_id_home int not null default -1,
+    team_id_away int not null default -1,
+    played_on timestamp not null
+);
@@ -0,0 +1,17 @@
+-- Indexes for the hot queries of the data layer (data.py, data6.py):
+-- logins and profile lookups, browsing, reset tokens, ranking and
+-- match stats. Check with the explain tool.
+
+alter table users
+    add key users_deleted_username (deleted, username),
+    add key users_reset_nonce (reset_nonce);
+
+alter table profiles
+    add key profiles_user (user_id, deleted, updated_on),
+    add key profiles_deleted_name (deleted, name),
+    add key profiles_ranking (points, seconds_played);
+
+-- stats: home and away matches of a profile, with scores
+alter table matches
+    add key matches_home (profile_id_home, score_home, score_away),
+    add key matches_away (profile_id_away, score_away, score_home);
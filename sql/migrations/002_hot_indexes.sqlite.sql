@@ -0,0 +1,19 @@
+-- Indexes for the hot queries of the data layer (data.py, data6.py):
+-- logins and profile lookups, browsing, reset tokens, ranking and
+-- match stats. Check with the explain tool.
+
+create index if not exists users_deleted_username
+    on users (deleted, username);
+create index if not exists users_reset_nonce on users (reset_nonce);
+
+create index if not exists profiles_user
+    on profiles (user_id, deleted, updated_on);
+create index if not exists profiles_deleted_name on profiles (deleted, name);
+create index if not exists profiles_ranking
+    on profiles (points, seconds_played);
+
+-- stats: home and away matches of a profile, with scores
+create index if not exists matches_home
+    on matches (profile_id_home, score_home, score_away);
+create index if not exists matches_away
+    on matches (profile_id_away, score_away, score_home);
@@ -0,0 +1,16 @@
+-- Indexes for the hot queries of the data layer (data.py, data6.py):
+-- logins and profile lookups, browsing, reset tokens, ranking and
+-- match stats. Check with the explain tool.
+
+alter table users
+    add key users_deleted_username (deleted, username),
+    add key users_reset_nonce (reset_nonce);
+
+alter table profiles
+    add key profiles_user (user_id, deleted, updated_on),
+    add key profiles_deleted_name (deleted, name),
+    add key profiles_ranking (points, seconds_played);
+
+-- stats and last teams: matches of a profile, newest first
+alter table matches_played
+    add key matches_played_profile (profile_id, match_id, home);
@@ -95,3 +95,44 @@ create table if not exists settings (
 
 ) Engine=InnoDB default charset=utf8;
 
+create table if not exists journal_applied (
+    entry_key varchar(64) not null,
+    applied_on timestamp not null default current_timestamp,
+    primary key(entry_key)
+
+) Engine=InnoDB default charset=utf8;
+
+create table if not exists match_rollups (
+    profile_id int unsigned not null,
+    month date not null,
+    games int unsigned not null default 0,
+    wins int unsigned not null default 0,
+    losses int unsigned not null default 0,
+    draws int unsigned not null default 0,
+    goals_scored int unsigned not null default 0,
+    goals_allowed int unsigned not null default 0,
+    primary key(profile_id, month)
+
+) Engine=InnoDB default charset=utf8;
+
+create table if not exists matches_archive (
+    id bigint unsigned not null,
+    score_home int unsigned not null default 0,
+    score_away int unsigned not null default 0,
+    team_id_home int not null default -1,
+    team_id_away int not null default -1,
+    played_on timestamp not null default current_timestamp,
+    primary key(id),
+    key(played_on)
+
+) Engine=InnoDB default charset=utf8;
+
+create table if not exists matches_played_archive (
+    id bigint unsigned not null,
+    match_id bigint unsigned not null,
+    profile_id int unsigned not null,
+    home boolean not null default 0,
+    primary key(id),
+    key(match_id)
+
+) Engine=InnoDB default charset=utf8;
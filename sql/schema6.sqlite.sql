@@ -0,0 +1,144 @@
+-- SQLite version of schema6.sql (DB.backend: sqlite or memory)
+
+create table if not exists users (
+    id integer primary key autoincrement,
+    deleted boolean not null default 0,
+    username varchar(32) not null unique,
+    serial char(20) not null,
+    hash char(32) not null unique,
+    reset_nonce varchar(32) default null,
+    updated_on timestamp not null default (datetime('now','localtime'))
+);
+
+create table if not exists profiles (
+    id integer primary key autoincrement,
+    deleted boolean not null default 0,
+    user_id int not null,
+    ordinal tinyint not null default -1,
+    name varchar(32) not null unique,
+    `rank` int not null default 0,
+    rating int not null default 0,
+    points int not null default 0,
+    disconnects int not null default 0,
+    updated_on timestamp not null default (datetime('now','localtime')),
+    seconds_played bigint not null default 0,
+    comment varchar(256) default null,
+    foreign key(user_id) references users (id)
+);
+
+create table if not exists matches (
+    id integer primary key autoincrement,
+    score_home int not null default 0,
+    score_away int not null default 0,
+    team_id_home int not null default -1,
+    team_id_away int not null default -1,
+    played_on timestamp not null default (datetime('now','localtime'))
+);
+
+create table if not exists matches_played (
+    id integer primary key autoincrement,
+    match_id bigint not null,
+    profile_id int not null,
+    home boolean not null default 0,
+    unique(match_id, profile_id),
+    foreign key(match_id) references matches (id),
+    foreign key(profile_id) references profiles (id)
+);
+
+create table if not exists streaks (
+    id integer primary key autoincrement,
+    profile_id int not null,
+    wins int not null default 0,
+    best int not null default 0,
+    unique(profile_id),
+    foreign key(profile_id) references profiles (id)
+);
+
+create table if not exists friends (
+    id integer primary key autoincrement,
+    profile_id int not null,
+    friend_profile_id int not null,
+    unique(profile_id, friend_profile_id),
+    foreign key(profile_id) references profiles (id),
+    foreign key(friend_profile_id) references profiles (id)
+);
+
+create table if not exists blocked (
+    id integer primary key autoincrement,
+    profile_id int not null,
+    blocked_profile_id int not null,
+    unique(profile_id, blocked_profile_id),
+    foreign key(profile_id) references profiles (id),
+    foreign key(blocked_profile_id) references profiles (id)
+);
+
+create table if not exists settings (
+    id integer primary key autoincrement,
+    profile_id int not null,
+    settings1 blob default null,
+    settings2 blob default null,
+    unique(profile_id),
+    foreign key(profile_id) references profiles (id)
+);
+
+create table if not exists journal_applied (
+    entry_key varchar(64) not null primary key,
+    applied_on timestamp not null default (datetime('now','localtime'))
+);
+
+create table if not exists match_rollups (
+    profile_id int not null,
+    month date not null,
+    games int not null default 0,
+    wins int not null default 0,
+    losses int not null default 0,
+    draws int not null default 0,
+    goals_scored int not null default 0,
+    goals_allowed int not null default 0,
+    primary key(profile_id, month)
+);
+
+create table if not exists matches_archive (
+    id integer primary key,
+    score_home int not null default 0,
+    score_away int not null default 0,
+    team_id_home int not null default -1,
+    team_id_away int not null default -1,
+    played_on timestamp not null
+);
+
+create table if not exists matches_played_archive (
+    id integer primary key,
+    match_id bigint not null,
+    profile_id int not null,
+    home boolean not null default 0
+);
+
+-- indexes of the hot queries (see sql/migrations*/002_hot_indexes)
+create index if not exists users_deleted_username
+    on users (deleted, username);
+create index if not exists users_reset_nonce on users (reset_nonce);
+
+create index if not exists profiles_user
+    on profiles (user_id, deleted, updated_on);
+create index if not exists profiles_deleted_name on profiles (deleted, name);
+create index if not exists profiles_ranking
+    on profiles (points, seconds_played);
+
+-- stats and last teams: matches of a profile, newest first
+create index if not exists matches_played_profile
+    on matches_played (profile_id, match_id, home);
+
+create trigger if not exists users_updated_on after update on users
+for each row when new.updated_on = old.updated_on
+begin
+    update users set updated_on = datetime('now','localtime')
+    where id = new.id;
+end;
+
+create trigger if not exists profiles_updated_on after update on profiles
+for each row when new.updated_on = old.updated_on
+begin
+    update profiles set updated_on = datetime('now','localtime')
+    where id = new.id;
+end;